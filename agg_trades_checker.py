@@ -1,10 +1,13 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 from multiprocessing import Pool
 import os
+import numpy as np
 import pandas as pd
 
 import api_downloader
+import catalog
 import config
 import csv_util
 from enums import SymbolType
@@ -15,105 +18,152 @@ logging.basicConfig(level=logging.INFO)
 _logger = logging.getLogger(__name__)
 
 
-def check_consistency(frame: pd.DataFrame) -> list[int]:
-    ids = frame["id"].to_numpy()
+def empty_id_ranges() -> np.ndarray:
+    return np.empty((0, 2), dtype=np.int64)
+
+
+def count_missing_ids(id_ranges: np.ndarray) -> int:
+    """Number of ids in (start_id, end_id) ranges, both ends included."""
+    return int((id_ranges[:, 1] - id_ranges[:, 0] + 1).sum())
+
+
+def merge_id_ranges(id_ranges: np.ndarray) -> np.ndarray:
+    """
+    Sort (start_id, end_id) ranges and merge the ones that overlap or touch.
+    """
+    if len(id_ranges) == 0:
+        return empty_id_ranges()
+    id_ranges = id_ranges[np.argsort(id_ranges[:, 0], kind="stable")]
+    starts = id_ranges[:, 0]
+    ends = np.maximum.accumulate(id_ranges[:, 1])
+    new_group = np.r_[True, starts[1:] > ends[:-1] + 1]
+    group_indices = np.flatnonzero(new_group)
+    return np.column_stack([starts[group_indices], np.maximum.reduceat(id_ranges[:, 1], group_indices)])
+
+
+def check_consistency(frame: pd.DataFrame) -> np.ndarray:
+    """
+    Find the holes in the ids of a trades frame.
+
+    Returns:
+        Array of shape (n, 2) with the (start_id, end_id) of every hole, both ends
+        included, so memory follows the number of holes and not of missing ids
+    """
+    ids = frame["id"].to_numpy(dtype=np.int64)
 
     # Check for missing ids by finding where difference is > 1
     id_diffs = ids[1:] - ids[:-1]
     missing_indices = id_diffs > 1
     
-    # If no gaps found, return empty list
-    if not any(missing_indices):
-        return []
-    
-    # Get the starting ids where gaps occur
-    gap_starts = ids[:-1][missing_indices]
-    gap_sizes = id_diffs[missing_indices] - 1
-    
-    # Generate all missing ids
-    missing_ids = []
-    for start, size in zip(gap_starts, gap_sizes):
-        missing_ids.extend(range(start + 1, start + size + 1))
-        
-    return missing_ids
+    # Each hole runs from the id after its left neighbour to the id before its right one
+    return np.column_stack([ids[:-1][missing_indices] + 1, ids[1:][missing_indices] - 1])
 
 
-def check_one_file_consistency(file_path: str, headers: list[str]) -> tuple[int, int, list[int]]:
+def check_one_file_consistency(file_path: str, headers: list[str], fast: bool = True) -> tuple[int, int, np.ndarray]:
     """Check consistency of IDs in a single CSV file.
 
+    Ids of a file are strictly increasing, so it has no hole exactly when
+    last_id - first_id + 1 equals its row count.
+
     Args:
         file_path: Path to the CSV file to check
         headers: List of column headers expected in the CSV file
+        fast: Test that identity on the first and last ids and the row count,
+        from the parquet footer or a newline count of the csv, and only read the
+        id column when it fails
 
     Returns:
         Tuple containing:
             - start_id: First ID in the file
             - end_id: Last ID in the file 
-            - missing_ids: List of any missing IDs between start and end
+            - missing_id_ranges: (start_id, end_id) ranges of missing IDs between start and end
     """
-    with open(file_path, "r") as f:
-        _logger.info(f"Checking {file_path} for consistency")
-        df = csv_util.csv_to_pandas(f, headers)
-        if df.empty:
-            _logger.warning(f"File {file_path} is empty")
-            return 0, 0, []
-        start_id = df["id"].min()
-        end_id = df["id"].max()
-        missing_ids = check_consistency(df)
-        if len(missing_ids) > 0:
-            _logger.info(f"Found {len(missing_ids)} missing IDs in {file_path}")
-        return start_id, end_id, missing_ids
+    _logger.info(f"Checking {file_path} for consistency")
+    if fast:
+        first_id, last_id, rows = csv_util.get_int_column_bounds(file_path, headers, "id")
+        if rows > 0 and last_id - first_id + 1 == rows:
+            return first_id, last_id, empty_id_ranges()
+    df = csv_util.read_file_to_pandas(file_path, headers, usecols=["id"])
+    if df.empty:
+        _logger.warning(f"File {file_path} is empty")
+        return 0, 0, empty_id_ranges()
+    start_id = df["id"].min()
+    end_id = df["id"].max()
+    missing_id_ranges = check_consistency(df)
+    if len(missing_id_ranges) > 0:
+        _logger.info(f"Found {count_missing_ids(missing_id_ranges)} missing IDs in {len(missing_id_ranges)} ranges in {file_path}")
+    return start_id, end_id, missing_id_ranges
+
+
+def _check_one_file_consistency_for_cache(file_path: str, headers: list[str]) -> tuple[str, int, int, int, int, np.ndarray]:
+    # stat before reading, a file rewritten meanwhile then fails the fingerprint next time
+    st = os.stat(file_path)
+    return (file_path, st.st_size, st.st_mtime_ns, *check_one_file_consistency(file_path, headers))
             
 
-def multi_proc_check_one_dir_consistency(dir_path: str, headers: list[str], *, tidy_dir: str | None = None, start_file_name: str | None = None, max_workers: int = config.max_workers) -> list[int]:
-    infos: list[tuple[int, int, list[int]]] = []
+def multi_proc_check_one_dir_consistency(dir_path: str, headers: list[str], *, tidy_dir: str | None = None, start_file_name: str | None = None, max_workers: int = config.max_workers) -> np.ndarray:
+    """
+    Check the ids of every file in dir_path and between neighbouring files.
+
+    The result of each file is cached in the catalog with the size and mtime of
+    the file, only new or changed files are read, the gaps between files are
+    recomputed from the cached start and end ids.
+
+    Returns:
+        Array of shape (n, 2) with the (start_id, end_id) ranges of missing ids, sorted
+    """
+    infos: list[tuple[int, int, np.ndarray]] = []
     if start_file_name is None:
         start_file_name = ""
-
-    with Pool(processes=max_workers) as pool:
-        files = []
-        for name in os.listdir(dir_path):
-            if name.endswith(".csv") and name >= start_file_name:
-                if tidy_dir is not None:
-                    tidy_file_path = os.path.join(tidy_dir, name)
-                    if os.path.exists(tidy_file_path):
-                        files.append(tidy_file_path)
-                        continue
-                files.append(os.path.join(dir_path, name))
-        infos = pool.starmap(check_one_file_consistency, [(file, headers) for file in files])
+    start_stem = os.path.splitext(start_file_name)[0]
+
+    tidy_file_names = {}
+    if tidy_dir is not None:
+        tidy_file_names = catalog.file_names_by_stem(tidy_dir, csv_util.data_file_exts)
+
+    files = []
+    for name in catalog.list_file_names(dir_path, csv_util.data_file_exts):
+        stem = os.path.splitext(name)[0]
+        if stem >= start_stem:
+            if stem in tidy_file_names:
+                files.append(os.path.join(tidy_dir, tidy_file_names[stem]))
+                continue
+            files.append(os.path.join(dir_path, name))
+
+    cached_infos = catalog.load_id_checks(files)
+    todo_files = [file for file in files if file not in cached_infos]
+    _logger.info(f"Checking {len(todo_files)} files in {dir_path}, {len(cached_infos)} cached")
+    if todo_files:
+        with Pool(processes=max_workers) as pool:
+            checks = pool.starmap(_check_one_file_consistency_for_cache, [(file, headers) for file in todo_files])
+        catalog.save_id_checks(checks)
+        cached_infos.update({check[0]: check[3:] for check in checks})
+    infos = [cached_infos[file] for file in files]
         
     if len(infos) == 0:
-        return []
+        return empty_id_ranges()
     
     infos.sort(key=lambda x: x[0])
     
-    if len(infos) == 1:
-        return infos[0][2]
-    
     last_end_id = infos[0][1]
-    missing_ids = [id for id in infos[0][2]]
+    missing_id_ranges = [infos[0][2]]
     for info in infos[1:]:
-        start_id, end_id, ids = info
-        if start_id != last_end_id + 1:
-            missing_ids.extend(range(last_end_id + 1, start_id))
-        missing_ids.extend(ids)
+        start_id, end_id, id_ranges = info
+        if start_id > last_end_id + 1:
+            missing_id_ranges.append(np.array([[last_end_id + 1, start_id - 1]], dtype=np.int64))
+        missing_id_ranges.append(id_ranges)
         last_end_id = end_id
 
-    return missing_ids
-
+    return np.concatenate(missing_id_ranges)
 
-def group_missing_ids(missing_ids: list[int]) -> list[list[int]]:
-    groups = []
-    for id in missing_ids:
-        if len(groups) == 0 or id != groups[-1][-1] + 1:
-            groups.append([id])
-        else:
-            groups[-1].append(id)
-    return groups
 
+def download_missing_trades(syb_type: SymbolType, symbol: str, missing_id_ranges: np.ndarray, max_in_flight: int = config.max_in_flight_rest_requests) -> list[dict]:
+    """
+    Download the trades of every missing id range from the REST api.
 
-def download_missing_trades(syb_type: SymbolType, symbol: str, missing_ids: list[int]) -> list[dict]:
-    grouped_missing_ids = group_missing_ids(missing_ids)
+    Ranges are downloaded by up to max_in_flight threads, the shared weight
+    budget of api_downloader decides how fast they actually go.
+    """
     trades = []
     f = None
     match syb_type:
@@ -123,8 +173,10 @@ def download_missing_trades(syb_type: SymbolType, symbol: str, missing_ids: list
             f = api_downloader.download_um_futures_agg_trades_by_ids
         case SymbolType.FUTURES_CM:
             f = api_downloader.download_cm_futures_agg_trades_by_ids
-    for group in grouped_missing_ids:
-        trades.extend(f(symbol, group[0], group[-1]))
+    id_ranges = merge_id_ranges(missing_id_ranges).tolist()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for ts in executor.map(lambda r: f(symbol, r[0], r[1]), id_ranges):
+            trades.extend(ts)
     return trades
 
 
@@ -151,7 +203,7 @@ def group_trades_by_date_save(symbol: str, trades: list[dict], save_dir: str, he
         filepath = os.path.join(save_dir, filename)
         
         # Convert date_trades list to pandas DataFrame
-        date_trades_df = pd.DataFrame(date_trades, columns=csv_util.agg_trades_api_data_headers)
+        date_trades_df = pd.DataFrame(date_trades, columns=csv_util.agg_trades_api_data_headers[:len(headers)])
         
         date_trades_df.columns = headers
 
@@ -168,36 +220,100 @@ def group_trades_by_date_save(symbol: str, trades: list[dict], save_dir: str, he
         
         # Write sorted DataFrame back to CSV
         date_trades_df.to_csv(filepath, index=False)
+        catalog.record_frame(filepath, date_trades_df, "id", "time")
         _logger.info(f"Saved {len(date_trades_df)} trades to {filepath}")
-        return
 
 
-def download_missing_trades_and_save(syb_type: SymbolType, symbol: str, missing_ids: list[int], save_dir: str, headers: list[str]) -> None:
-    if not missing_ids:
+def download_missing_trades_and_save(syb_type: SymbolType, symbol: str, missing_id_ranges: np.ndarray, save_dir: str, headers: list[str]) -> None:
+    if len(missing_id_ranges) == 0:
         return
-    trades = download_missing_trades(syb_type, symbol, missing_ids)
+    trades = download_missing_trades(syb_type, symbol, missing_id_ranges)
     group_trades_by_date_save(symbol, trades, save_dir, headers)
     
 
-def merge_raw_and_missing_trades(file_name: str, raw_dir: str, missing_dir: str, save_dir: str, headers: list[str], check_tidy_file_exists: bool = True) -> None:
+def merge_sorted_trades(raw_df: pd.DataFrame, missing_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Insert the trades of missing_df into raw_df, keeping them sorted by id.
+
+    raw_df is sorted by id already, so every missing trade is placed by a binary
+    search of its id and each column is written once into the merged frame.
+    Besides that single copy of the day, the work follows the number of missing
+    trades. Missing trades whose id is already in raw_df, or repeated, are dropped.
+
+    Returns:
+        The merged trades with the columns of raw_df and a fresh index
+    """
+    if missing_df.empty:
+        return raw_df.reset_index(drop=True)
+    missing_ids = missing_df["id"].to_numpy(dtype=np.int64)
+    order = np.argsort(missing_ids, kind="stable")
+    missing_ids = missing_ids[order]
+    if raw_df.empty:
+        keep = np.r_[True, missing_ids[1:] != missing_ids[:-1]]
+        return missing_df.iloc[order[keep]].reset_index(drop=True)
+
+    raw_ids = raw_df["id"].to_numpy(dtype=np.int64)
+    positions = np.searchsorted(raw_ids, missing_ids)
+    in_raw = raw_ids[np.minimum(positions, len(raw_ids) - 1)] == missing_ids
+    keep = ~in_raw & np.r_[True, missing_ids[1:] != missing_ids[:-1]]
+    order = order[keep]
+    positions = positions[keep]
+    if len(order) == 0:
+        return raw_df.reset_index(drop=True)
+
+    # the j-th kept missing trade lands after the raw trades before it and the j missing trades before it
+    missing_indexes = positions + np.arange(len(positions))
+    is_raw = np.ones(len(raw_ids) + len(positions), dtype=bool)
+    is_raw[missing_indexes] = False
+    columns = {}
+    for column in raw_df.columns:
+        raw_values = raw_df[column].to_numpy()
+        values = np.empty(len(is_raw), dtype=raw_values.dtype)
+        values[is_raw] = raw_values
+        values[missing_indexes] = missing_df[column].to_numpy(dtype=raw_values.dtype)[order]
+        columns[column] = values
+    return pd.DataFrame(columns, columns=raw_df.columns)
+
+
+def _save_id_check_of_written_frame(file_path: str, df: pd.DataFrame) -> None:
+    # the frame is still in memory, so the check of the tidy file written from it is free
+    if df.empty:
+        return
+    st = os.stat(file_path)
+    catalog.save_id_checks([(file_path, st.st_size, st.st_mtime_ns, df["id"].min(), df["id"].max(), check_consistency(df))])
+
+
+def merge_raw_and_missing_trades(
+        file_name: str,
+        raw_dir: str,
+        missing_dir: str,
+        save_dir: str,
+        headers: list[str],
+        check_tidy_file_exists: bool = True,
+        tidy_format: str = config.tidy_agg_trades_format,
+    ) -> None:
     os.makedirs(missing_dir, exist_ok=True)
     os.makedirs(save_dir, exist_ok=True)
-    tidy_path = os.path.join(save_dir, file_name)
-    if check_tidy_file_exists and os.path.exists(tidy_path):
-        _logger.info(f"Tidy file {tidy_path} already exists, skipping")
-        return
+    # raw file may be csv or parquet, missing files are csv, tidy files are tidy_format
+    stem = os.path.splitext(file_name)[0]
+    tidy_path = os.path.join(save_dir, f"{stem}.{tidy_format}")
+    if check_tidy_file_exists:
+        exist_tidy_path = csv_util.find_data_file(save_dir, stem)
+        if exist_tidy_path is not None:
+            _logger.info(f"Tidy file {exist_tidy_path} already exists, skipping")
+            return
 
     raw_path = os.path.join(raw_dir, file_name)
-    raw_df = None
-    with open(raw_path, "r") as f:
-        raw_df = csv_util.csv_to_pandas(f, headers)
+    raw_df = csv_util.read_file_to_pandas(raw_path, headers)
 
     os.makedirs(save_dir, exist_ok=True)
 
-    missing_path = os.path.join(missing_dir, file_name)
+    missing_path = os.path.join(missing_dir, stem + ".csv")
     if not os.path.exists(missing_path):
         _logger.info(f"No missing trades file for {file_name}, copying raw file to tidy file")
-        raw_df.to_csv(tidy_path, index=False)
+        csv_util.write_pandas_to_file(raw_df, tidy_path)
+        catalog.record_frame(tidy_path, raw_df, "id", "time")
+        _save_id_check_of_written_frame(tidy_path, raw_df)
         _logger.info(f"Saved raw trades to {tidy_path}")
         return
     
@@ -207,10 +323,11 @@ def merge_raw_and_missing_trades(file_name: str, raw_dir: str, missing_dir: str,
     with open(missing_path, "r") as f:
         missing_df = csv_util.csv_to_pandas(f, headers)
     
-    merged_df = pd.concat([raw_df, missing_df])
-    merged_df.sort_values(by="id", inplace=True, key=lambda x: x.astype(int))
+    merged_df = merge_sorted_trades(raw_df, missing_df)
     
-    merged_df.to_csv(tidy_path, index=False)
+    csv_util.write_pandas_to_file(merged_df, tidy_path)
+    catalog.record_frame(tidy_path, merged_df, "id", "time")
+    _save_id_check_of_written_frame(tidy_path, merged_df)
 
     _logger.info(f"Saved merged trades to {os.path.join(save_dir, file_name)}")
     
@@ -218,12 +335,25 @@ def merge_raw_and_missing_trades(file_name: str, raw_dir: str, missing_dir: str,
     _logger.info(f"Cleared {raw_path}")
     
 
-def multi_proc_merge_one_dir_raw_and_missing_trades(raw_dir: str, missing_dir: str, save_dir: str, headers: list[str], check_tidy_file_exists: bool = True, max_workers: int = config.max_workers) -> None:
+def multi_proc_merge_one_dir_raw_and_missing_trades(
+        raw_dir: str,
+        missing_dir: str,
+        save_dir: str,
+        headers: list[str],
+        check_tidy_file_exists: bool = True,
+        max_workers: int = config.max_workers,
+        tidy_format: str = config.tidy_agg_trades_format,
+    ) -> None:
     os.makedirs(save_dir, exist_ok=True)
     os.makedirs(missing_dir, exist_ok=True)
     os.makedirs(raw_dir, exist_ok=True)
+    file_names = catalog.list_file_names(raw_dir, csv_util.data_file_exts)
+    if check_tidy_file_exists:
+        tidy_stems = {os.path.splitext(name)[0] for name in catalog.list_file_names(save_dir, csv_util.data_file_exts)}
+        file_names = [name for name in file_names if os.path.splitext(name)[0] not in tidy_stems]
     with Pool(processes=max_workers) as pool:
-        pool.starmap(merge_raw_and_missing_trades, [(file_name, raw_dir, missing_dir, save_dir, headers, check_tidy_file_exists) for file_name in os.listdir(raw_dir)])
+        pool.starmap(merge_raw_and_missing_trades, [(file_name, raw_dir, missing_dir, save_dir, headers, check_tidy_file_exists, tidy_format)
+                                                    for file_name in file_names])
         
 
 def multi_proc_merge_one_symbol_raw_and_missing_trades(
@@ -234,13 +364,14 @@ def multi_proc_merge_one_symbol_raw_and_missing_trades(
         missing_root_dir: str = config.missing_binance_vision_dir,
         tidy_root_dir: str = config.tidy_binance_vision_dir,
         check_tidy_file_exists: bool = True,
-        max_workers: int = config.max_workers
+        max_workers: int = config.max_workers,
+        tidy_format: str = config.tidy_agg_trades_format,
     ) -> None:
     prefix = f"data/{syb_type.value}/daily/aggTrades/{symbol}"
     raw_dir = os.path.join(unzip_root_dir, prefix)
     missing_dir = os.path.join(missing_root_dir, prefix)
     save_dir = os.path.join(tidy_root_dir, prefix)
-    multi_proc_merge_one_dir_raw_and_missing_trades(raw_dir, missing_dir, save_dir, headers, check_tidy_file_exists, max_workers)
+    multi_proc_merge_one_dir_raw_and_missing_trades(raw_dir, missing_dir, save_dir, headers, check_tidy_file_exists, max_workers, tidy_format)
     
 
 if __name__ == "__main__":
@@ -253,12 +384,12 @@ if __name__ == "__main__":
 
     unzip_dir_path = f"{unzip_root_dir}/{prefix}"
 
-    missing_ids = multi_proc_check_one_dir_consistency(unzip_dir_path, csv_util.agg_trades_headers)
-    if missing_ids:
-        _logger.info(f"Downloading {len(missing_ids)} missing trades for {symbol}")
+    missing_id_ranges = multi_proc_check_one_dir_consistency(unzip_dir_path, csv_util.agg_trades_headers)
+    if len(missing_id_ranges) > 0:
+        _logger.info(f"Downloading {count_missing_ids(missing_id_ranges)} missing trades for {symbol}")
         missing_dir_path = f"{missing_root_dir}/{prefix}"
-        download_missing_trades_and_save(syb_type, symbol, missing_ids, missing_dir_path, csv_util.agg_trades_headers)
-        _logger.info(f"Downloaded {len(missing_ids)} missing trades for {symbol}")
+        download_missing_trades_and_save(syb_type, symbol, missing_id_ranges, missing_dir_path, csv_util.agg_trades_headers)
+        _logger.info(f"Downloaded {count_missing_ids(missing_id_ranges)} missing trades for {symbol}")
     _logger.info(f"Merging raw and missing trades for {symbol}")
     multi_proc_merge_one_symbol_raw_and_missing_trades(syb_type, symbol, csv_util.agg_trades_headers)
     _logger.info(f"Merged raw and missing trades for {symbol}")
@@ -1,6 +1,7 @@
 import logging
 import os
 import agg_trades_checker
+import catalog
 import config
 import csv_util
 from enums import SymbolType
@@ -19,6 +20,8 @@ def tidy_one_symbol(
         unzip_root_dir: str = config.unzip_binance_vision_dir,
         missing_root_dir: str = config.missing_binance_vision_dir,
         tidy_root_dir: str = config.tidy_binance_vision_dir,
+        unzip_format: str = "csv",  # csv or parquet
+        tidy_format: str = config.tidy_agg_trades_format,  # csv, parquet or agz
         max_workers: int = config.max_workers
         ):
 
@@ -42,14 +45,6 @@ def tidy_one_symbol(
     
     raw_downloader.multi_proc_download(prefix, marker, zip_dir, max_workers=max_workers)
     
-    raw_unzipper.multi_proc_unzip_one_dir_files_to_dir(zip_dir, unzip_dir, max_workers=max_workers)
-    
-    last_file_name = ""
-    file_names = os.listdir(tidy_dir)
-    if file_names:
-        file_names.sort()
-        last_file_name = file_names[-1]
-        
     agg_trades_header = None
     if syb_type == SymbolType.SPOT:
         agg_trades_header = csv_util.agg_trades_headers
@@ -57,17 +52,24 @@ def tidy_one_symbol(
         agg_trades_header = csv_util.agg_trades_headers[:-1]
     elif syb_type == SymbolType.FUTURES_CM:
         agg_trades_header = csv_util.agg_trades_headers[:-1]
+
+    if unzip_format == "parquet":
+        raw_unzipper.multi_proc_unzip_one_dir_files_to_parquet(zip_dir, unzip_dir, agg_trades_header, max_workers=max_workers)
+    else:
+        raw_unzipper.multi_proc_unzip_one_dir_files_to_dir(zip_dir, unzip_dir, max_workers=max_workers)
+    
+    last_file_name = catalog.last_file_name(tidy_dir, csv_util.data_file_exts)
     
-    missing_ids = agg_trades_checker.multi_proc_check_one_dir_consistency(unzip_dir, agg_trades_header, tidy_dir=tidy_dir, start_file_name=last_file_name, max_workers=max_workers)
+    missing_id_ranges = agg_trades_checker.multi_proc_check_one_dir_consistency(unzip_dir, agg_trades_header, tidy_dir=tidy_dir, start_file_name=last_file_name, max_workers=max_workers)
     
-    agg_trades_checker.download_missing_trades_and_save(syb_type, symbol, missing_ids, missing_dir, agg_trades_header)
+    agg_trades_checker.download_missing_trades_and_save(syb_type, symbol, missing_id_ranges, missing_dir, agg_trades_header)
     
-    agg_trades_checker.multi_proc_merge_one_symbol_raw_and_missing_trades(syb_type, symbol, agg_trades_header, max_workers=max_workers)
+    agg_trades_checker.multi_proc_merge_one_symbol_raw_and_missing_trades(syb_type, symbol, agg_trades_header, max_workers=max_workers, tidy_format=tidy_format)
     
-    missing_ids = agg_trades_checker.multi_proc_check_one_dir_consistency(tidy_dir, agg_trades_header, start_file_name=last_file_name, max_workers=max_workers)
+    missing_id_ranges = agg_trades_checker.multi_proc_check_one_dir_consistency(tidy_dir, agg_trades_header, start_file_name=last_file_name, max_workers=max_workers)
     
-    if missing_ids:
-        _logger.error(f"Missing trades found for {symbol} in {tidy_dir}")
+    if len(missing_id_ranges) > 0:
+        _logger.error(f"Missing trades found for {symbol} in {tidy_dir}: {agg_trades_checker.count_missing_ids(missing_id_ranges)} ids in {len(missing_id_ranges)} ranges")
         
 
 if __name__ == "__main__":
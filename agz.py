@@ -0,0 +1,209 @@
+import json
+import logging
+import struct
+from typing import Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import config
+
+_logger = logging.getLogger(__name__)
+
+# .agz 是tidy aggTrades的紧凑列式格式
+# 文件 = magic + 若干块 + footer(json) + footer长度(uint32) + magic
+# 每块 = 块头长度(uint32) + 块头(json) + 各列数据，各列单独用zstd压缩
+# 整数列存差分或直接存，减去最小值后用最窄的无符号类型(frame of reference)
+# 浮点列如果都是有限位小数，乘以10的幂变成整数后同样处理，否则原样存float64
+# lastTradeId存和firstTradeId的差，布尔列按位打包
+_magic = b"AGZ1"
+_length = struct.Struct("<I")
+_uint_dtypes = ("<u1", "<u2", "<u4", "<u8")
+# prices and quantities of binance have at most 8 decimals, scaled values must stay exact in float64
+_max_decimals = 10
+_codec = "zstd"
+
+
+def _pack_for(values: np.ndarray) -> tuple[dict, np.ndarray]:
+    """Frame of reference: subtract the minimum and keep the narrowest unsigned type."""
+    if len(values) == 0:
+        return {"ref": 0, "dtype": _uint_dtypes[0]}, np.empty(0, dtype=_uint_dtypes[0])
+    ref = int(values.min())
+    span = int(values.max()) - ref
+    dtype = next(d for d in _uint_dtypes if span < 1 << (8 * np.dtype(d).itemsize))
+    return {"ref": ref, "dtype": dtype}, (values - ref).astype(dtype)
+
+
+def _encode_ints(values: np.ndarray) -> tuple[dict, np.ndarray]:
+    # dense ids and sorted times have tiny deltas, other columns are narrower as they are
+    plain_meta, plain = _pack_for(values)
+    if len(values) < 2:
+        return {"enc": "for", **plain_meta}, plain
+    delta_meta, deltas = _pack_for(np.diff(values))
+    if deltas.itemsize < plain.itemsize:
+        return {"enc": "delta", "first": int(values[0]), **delta_meta}, deltas
+    return {"enc": "for", **plain_meta}, plain
+
+
+def _decimal_scale(values: np.ndarray) -> int | None:
+    """Smallest number of decimals that holds every value exactly, None if there is none."""
+    finite = np.isfinite(values).all()
+    if not finite:
+        return None
+    for decimals in range(_max_decimals + 1):
+        scale = 10.0 ** decimals
+        scaled = np.round(values * scale)
+        if np.abs(scaled).max(initial=0) >= 2 ** 53:
+            return None
+        # dividing the exact integer gives the nearest double of the decimal, like parsing it
+        if np.array_equal(scaled / scale, values):
+            return decimals
+    return None
+
+
+def _encode_column(name: str, values: np.ndarray, columns: dict[str, np.ndarray]) -> tuple[dict, np.ndarray]:
+    if values.dtype == bool:
+        return {"enc": "bits"}, np.packbits(values)
+    if np.issubdtype(values.dtype, np.integer):
+        if name == "lastTradeId" and "firstTradeId" in columns:
+            meta, packed = _pack_for(values - columns["firstTradeId"])
+            return {"enc": "offset", "base": "firstTradeId", **meta}, packed
+        return _encode_ints(values.astype(np.int64))
+    values = values.astype(np.float64)
+    decimals = _decimal_scale(values)
+    if decimals is None:
+        return {"enc": "raw", "dtype": "<f8"}, values.astype("<f8")
+    meta, packed = _encode_ints(np.round(values * 10.0 ** decimals).astype(np.int64))
+    return {**meta, "decimals": decimals}, packed
+
+
+def _decode_column(meta: dict, data: np.ndarray, rows: int, decoded: dict[str, np.ndarray]) -> np.ndarray:
+    enc = meta["enc"]
+    if enc == "bits":
+        return np.unpackbits(data, count=rows).astype(bool)
+    if enc == "raw":
+        return data
+    if enc == "offset":
+        values = decoded[meta["base"]] + data.astype(np.int64) + meta["ref"]
+    elif enc == "delta":
+        values = np.empty(rows, dtype=np.int64)
+        if rows > 0:
+            values[0] = meta["first"]
+            np.cumsum(data.astype(np.int64) + meta["ref"], out=values[1:])
+            values[1:] += meta["first"]
+    else:
+        values = data.astype(np.int64) + meta["ref"]
+    if "decimals" in meta:
+        return values / 10.0 ** meta["decimals"]
+    return values
+
+
+def _encode_block(df: pd.DataFrame) -> tuple[bytes, dict]:
+    columns = {c: df[c].to_numpy() for c in df.columns}
+    metas = []
+    payloads = []
+    stats = {}
+    for name, values in columns.items():
+        meta, packed = _encode_column(name, values, columns)
+        raw = packed.tobytes()
+        compressed = pa.compress(raw, codec=_codec, asbytes=True)
+        metas.append({"name": name, **meta, "raw_nbytes": len(raw), "nbytes": len(compressed)})
+        payloads.append(compressed)
+        first, last = values[0].item(), values[-1].item()
+        stats[name] = [first, last]
+    header = json.dumps({"rows": len(df), "columns": metas}).encode()
+    return _length.pack(len(header)) + header + b"".join(payloads), stats
+
+
+def write_agg_trades(df: pd.DataFrame, file_path: str, block_rows: int = config.stream_chunk_rows) -> None:
+    """
+    Write agg trades sorted by id as an .agz file, in blocks of block_rows rows
+    so they can be decoded one at a time.
+    """
+    blocks = []
+    with open(file_path, "wb") as f:
+        f.write(_magic)
+        for start in range(0, len(df), block_rows):
+            block = df.iloc[start:start + block_rows]
+            offset = f.tell()
+            data, stats = _encode_block(block)
+            f.write(data)
+            blocks.append({"offset": offset, "rows": len(block), "stats": stats})
+        dtypes = {c: df[c].dtype.str for c in df.columns}
+        footer = json.dumps({"columns": list(df.columns), "dtypes": dtypes, "blocks": blocks}).encode()
+        f.write(footer)
+        f.write(_length.pack(len(footer)))
+        f.write(_magic)
+
+
+def read_footer(file_path: str) -> dict:
+    """
+    Columns, dtypes and blocks of an .agz file, each block with its offset, rows
+    and the first and last value of every column.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(-(_length.size + len(_magic)), 2)
+        footer_length = _length.unpack(f.read(_length.size))[0]
+        if f.read(len(_magic)) != _magic:
+            raise ValueError(f"{file_path} is not an agz file")
+        f.seek(-(_length.size + len(_magic) + footer_length), 2)
+        return json.loads(f.read(footer_length))
+
+
+def iter_agg_trades_blocks(
+        file_path: str,
+        usecols: list[str] | None = None,
+        block_indexes: list[int] | None = None,
+        ) -> Iterator[dict[str, np.ndarray]]:
+    """
+    Decode an .agz file block by block, only the blocks of block_indexes if given,
+    e.g. the ones whose footer stats overlap a time range.
+
+    Yields:
+        Dict from column name to values of one block, only usecols if given,
+        plus the columns they are encoded against
+    """
+    footer = read_footer(file_path)
+    with open(file_path, "rb") as f:
+        blocks = footer["blocks"] if block_indexes is None else [footer["blocks"][i] for i in block_indexes]
+        for block in blocks:
+            f.seek(block["offset"])
+            header = json.loads(f.read(_length.unpack(f.read(_length.size))[0]))
+            wanted = set(usecols if usecols is not None else footer["columns"])
+            # offsets are decoded against their base column
+            wanted |= {m["base"] for m in header["columns"] if m["name"] in wanted and m["enc"] == "offset"}
+            decoded: dict[str, np.ndarray] = {}
+            for meta in header["columns"]:
+                if meta["name"] not in wanted:
+                    f.seek(meta["nbytes"], 1)
+                    continue
+                raw = pa.decompress(f.read(meta["nbytes"]), decompressed_size=meta["raw_nbytes"], codec=_codec, asbytes=True)
+                dtype = "<u1" if meta["enc"] == "bits" else meta["dtype"]
+                decoded[meta["name"]] = _decode_column(meta, np.frombuffer(raw, dtype=dtype), header["rows"], decoded)
+            yield decoded
+
+
+def read_agg_trades(file_path: str, usecols: list[str] | None = None) -> pd.DataFrame:
+    """Decode a whole .agz file into a DataFrame with the columns it was written with."""
+    footer = read_footer(file_path)
+    columns = [c for c in footer["columns"] if usecols is None or c in usecols]
+    blocks = list(iter_agg_trades_blocks(file_path, columns))
+    if not blocks:
+        return pd.DataFrame({c: np.empty(0, dtype=footer["dtypes"][c]) for c in columns})
+    return pd.DataFrame({c: np.concatenate([b[c] for b in blocks]) if len(blocks) > 1 else blocks[0][c] for c in columns})
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    import csv_util
+
+    df = csv_util.read_file_to_pandas(sys.argv[1], csv_util.agg_trades_headers)
+    t = time.perf_counter()
+    write_agg_trades(df, sys.argv[1] + ".agz")
+    print(f"encoded in {time.perf_counter() - t:.2f}s")
+    t = time.perf_counter()
+    decoded = read_agg_trades(sys.argv[1] + ".agz")
+    print(f"decoded in {time.perf_counter() - t:.2f}s, equal: {decoded.equals(df)}")
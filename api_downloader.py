@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import logging
 import math
@@ -6,21 +7,69 @@ from typing import Callable, Any
 from binance.spot import Spot
 from binance.um_futures import UMFutures
 from binance.cm_futures import CMFutures
+from binance.error import ClientError
 
+import config
 from enums import SymbolType
+import rate_limiter
 
 
 logging.basicConfig(level=logging.INFO)
 _logger = logging.getLogger(__name__)
 
-def download_agg_trades_by_ids(rester: Callable[[str, dict[str, Any]], list[dict]], symbol: str, start_id: int, end_id: int) -> list[dict]:
+# weight of one request with limit=1000, from the binance api docs
+agg_trades_weights = {
+    SymbolType.SPOT: 4,
+    SymbolType.FUTURES_UM: 20,
+    SymbolType.FUTURES_CM: 20,
+}
+
+klines_weights = {
+    SymbolType.SPOT: 2,
+    SymbolType.FUTURES_UM: 5,
+    SymbolType.FUTURES_CM: 5,
+}
+
+
+def call_with_weight_budget(rester: Callable[..., dict], syb_type: SymbolType, weight: int, **params: Any) -> Any:
+    """
+    Call a connector method created with show_limit_usage=True under the shared
+    weight budget of the market.
+
+    The weight is taken from rate_limiter before the call and the budget is synced
+    with the used weight header of the response. A 429 or 418 pauses every process
+    for the Retry-After seconds of the response and the call is made again.
+
+    Returns:
+        The data of the response
+
+    Raises:
+        Exception: Any other error of the connector
+    """
+    market = syb_type.value
+    while True:
+        rate_limiter.acquire(market, weight)
+        try:
+            response = rester(**params)
+        except ClientError as e:
+            if e.status_code not in (418, 429):
+                raise
+            retry_after = (e.header or {}).get("Retry-After")
+            rate_limiter.ban(market, float(retry_after) if retry_after else 60.0)
+            continue
+        rate_limiter.update_from_headers(market, response["limit_usage"])
+        return response["data"]
+
+
+def download_agg_trades_by_ids(rester: Callable[..., dict], syb_type: SymbolType, symbol: str, start_id: int, end_id: int) -> list[dict]:
     id = start_id - 1
     trades = []
     while id < end_id:
         _logger.info(f"Downloading trades from {id+1} to {end_id}")
         try:
-            ts = rester(symbol=symbol, fromId=id+1, limit=1000)
+            ts = call_with_weight_budget(rester, syb_type, agg_trades_weights[syb_type], symbol=symbol, fromId=id+1, limit=1000)
         except Exception as e:
+            time.sleep(1)
             _logger.error(e)
             continue
         _logger.info(f"Downloaded {len(ts)} trades")
@@ -34,19 +83,59 @@ def download_agg_trades_by_ids(rester: Callable[[str, dict[str, Any]], list[dict
     return trades
 
 
+def download_agg_trades_by_ids_sharded(
+        make_rester: Callable[[], Callable[..., dict]],
+        syb_type: SymbolType,
+        symbol: str,
+        start_id: int,
+        end_id: int,
+        shard_size: int = config.agg_trades_shard_size,
+        max_in_flight: int = config.max_in_flight_rest_requests,
+    ) -> list[dict]:
+    """
+    Download trades start_id ~ end_id as independent shards of shard_size ids.
+
+    Agg trade ids are dense, so every shard can start at its own fromId and page
+    forward on its own. Shards run on up to max_in_flight threads, each with its
+    own client, under the shared weight budget, and are stitched back in id order.
+
+    Args:
+        make_rester: Creates the connector method for one shard, e.g. lambda: Spot(show_limit_usage=True).agg_trades
+        shard_size: Number of ids of each shard
+
+    Returns:
+        Trades sorted by "a", without duplicates
+    """
+    shards = [(s, min(s + shard_size - 1, end_id)) for s in range(start_id, end_id + 1, shard_size)]
+    if len(shards) <= 1:
+        return download_agg_trades_by_ids(make_rester(), syb_type, symbol, start_id, end_id)
+    _logger.info(f"Downloading trades from {start_id} to {end_id} in {len(shards)} shards")
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        parts = list(executor.map(lambda r: download_agg_trades_by_ids(make_rester(), syb_type, symbol, r[0], r[1]), shards))
+    trades = []
+    last_id = start_id - 1
+    for part in parts:
+        for trade in part:
+            # shards are in id order, a trade not after the last one is a duplicate
+            if trade["a"] > last_id:
+                trades.append(trade)
+                last_id = trade["a"]
+    return trades
+
+
 def download_spot_agg_trades_by_ids(symbol: str, start_id: int, end_id: int) -> list[dict]:
-    return download_agg_trades_by_ids(Spot().agg_trades, symbol, start_id, end_id)
+    return download_agg_trades_by_ids_sharded(lambda: Spot(base_url=config.rest_base_urls["spot"], show_limit_usage=True).agg_trades, SymbolType.SPOT, symbol, start_id, end_id)
 
 
 def download_um_futures_agg_trades_by_ids(symbol: str, start_id: int, end_id: int) -> list[dict]:
-    return download_agg_trades_by_ids(UMFutures().agg_trades, symbol, start_id, end_id)
+    return download_agg_trades_by_ids_sharded(lambda: UMFutures(base_url=config.rest_base_urls["futures/um"], show_limit_usage=True).agg_trades, SymbolType.FUTURES_UM, symbol, start_id, end_id)
 
 
 def download_cm_futures_agg_trades_by_ids(symbol: str, start_id: int, end_id: int) -> list[dict]:
-    return download_agg_trades_by_ids(CMFutures().agg_trades, symbol, start_id, end_id)
+    return download_agg_trades_by_ids_sharded(lambda: CMFutures(base_url=config.rest_base_urls["futures/cm"], show_limit_usage=True).agg_trades, SymbolType.FUTURES_CM, symbol, start_id, end_id)
 
 
-def download_klines_with_caller(caller: Callable[[str, str, dict[str, Any]], list[dict]], symbol: str, interval: str, start_open_time: int, end_open_time: int) -> list[list[any]]:
+def download_klines_with_caller(caller: Callable[..., dict], syb_type: SymbolType, symbol: str, interval: str, start_open_time: int, end_open_time: int) -> list[list[any]]:
     open_time = start_open_time
     klines = []
     _logger.info(f"Downloading klines from {
@@ -54,7 +143,7 @@ def download_klines_with_caller(caller: Callable[[str, str, dict[str, Any]], lis
             datetime.datetime.fromtimestamp(end_open_time//1000, datetime.timezone.utc)}")
     while open_time <= end_open_time:
         try:
-            ks = caller(symbol, interval, startTime=open_time, limit=1000)
+            ks = call_with_weight_budget(caller, syb_type, klines_weights[syb_type], symbol=symbol, interval=interval, startTime=open_time, limit=1000)
         except Exception as e:
             time.sleep(1)
             _logger.error(e)
@@ -71,15 +160,15 @@ def download_klines_with_caller(caller: Callable[[str, str, dict[str, Any]], lis
 
 
 def download_spot_klines(symbol: str, interval: str, start_open_time: int, end_open_time: int) -> list[dict]:
-    return download_klines_with_caller(Spot().klines, symbol, interval, start_open_time, end_open_time)
+    return download_klines_with_caller(Spot(base_url=config.rest_base_urls["spot"], show_limit_usage=True).klines, SymbolType.SPOT, symbol, interval, start_open_time, end_open_time)
 
 
 def download_um_futures_klines(symbol: str, interval: str, start_open_time: int, end_open_time: int) -> list[dict]:
-    return download_klines_with_caller(UMFutures().klines, symbol, interval, start_open_time, end_open_time)
+    return download_klines_with_caller(UMFutures(base_url=config.rest_base_urls["futures/um"], show_limit_usage=True).klines, SymbolType.FUTURES_UM, symbol, interval, start_open_time, end_open_time)
 
 
 def download_cm_futures_klines(symbol: str, interval: str, start_open_time: int, end_open_time: int) -> list[dict]:
-    return download_klines_with_caller(CMFutures().klines, symbol, interval, start_open_time, end_open_time)
+    return download_klines_with_caller(CMFutures(base_url=config.rest_base_urls["futures/cm"], show_limit_usage=True).klines, SymbolType.FUTURES_CM, symbol, interval, start_open_time, end_open_time)
 
 
 def download_klines(syb_type: SymbolType, symbol: str, interval: str, start_open_time: int, end_open_time: int) -> list[dict]:
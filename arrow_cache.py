@@ -0,0 +1,154 @@
+import logging
+import os
+
+import pandas as pd
+import pyarrow as pa
+
+import catalog
+import config
+import csv_util
+from enums import SymbolType
+
+_logger = logging.getLogger(__name__)
+
+# schema metadata of a cached day, the fingerprint of the tidy file it was built from
+_source_metadata_keys = (b"source_path", b"source_size", b"source_mtime_ns")
+
+
+def dataset_dir(root_dir: str, syb_type: SymbolType, symbol: str, dataset: str, interval: str | None) -> str:
+    prefix = f"data/{syb_type.value}/daily/{dataset}/{symbol}"
+    if interval is not None:
+        prefix = f"{prefix}/{interval}"
+    return os.path.join(root_dir, prefix)
+
+
+def day_stem(symbol: str, dataset: str, interval: str | None, date: str) -> str:
+    if dataset == "klines":
+        return f"{symbol}-{interval}-{date}"
+    return f"{symbol}-{dataset}-{date}"
+
+
+def dataset_headers(dataset: str) -> list[str]:
+    if dataset == "klines":
+        return csv_util.klines_headers
+    if dataset == "aggTrades":
+        return csv_util.agg_trades_headers
+    raise ValueError(f"Unknown dataset {dataset}, expected klines or aggTrades")
+
+
+def _read_cached_day(cache_path: str, source_path: str) -> pa.Table | None:
+    """
+    Memory map a cached day, None if it is missing or was built from another
+    version of source_path.
+    """
+    if not os.path.exists(cache_path):
+        return None
+    st = os.stat(source_path)
+    source = pa.memory_map(cache_path, "r")
+    reader = pa.ipc.open_file(source)
+    metadata = reader.schema.metadata or {}
+    fingerprint = (source_path.encode(), str(st.st_size).encode(), str(st.st_mtime_ns).encode())
+    if tuple(metadata.get(k) for k in _source_metadata_keys) != fingerprint:
+        _logger.debug(f"Cache {cache_path} is stale")
+        return None
+    # buffers of the table point into the mapping, nothing is copied
+    return reader.read_all()
+
+
+def _write_cached_day(cache_path: str, source_path: str, headers: list[str]) -> None:
+    # stat before reading, a tidy file rewritten meanwhile then fails the fingerprint next time
+    st = os.stat(source_path)
+    df = csv_util.read_file_to_pandas(source_path, headers)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    table = table.replace_schema_metadata({
+        b"source_path": source_path.encode(),
+        b"source_size": str(st.st_size).encode(),
+        b"source_mtime_ns": str(st.st_mtime_ns).encode(),
+    })
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    # uncompressed, so readers can map the buffers as they are
+    with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp_path, cache_path)
+    _logger.info(f"Cached {source_path} to {cache_path}")
+
+
+def load_table(
+        syb_type: SymbolType,
+        symbol: str,
+        dataset: str,
+        start_date: str,
+        end_date: str,
+        interval: str | None = None,
+        *,
+        tidy_root_dir: str = config.tidy_binance_vision_dir,
+        cache_dir: str = config.arrow_cache_dir,
+    ) -> pa.Table:
+    """
+    Tidy klines or aggTrades of a date range as one Arrow table, read through a
+    cache of uncompressed Arrow IPC files.
+
+    Every tidy day file gets a cached copy under cache_dir on first use. Later
+    reads memory map the copy, so all processes reading the same days share the
+    page cache and nothing is parsed or copied. A copy is rebuilt as soon as the
+    size or mtime of its tidy file changes.
+
+    Args:
+        syb_type: Type of symbol
+        symbol: e.g. BTCUSDT
+        dataset: klines or aggTrades
+        start_date: First day, yyyy-mm-dd
+        end_date: Last day, yyyy-mm-dd, included
+        interval: Kline interval, e.g. 1m, only for klines
+
+    Returns:
+        The days concatenated in date order, one chunk per day
+
+    Raises:
+        ValueError: If dataset is unknown
+    """
+    headers = dataset_headers(dataset)
+    tidy_dir = dataset_dir(tidy_root_dir, syb_type, symbol, dataset, interval)
+    day_cache_dir = dataset_dir(cache_dir, syb_type, symbol, dataset, interval)
+    start_stem = day_stem(symbol, dataset, interval, start_date)
+    end_stem = day_stem(symbol, dataset, interval, end_date)
+
+    tables = []
+    for stem, name in sorted(catalog.file_names_by_stem(tidy_dir, csv_util.data_file_exts).items()):
+        if not start_stem <= stem <= end_stem:
+            continue
+        source_path = os.path.join(tidy_dir, name)
+        cache_path = os.path.join(day_cache_dir, stem + ".arrow")
+        table = _read_cached_day(cache_path, source_path)
+        if table is None:
+            _write_cached_day(cache_path, source_path, headers)
+            table = _read_cached_day(cache_path, source_path)
+        if table is not None and table.num_rows > 0:
+            tables.append(table)
+    if not tables:
+        return pa.table({h: pa.array([], type=pa.from_numpy_dtype(csv_util.headers_dtypes(headers).get(h, "int64"))) for h in headers})
+    return pa.concat_tables(tables, promote_options="default")
+
+
+def load_pandas(
+        syb_type: SymbolType,
+        symbol: str,
+        dataset: str,
+        start_date: str,
+        end_date: str,
+        interval: str | None = None,
+        **kwargs,
+    ) -> pd.DataFrame:
+    """
+    load_table as a DataFrame.
+
+    Converting to pandas copies the mapped columns once into the process, use
+    load_table to keep them shared.
+    """
+    return load_table(syb_type, symbol, dataset, start_date, end_date, interval, **kwargs).to_pandas()
+
+
+if __name__ == "__main__":
+    table = load_table(SymbolType.SPOT, "BTCUSDT", "klines", "2025-01-01", "2025-01-31", "1m")
+    print(table.num_rows, table.schema)
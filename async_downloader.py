@@ -0,0 +1,202 @@
+import asyncio
+import hashlib
+import logging
+import os
+from urllib.parse import urlparse
+
+import aiohttp
+
+import catalog
+import config
+import manifest
+import zipper
+
+_logger = logging.getLogger(__name__)
+_logger.setLevel(logging.DEBUG)
+
+# big archives can take minutes, so only connecting and single reads are bounded
+_timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+
+
+async def download_checksum(session: aiohttp.ClientSession, url: str) -> str | None:
+    async with session.get(url + ".CHECKSUM") as response:
+        if response.status == 404:
+            return None
+        response.raise_for_status()
+        return manifest.parse_checksum(await response.text())
+
+
+async def download_to_file(
+        session: aiohttp.ClientSession,
+        url: str,
+        save_path: str,
+        chunk_size: int = 1024 * 1024,
+        expected_sha256: str | None = None,
+    ) -> str:
+    """
+    Stream url into save_path through a pooled session.
+
+    Same contract as downloader.download_to_file: chunks go to save_path + ".part",
+    an existing part file is resumed with an HTTP Range request, the file is hashed
+    while it is written and the part file is renamed to save_path once it is complete.
+
+    Args:
+        session: Session whose connector holds the persistent connections
+        url: URL of the file to download
+        save_path: Final path of the downloaded file
+        chunk_size: Size of each chunk read from the response
+        expected_sha256: If given, the file must hash to it, and testzip is skipped
+
+    Returns:
+        The sha256 hex digest of the downloaded file
+
+    Raises:
+        aiohttp.ClientResponseError: If the server answers with an error status
+        Exception: If a zip file is invalid or the checksum does not match
+    """
+    part_path = save_path + ".part"
+    downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={downloaded}-"} if downloaded > 0 else {}
+    h = hashlib.sha256()
+    async with session.get(url, headers=headers) as response:
+        # 416 means the part file already holds every byte of the remote file
+        complete = downloaded > 0 and response.status == 416
+        if not complete:
+            response.raise_for_status()
+        # server ignored the Range header, so restart from byte zero
+        mode = 'ab' if complete or response.status == 206 else 'wb'
+        if mode == 'ab':
+            _logger.debug(f"Resuming {url} from byte {downloaded}")
+            # bytes already on disk are part of the file, hash them first
+            with open(part_path, 'rb') as f:
+                while data := f.read(chunk_size):
+                    h.update(data)
+        if not complete:
+            with open(part_path, mode) as f:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    h.update(chunk)
+                    f.write(chunk)
+    sha256 = h.hexdigest()
+    if expected_sha256 is not None:
+        if sha256 != expected_sha256:
+            os.remove(part_path)
+            _logger.error(f"Checksum mismatch: {url}")
+            raise Exception(f"Checksum mismatch: {url}")
+    elif url.endswith(".zip"):
+        # testzip is cpu bound, keep it off the event loop
+        if not await asyncio.to_thread(zipper.is_valid_zip_file, part_path):
+            os.remove(part_path)
+            _logger.error(f"Invalid zip file: {url}")
+            raise Exception(f"Invalid zip file: {url}")
+    os.replace(part_path, save_path)
+    return sha256
+
+
+async def download_save(
+        session: aiohttp.ClientSession,
+        url: str,
+        save_dir: str,
+        check_exists: bool = True,
+        verify: bool = False,
+    ) -> tuple[str, int, str] | None:
+    """
+    Same as downloader.download_save, over a pooled session.
+
+    Returns:
+        (file name, size, sha256) of a verified file, None otherwise
+    """
+    filename = urlparse(url).path.split('/')[-1]
+    save_path = os.path.join(save_dir, filename)
+    expected_sha256 = None
+    if check_exists and os.path.exists(save_path):
+        size = os.path.getsize(save_path)
+        # cleared zips were unzipped already, skip them before any request
+        if not verify or size == 0:
+            return None
+        expected_sha256 = await download_checksum(session, url)
+        if expected_sha256 is None:
+            return None
+        if await asyncio.to_thread(manifest.sha256_file, save_path) == expected_sha256:
+            return filename, size, expected_sha256
+        _logger.warning(f"Checksum mismatch for existing {save_path}, downloading again")
+    elif verify:
+        expected_sha256 = await download_checksum(session, url)
+    os.makedirs(save_dir, exist_ok=True)
+    await download_to_file(session, url, save_path, expected_sha256=expected_sha256)
+    catalog.record_file(save_path)
+    if expected_sha256 is None:
+        return None
+    return filename, os.path.getsize(save_path), expected_sha256
+
+
+async def _download_save_wrapper(
+        session: aiohttp.ClientSession,
+        semaphore: asyncio.Semaphore,
+        url: str,
+        save_dir: str,
+        check_exists: bool = True,
+        verify: bool = False,
+    ) -> tuple[str | None, tuple[str, int, str] | None]:
+    async with semaphore:
+        try:
+            _logger.debug(f"Downloading {url}")
+            entry = await download_save(session, url, save_dir, check_exists, verify)
+            _logger.debug(f"Downloaded {url}")
+            return None, entry
+        except Exception:
+            _logger.error(f"Failed to download {url}")
+            return url, None
+
+
+async def download_save_all(
+        urls: list[str],
+        save_dir: str,
+        check_exists: bool = True,
+        max_in_flight: int = config.max_in_flight_downloads,
+        verify: bool = False,
+    ) -> list[str]:
+    """
+    Download urls concurrently over one pool of keep-alive connections.
+
+    Args:
+        urls: URLs to download
+        save_dir: Directory to save the files in
+        check_exists: Skip files that already exist in save_dir
+        max_in_flight: Maximum number of concurrent requests, also the connection pool size
+        verify: Check files against their .CHECKSUM sidecars and record them in the manifest
+
+    Returns:
+        URLs that failed to download
+    """
+    if verify and check_exists:
+        # files in the manifest were verified by an earlier run, skip them without hashing
+        verified = manifest.load_manifest(save_dir)
+        urls = [url for url in urls if not manifest.is_verified(verified, os.path.join(save_dir, urlparse(url).path.split('/')[-1]))]
+    connector = aiohttp.TCPConnector(limit=max_in_flight, limit_per_host=max_in_flight)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    async with aiohttp.ClientSession(connector=connector, timeout=_timeout) as session:
+        results = await asyncio.gather(*[_download_save_wrapper(session, semaphore, url, save_dir, check_exists, verify) for url in urls])
+    manifest.append_manifest(save_dir, [entry for _, entry in results if entry])
+    return [url for url, _ in results if url]
+
+
+def download_save_until_success(
+        urls: list[str],
+        save_dir: str,
+        check_exists: bool = True,
+        max_in_flight: int = config.max_in_flight_downloads,
+        verify: bool = False,
+    ) -> None:
+    undownloaded_urls = urls
+    while undownloaded_urls:
+        undownloaded_urls = asyncio.run(download_save_all(undownloaded_urls, save_dir, check_exists, max_in_flight, verify))
+
+
+if __name__ == "__main__":
+    # Just for testing
+    urls = [
+        "https://data.binance.vision/data/spot/daily/klines/BTCUSDT/1m/BTCUSDT-1m-2023-11-19.zip",
+        "https://data.binance.vision/data/spot/daily/klines/BTCUSDT/1m/BTCUSDT-1m-2023-11-20.zip",
+        "https://data.binance.vision/data/spot/daily/klines/BTCUSDT/1m/BTCUSDT-1m-2023-11-21.zip",
+        ]
+    download_save_until_success(urls, config.data_binance_vision_dir + "/data/spot/daily/klines/BTCUSDT/1m/")
@@ -0,0 +1,351 @@
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+import numpy as np
+import pandas as pd
+
+import config
+
+_logger = logging.getLogger(__name__)
+
+# 每个文件一行，dir+name唯一；stage是根目录名的第一段，例如 tidy.binance.vision 的 tidy
+# syb_type, data_type, symbol, interval, date 从 prefix 和文件名里解析，解析不出来的为空
+# rows, first_id, last_id, first_time, last_time 由写文件的阶段填写，不知道的为空
+# id_checks缓存aggTrades文件的id检查结果，文件的size和mtime变了就作废
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    stage TEXT,
+    syb_type TEXT,
+    data_type TEXT,
+    symbol TEXT,
+    interval TEXT,
+    date TEXT,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    rows INTEGER,
+    first_id INTEGER,
+    last_id INTEGER,
+    first_time INTEGER,
+    last_time INTEGER,
+    PRIMARY KEY (dir, name)
+);
+CREATE INDEX IF NOT EXISTS files_symbol ON files (stage, syb_type, data_type, symbol, interval, date);
+CREATE TABLE IF NOT EXISTS dirs (
+    dir TEXT PRIMARY KEY,
+    -- mtime of the directory when it was scanned, NULL if it did not exist
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS id_checks (
+    dir TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    start_id INTEGER NOT NULL,
+    end_id INTEGER NOT NULL,
+    missing_id_ranges BLOB NOT NULL,
+    PRIMARY KEY (dir, name)
+);
+"""
+
+_date_pattern = re.compile(r"\d{4}-\d{2}(-\d{2})?$")
+_local = threading.local()
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
+    """
+    One connection per process, thread and database.
+
+    Pool workers are forked with the connections of the parent, so connections
+    are keyed by pid and a worker opens its own.
+    """
+    connections = getattr(_local, "connections", None)
+    if connections is None or _local.pid != os.getpid():
+        connections = _local.connections = {}
+        _local.pid = os.getpid()
+    conn = connections.get(db_path)
+    if conn is None:
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # writers of all processes wait on each other instead of failing
+        conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_schema)
+        # catalogs created before dirs kept their mtime, rows without one are scanned again
+        if "mtime_ns" not in [row[1] for row in conn.execute("PRAGMA table_info(dirs)")]:
+            conn.execute("ALTER TABLE dirs ADD COLUMN mtime_ns INTEGER")
+        connections[db_path] = conn
+    return conn
+
+
+def parse_path(file_path: str) -> dict:
+    """
+    Split a path of the data trees into catalog columns.
+
+    e.g. ~/tidy.binance.vision/data/futures/um/daily/klines/BTCUSDT/1m/BTCUSDT-1m-2025-01-01.parquet
+    is stage tidy, syb_type futures/um, data_type klines, symbol BTCUSDT, interval 1m, date 2025-01-01
+    """
+    parts = os.path.normpath(file_path).split(os.sep)
+    info = {"stage": None, "syb_type": None, "data_type": None, "symbol": None, "interval": None, "date": None}
+    root_indexes = [i for i, part in enumerate(parts[:-1]) if part.endswith(".binance.vision")]
+    if root_indexes:
+        root_index = root_indexes[-1]
+        info["stage"] = parts[root_index].split(".")[0]
+        prefix = parts[root_index + 1:-1]
+        for period in ("daily", "monthly"):
+            if period in prefix:
+                i = prefix.index(period)
+                info["syb_type"] = "/".join(prefix[1:i])
+                rest = prefix[i + 1:]
+                info["data_type"] = rest[0] if len(rest) > 0 else None
+                info["symbol"] = rest[1] if len(rest) > 1 else None
+                info["interval"] = rest[2] if len(rest) > 2 else None
+                break
+    stem = parts[-1].split(".")[0]
+    date = _date_pattern.search(stem)
+    if date is not None:
+        info["date"] = date.group(0)
+    return info
+
+
+def frame_stats(df: pd.DataFrame, id_column: str | None, time_column: str) -> dict:
+    """
+    Row count, id range and time range of a sorted data frame, as keyword
+    arguments of record_file.
+    """
+    stats = {"rows": len(df)}
+    if len(df) == 0:
+        return stats
+    if id_column is not None:
+        stats["first_id"] = int(df[id_column].iloc[0])
+        stats["last_id"] = int(df[id_column].iloc[-1])
+    stats["first_time"] = int(df[time_column].iloc[0])
+    stats["last_time"] = int(df[time_column].iloc[-1])
+    return stats
+
+
+def record_file(
+        file_path: str,
+        *,
+        rows: int | None = None,
+        first_id: int | None = None,
+        last_id: int | None = None,
+        first_time: int | None = None,
+        last_time: int | None = None,
+        db_path: str = config.catalog_path,
+    ) -> None:
+    """
+    Record a file a stage has just written, or truncated.
+
+    Called by every writer of the data trees, so later stages can list their
+    input from the catalog. Statistics not given are left empty, the size and
+    mtime are always taken from the file.
+    """
+    if not config.use_catalog:
+        return
+    st = os.stat(file_path)
+    dir_path, name = os.path.split(os.path.abspath(file_path))
+    info = parse_path(file_path)
+    _connect(db_path).execute(
+        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (dir_path, name, info["stage"], info["syb_type"], info["data_type"], info["symbol"], info["interval"], info["date"],
+         st.st_size, st.st_mtime_ns, rows, first_id, last_id, first_time, last_time),
+    )
+
+
+def record_frame(file_path: str, df: pd.DataFrame, id_column: str | None, time_column: str, db_path: str = config.catalog_path) -> None:
+    """record_file with the statistics of the frame that was written to file_path."""
+    if not config.use_catalog:
+        return
+    record_file(file_path, db_path=db_path, **frame_stats(df, id_column, time_column))
+
+
+def _dir_mtime_ns(dir_path: str) -> int | None:
+    try:
+        return os.stat(dir_path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def scan_dir(dir_path: str, db_path: str = config.catalog_path, full: bool = False) -> None:
+    """
+    Sync the catalog of dir_path with the disk.
+
+    Names new to the catalog are stat'ed and added, names that are gone are
+    dropped. Known files keep their row as recorded by record_file, so a daily
+    run adding a few files to a long history only stats those few. With full,
+    every file is stat'ed and rows whose size or mtime changed lose their
+    statistics, for files rewritten by hand. Afterwards the catalog answers for
+    dir_path on its own until the mtime of the directory changes.
+    """
+    dir_path = os.path.abspath(dir_path)
+    # taken before listing, so files added during the scan change it and trigger the next one
+    dir_mtime_ns = _dir_mtime_ns(dir_path)
+    names = []
+    if os.path.isdir(dir_path):
+        with os.scandir(dir_path) as it:
+            # the file type comes from the directory entry, no stat is needed
+            names = [entry.name for entry in it if entry.is_file()]
+    conn = _connect(db_path)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        known = {name: (size, mtime_ns) for name, size, mtime_ns in conn.execute("SELECT name, size, mtime_ns FROM files WHERE dir = ?", (dir_path,))}
+        conn.executemany("DELETE FROM files WHERE dir = ? AND name = ?", [(dir_path, name) for name in known.keys() - set(names)])
+        rows = []
+        for name in names:
+            if name in known and not full:
+                continue
+            file_path = os.path.join(dir_path, name)
+            try:
+                st = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            fingerprint = (st.st_size, st.st_mtime_ns)
+            if known.get(name) == fingerprint:
+                continue
+            info = parse_path(file_path)
+            rows.append((dir_path, name, info["stage"], info["syb_type"], info["data_type"], info["symbol"], info["interval"], info["date"],
+                         *fingerprint, None, None, None, None, None))
+        conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO dirs VALUES (?, ?)", (dir_path, dir_mtime_ns))
+    _logger.debug(f"Scanned {dir_path}: {len(names)} files, {len(rows)} new or changed")
+
+
+def list_file_names(dir_path: str, exts: tuple[str, ...] | None = None, db_path: str = config.catalog_path) -> list[str]:
+    """
+    Sorted names of the files in dir_path, like a sorted os.listdir.
+
+    Directories are scanned when the catalog has never seen them or when their
+    mtime changed since the last scan, e.g. a file was added or removed without
+    a record_* call. Otherwise the answer comes from the catalog alone, for the
+    cost of one stat of the directory.
+
+    Args:
+        dir_path: Directory to list
+        exts: Only names with one of these extensions, e.g. csv_util.data_file_exts
+    """
+    if not config.use_catalog:
+        names = sorted(os.listdir(dir_path)) if os.path.isdir(dir_path) else []
+    else:
+        dir_path = os.path.abspath(dir_path)
+        conn = _connect(db_path)
+        row = conn.execute("SELECT mtime_ns FROM dirs WHERE dir = ?", (dir_path,)).fetchone()
+        if row is None or row[0] != _dir_mtime_ns(dir_path):
+            scan_dir(dir_path, db_path)
+        names = [name for name, in conn.execute("SELECT name FROM files WHERE dir = ? ORDER BY name", (dir_path,))]
+    if exts is not None:
+        names = [name for name in names if os.path.splitext(name)[1] in exts]
+    return names
+
+
+def file_names_by_stem(dir_path: str, exts: tuple[str, ...], db_path: str = config.catalog_path) -> dict[str, str]:
+    """
+    File names of dir_path by stem, a day stored in several formats maps to the
+    first one in exts, like csv_util.find_data_file.
+    """
+    names: dict[str, str] = {}
+    for name in list_file_names(dir_path, exts, db_path):
+        stem, ext = os.path.splitext(name)
+        if stem not in names or exts.index(ext) < exts.index(os.path.splitext(names[stem])[1]):
+            names[stem] = name
+    return names
+
+
+def last_file_name(dir_path: str, exts: tuple[str, ...] | None = None, db_path: str = config.catalog_path) -> str:
+    """Greatest file name in dir_path, empty if there is none."""
+    names = list_file_names(dir_path, exts, db_path)
+    return names[-1] if names else ""
+
+
+def get_file(file_path: str, db_path: str = config.catalog_path) -> dict | None:
+    """The catalog row of file_path as a dict, None if it is not recorded."""
+    dir_path, name = os.path.split(os.path.abspath(file_path))
+    cursor = _connect(db_path).execute("SELECT * FROM files WHERE dir = ? AND name = ?", (dir_path, name))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([d[0] for d in cursor.description], row))
+
+
+def load_id_checks(file_paths: list[str], db_path: str = config.catalog_path) -> dict[str, tuple[int, int, np.ndarray]]:
+    """
+    Cached agg_trades_checker.check_one_file_consistency results of file_paths.
+
+    A result only counts while the size and mtime it was computed for still match
+    the file on disk, so new and rewritten files are missing from the returned
+    dict and have to be checked again, even when they were changed by hand.
+
+    Returns:
+        Dict from file path to (start_id, end_id, missing_id_ranges)
+    """
+    if not config.use_catalog:
+        return {}
+    conn = _connect(db_path)
+    paths_by_dir: dict[str, dict[str, str]] = {}
+    for file_path in file_paths:
+        dir_path, name = os.path.split(os.path.abspath(file_path))
+        paths_by_dir.setdefault(dir_path, {})[name] = file_path
+    checks = {}
+    for dir_path, paths in paths_by_dir.items():
+        rows = conn.execute("SELECT name, size, mtime_ns, start_id, end_id, missing_id_ranges FROM id_checks WHERE dir = ?", (dir_path,))
+        for name, size, mtime_ns, start_id, end_id, blob in rows:
+            if name not in paths:
+                continue
+            # a stat is cheap next to reading the file again, the files row may be stale
+            try:
+                st = os.stat(paths[name])
+            except FileNotFoundError:
+                continue
+            if (st.st_size, st.st_mtime_ns) == (size, mtime_ns):
+                checks[paths[name]] = (start_id, end_id, np.frombuffer(blob, dtype="<i8").reshape(-1, 2).copy())
+    return checks
+
+
+def save_id_checks(checks: list[tuple[str, int, int, int, int, np.ndarray]], db_path: str = config.catalog_path) -> None:
+    """
+    Cache check results as (file path, size, mtime_ns, start_id, end_id, missing_id_ranges),
+    with the size and mtime of the file as it was read.
+    """
+    if not config.use_catalog or not checks:
+        return
+    rows = []
+    for file_path, size, mtime_ns, start_id, end_id, missing_id_ranges in checks:
+        dir_path, name = os.path.split(os.path.abspath(file_path))
+        rows.append((dir_path, name, size, mtime_ns, int(start_id), int(end_id), np.ascontiguousarray(missing_id_ranges, dtype="<i8").tobytes()))
+    conn = _connect(db_path)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.executemany("INSERT OR REPLACE INTO id_checks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+
+def rescan(root_dirs: list[str], db_path: str = config.catalog_path) -> None:
+    """Scan every directory under root_dirs again, after files were changed by hand."""
+    for root_dir in root_dirs:
+        for dir_path, _, _ in os.walk(root_dir):
+            scan_dir(dir_path, db_path, full=True)
+    # directories that are gone
+    conn = _connect(db_path)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for dir_path, in conn.execute("SELECT dir FROM dirs").fetchall():
+            if not os.path.isdir(dir_path):
+                conn.execute("DELETE FROM files WHERE dir = ?", (dir_path,))
+                conn.execute("DELETE FROM id_checks WHERE dir = ?", (dir_path,))
+                conn.execute("DELETE FROM dirs WHERE dir = ?", (dir_path,))
+
+
+if __name__ == "__main__":
+    rescan([
+        config.data_binance_vision_dir,
+        config.unzip_binance_vision_dir,
+        config.missing_binance_vision_dir,
+        config.tidy_binance_vision_dir,
+        config.diy_binance_vision_dir,
+    ])
+    conn = _connect(config.catalog_path)
+    for stage, count, size in conn.execute("SELECT stage, COUNT(*), SUM(size) FROM files GROUP BY stage"):
+        print(f"{stage}: {count} files, {size} bytes")
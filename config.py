@@ -14,6 +14,7 @@ logger = logging.getLogger(__name__)
 # 如果work_dir为空，则存储在代码根目录
 # 如果work_dir为～，则存储在用户目录
 # 除此之外，work_dir为绝对路径
+# 也可以用环境变量BINANCE_WORK_DIR覆盖，fake_binance.py会给出一个临时目录，合成数据不会混进真实数据
 
 # 一个文件的完整路径为 根目录+prefix+filename
 # 例如：https://data.binance.vision/data/spot/daily/aggTrades/BTCUSDT/BTCUSDT-aggTrades-2024-11-19.zip
@@ -27,7 +28,7 @@ logger = logging.getLogger(__name__)
 # 这样做，可以保持文件的层次结构一样，便于管理
 
 
-work_dir = "~"
+work_dir = os.environ.get("BINANCE_WORK_DIR", "~")
 
 if work_dir == "~":
     work_dir = os.path.expanduser("~")
@@ -43,6 +44,23 @@ unzip_binance_vision_dir = os.path.join(work_dir, "unzip.binance.vision")
 missing_binance_vision_dir = os.path.join(work_dir, "missing.binance.vision")
 tidy_binance_vision_dir = os.path.join(work_dir, "tidy.binance.vision")
 diy_binance_vision_dir = os.path.join(work_dir, "diy.binance.vision")
+# tidy.binance.vision中aggTrades的存储格式，csv、parquet 或 agz
+# parquet按 symbol/日期 分文件，带类型并且压缩
+# agz是aggTrades专用的紧凑格式：id和时间存差分，价格和数量存成定点整数，再用zstd压缩，解码只用numpy向量运算
+tidy_agg_trades_format = "csv"
+# cache.binance.vision缓存常用的tidy数据，格式为不压缩的Arrow IPC，目录层次和tidy一样
+# 读取时用内存映射，多个进程共享同一份页缓存；tidy文件改动后对应的缓存自动重建
+arrow_cache_dir = os.path.join(work_dir, "cache.binance.vision")
+# 流式读取大文件时每块的行数，块越小内存越省，块太小会变慢
+stream_chunk_rows = 1_000_000
+# listing.binance.vision缓存S3的文件列表，按列表地址的hash分开，下面的目录层次和prefix一样
+listing_cache_dir = os.path.join(work_dir, "listing.binance.vision")
+# catalog.binance.vision下的sqlite数据库记录每个阶段写出的每个文件：大小、行数、id和时间范围
+# 各阶段通过它查询需要处理的文件，不再反复扫描目录
+# 手动增删文件会从目录的mtime发现，只stat新文件；原地改写了文件内容时运行 python catalog.py 全量重新扫描
+# aggTrades的id检查结果也缓存在这里，只有新增或改动过的文件才会重新读取
+use_catalog = True
+catalog_path = os.path.join(work_dir, "catalog.binance.vision", "catalog.sqlite3")
 
 
 # 需要多核下载
@@ -53,3 +71,38 @@ if os.cpu_count() > 1:
     max_workers = os.cpu_count() * 5 // 10
 
 logger.debug(f"Max workers: {max_workers}")
+
+# query.py按日期范围读取tidy数据时并行读取的线程数，读取和解码大多释放GIL
+max_query_threads = os.cpu_count() or 1
+
+# 异步下载时同时进行的请求数，也是连接池的大小
+# 下载是网络IO，不受CPU核数限制，所以和max_workers分开配置
+max_in_flight_downloads = 32
+
+# 用REST接口补缺失数据时的权重预算，所有进程共享，按市场分开计算
+# binance按IP每分钟计算权重，上限：现货6000，U本位和币本位合约各2400
+rest_weight_limits = {"spot": 6000, "futures/um": 2400, "futures/cm": 2400}
+# 只使用上限的一部分，给同一IP上的其他程序留余量
+rest_weight_ratio = 0.8
+# 多进程共享的权重记录文件所在目录，每个市场每个REST地址一个文件
+rate_limit_dir = os.path.join(work_dir, "rate_limit.binance.vision")
+# 补数据时同时进行的REST请求数，实际速度由权重预算控制
+max_in_flight_rest_requests = 8
+# 补一段很长的缺失aggTrades时，按id切成多少个一段并行下载，每段每次请求1000个
+agg_trades_shard_size = 10000
+
+# 数据源地址，默认是binance的正式地址
+# 可以用环境变量覆盖，例如指向fake_binance.py启动的本地服务，用来离线测试和测速
+vision_listing_url = os.environ.get("BINANCE_VISION_LISTING_URL", "https://s3-ap-northeast-1.amazonaws.com/data.binance.vision")
+vision_data_url = os.environ.get("BINANCE_VISION_DATA_URL", "https://data.binance.vision")
+# REST接口地址，按市场区分
+rest_base_urls = {
+    "spot": os.environ.get("BINANCE_SPOT_REST_URL", "https://api.binance.com"),
+    "futures/um": os.environ.get("BINANCE_UM_REST_URL", "https://fapi.binance.com"),
+    "futures/cm": os.environ.get("BINANCE_CM_REST_URL", "https://dapi.binance.com"),
+}
+# 数据源不是binance正式地址时必须同时覆盖work_dir，否则下载的文件、catalog和各种缓存都会写进真实的工作目录，
+# 之后真实下载会因为文件已存在而跳过这些日期
+_url_env_names = ["BINANCE_VISION_LISTING_URL", "BINANCE_VISION_DATA_URL", "BINANCE_SPOT_REST_URL", "BINANCE_UM_REST_URL", "BINANCE_CM_REST_URL"]
+if "BINANCE_WORK_DIR" not in os.environ and any(name in os.environ for name in _url_env_names):
+    raise ValueError("BINANCE_WORK_DIR must be set when the Binance urls are overridden")
@@ -1,9 +1,15 @@
-import csv
+import io
 import logging
+import os
+from typing import Iterator
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from typing import TextIO
 
+import agz
 import config
 
 _logger = logging.getLogger(__name__)
@@ -12,6 +18,61 @@ klines_headers = ["openTime", "openPrice", "highPrice", "lowPrice", "closePrice"
 agg_trades_headers = ["id", "price", "qty", "firstTradeId", "lastTradeId", "time", "isBuyerMaker", "isBestMatch"]
 agg_trades_api_data_headers = ["a", "p", "q", "f", "l", "T", "m", "M"]
 
+klines_dtypes = {
+    "openTime": "int64",
+    "openPrice": "float64",
+    "highPrice": "float64",
+    "lowPrice": "float64",
+    "closePrice": "float64",
+    "volume": "float64",
+    "closeTime": "int64",
+    "quoteAssetVolume": "float64",
+    "tradesNumber": "int64",
+    "takerBuyBaseAssetVolume": "float64",
+    "takerBuyQuoteAssetVolume": "float64",
+}
+agg_trades_dtypes = {
+    "id": "int64",
+    "price": "float64",
+    "qty": "float64",
+    "firstTradeId": "int64",
+    "lastTradeId": "int64",
+    "time": "int64",
+    "isBuyerMaker": "bool",
+    "isBestMatch": "bool",
+}
+
+
+# about the size of an aggTrades csv row, turns a number of rows into a block size
+_csv_row_bytes = 64
+
+# raw and tidy data files can be stored as csv or parquet, tidy aggTrades also as agz,
+# files of one day share the same stem
+data_file_exts = (".csv", ".parquet", ".agz")
+
+
+def find_data_file(dir_path: str, stem: str) -> str | None:
+    """Return the path of the data file named stem in dir_path, whatever its format."""
+    for ext in data_file_exts:
+        path = os.path.join(dir_path, stem + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def headers_dtypes(headers: list[str]) -> dict[str, str]:
+    """Column types of the known klines and aggTrades headers, unknown headers are left out."""
+    dtypes = {**klines_dtypes, **agg_trades_dtypes}
+    return {h: dtypes[h] for h in headers if h in dtypes}
+
+
+def is_header_line(first_bytes: bytes) -> bool:
+    """
+    Binance Vision rows always start with a number, so a first byte that is not
+    a digit means the file starts with a header row.
+    """
+    return len(first_bytes) > 0 and not first_bytes[:1].isdigit()
+
 def has_header(file: TextIO) -> bool:
     """
     Check if a CSV file has a header row.
@@ -23,20 +84,18 @@ def has_header(file: TextIO) -> bool:
         True if the file appears to have a header row, False otherwise
         
     Note:
-        This uses csv.Sniffer to detect if the first row appears to be headers.
+        Binance Vision rows always start with a number, so only the first
+        character is read, see is_header_line.
         The file pointer will be reset to the start after checking.
     """
     try:
         # Save original position
         original_pos = file.tell()
         
-        # Read sample of file
-        sample = file.read(10000)
+        first_char = file.read(1)
         file.seek(original_pos)
         
-        # Use csv sniffer to detect header
-        has_header = csv.Sniffer().has_header(sample)
-        return has_header
+        return is_header_line(first_char.encode())
         
     except Exception as e:
         _logger.error(f"Error checking if CSV file has header: {e}")
@@ -52,22 +111,183 @@ def get_last_row_ignore_header(filename: str) -> str:
     return last_row
     
 
-def csv_to_pandas(file: TextIO, headers: list[str]) -> pd.DataFrame:
+def csv_to_pandas(file: TextIO, headers: list[str], usecols: list[str] | None = None) -> pd.DataFrame:
+    """
+    Read a klines or aggTrades CSV file into a typed DataFrame.
+
+    The file is parsed by the multithreaded pyarrow csv reader with the column types
+    of csv_util.klines_dtypes and csv_util.agg_trades_dtypes, so ids and timestamps
+    are int64, prices and quantities float64 and flags bool.
+
+    Args:
+        file: A text file object opened in read mode
+        headers: Column names, files with fewer columns get the leading names
+        usecols: Only read these columns
+
+    Returns:
+        DataFrame with the requested columns
+    """
     # Check if file is empty
     file.seek(0, 2)  # Go to end of file
     if file.tell() == 0:  # Check if file size is 0
         file.seek(0)  # Reset position
-        return pd.DataFrame(columns=headers)
+        return pd.DataFrame(columns=headers if usecols is None else usecols)
     file.seek(0)  # Reset position for subsequent reads
     has_h = has_header(file)
-    frame = None
-    if has_h:
-        frame = pd.read_csv(file)
+    # futures aggTrades files have no isBestMatch column
+    column_count = file.readline().count(",") + 1
+    file.seek(0)
+    names = headers.copy()[:column_count]
+    source = file.buffer if hasattr(file, "buffer") else io.BytesIO(file.read().encode())
+    table = pa_csv.read_csv(
+        source,
+        read_options=pa_csv.ReadOptions(column_names=names, skip_rows=1 if has_h else 0),
+        convert_options=pa_csv.ConvertOptions(column_types=headers_dtypes(names), include_columns=usecols),
+    )
+    return table.to_pandas()
+
+
+def read_file_to_pandas(file_path: str, headers: list[str], usecols: list[str] | None = None) -> pd.DataFrame:
+    """
+    Read a csv, parquet or agz data file into a DataFrame.
+
+    Empty files are read as empty frames, raw files are truncated to zero bytes
+    once they have been merged.
+    """
+    if os.path.getsize(file_path) == 0:
+        return pd.DataFrame(columns=headers if usecols is None else usecols)
+    if file_path.endswith(".parquet"):
+        return pd.read_parquet(file_path, engine="pyarrow", columns=usecols)
+    if file_path.endswith(".agz"):
+        return agz.read_agg_trades(file_path, usecols)
+    with open(file_path, "r") as f:
+        return csv_to_pandas(f, headers, usecols)
+
+
+
+def iter_file_batches(file_path: str, headers: list[str], usecols: list[str], chunk_rows: int = config.stream_chunk_rows) -> Iterator[pa.RecordBatch]:
+    """
+    Read a csv, parquet or agz data file as record batches of about chunk_rows rows,
+    with only the columns of usecols, so memory does not grow with the file.
+    """
+    if os.path.getsize(file_path) == 0:
+        return
+    if file_path.endswith(".parquet"):
+        yield from pq.ParquetFile(file_path).iter_batches(batch_size=chunk_rows, columns=usecols)
+        return
+    if file_path.endswith(".agz"):
+        # agz is decoded a block at a time, blocks were written with stream_chunk_rows rows
+        for block in agz.iter_agg_trades_blocks(file_path, usecols):
+            yield pa.record_batch([block[c] for c in usecols], names=usecols)
+        return
+    with open(file_path, "rb") as f:
+        first_line = f.readline()
+        # futures aggTrades files have no isBestMatch column
+        names = headers[:first_line.count(b",") + 1]
+        read_options = pa_csv.ReadOptions(column_names=names)
+        convert_options = pa_csv.ConvertOptions(column_types=headers_dtypes(names), include_columns=usecols)
+        if not is_header_line(first_line):
+            f.seek(0)
+        # blocks are cut at the last newline and parsed one at a time, pyarrow's own
+        # streaming reader reads ahead and can hold most of a big file
+        block_size = chunk_rows * _csv_row_bytes
+        rest = b""
+        while block := f.read(block_size):
+            block = rest + block
+            cut = block.rfind(b"\n") + 1
+            rest = block[cut:]
+            if cut > 0:
+                yield from pa_csv.read_csv(io.BytesIO(block[:cut]), read_options=read_options, convert_options=convert_options).to_batches()
+        if rest.strip():
+            yield from pa_csv.read_csv(io.BytesIO(rest), read_options=read_options, convert_options=convert_options).to_batches()
+
+
+def write_pandas_to_file(df: pd.DataFrame, file_path: str) -> None:
+    """Write a DataFrame as csv, zstd compressed parquet or agz, chosen by the file extension."""
+    if file_path.endswith(".parquet"):
+        df.to_parquet(file_path, engine="pyarrow", index=False, compression="zstd")
+    elif file_path.endswith(".agz"):
+        agz.write_agg_trades(df, file_path)
     else:
-        frame = pd.read_csv(file, header=None)
-    row_count = len(frame.columns)
-    frame.columns = headers.copy()[:row_count]
-    return frame
+        df.to_csv(file_path, index=False)
+
+
+def get_last_value(file_path: str, headers: list[str], column: str) -> str:
+    """
+    Get the value of column in the last row of a csv, parquet or agz data file,
+    without reading the whole file.
+    """
+    if file_path.endswith(".parquet"):
+        pf = pq.ParquetFile(file_path)
+        values = pf.read_row_group(pf.num_row_groups - 1, columns=[column]).column(column)
+        return str(values[-1].as_py())
+    if file_path.endswith(".agz"):
+        blocks = agz.read_footer(file_path)["blocks"]
+        return str(blocks[-1]["stats"][column][1])
+    return get_last_row_ignore_header(file_path).split(",")[headers.index(column)]
+
+
+def count_csv_rows(file_path: str, chunk_size: int = 16 * 1024 * 1024) -> int:
+    """Number of data rows of a csv file, counted from its newlines without parsing."""
+    lines = 0
+    last_byte = b"\n"
+    first_bytes = b""
+    with open(file_path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            if not first_bytes:
+                first_bytes = chunk[:1]
+            lines += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+    if last_byte != b"\n":
+        lines += 1
+    return lines - (1 if is_header_line(first_bytes) else 0)
+
+
+def get_int_column_bounds(file_path: str, headers: list[str], column: str) -> tuple[int, int, int]:
+    """
+    First value, last value and row count of an int column of a csv, parquet or
+    agz data file, without parsing the rows.
+
+    Parquet answers from its footer, the column statistics of the first and last
+    row groups, agz from the block stats of its footer, csv from its first and
+    last lines and a newline count.
+
+    Returns:
+        (first value, last value, rows), (0, 0, 0) for an empty file
+    """
+    if os.path.getsize(file_path) == 0:
+        return 0, 0, 0
+    if file_path.endswith(".parquet"):
+        pf = pq.ParquetFile(file_path)
+        rows = pf.metadata.num_rows
+        if rows == 0:
+            return 0, 0, 0
+        index = pf.schema_arrow.get_field_index(column)
+        first_groups = [i for i in range(pf.num_row_groups) if pf.metadata.row_group(i).num_rows > 0]
+        first_stats = pf.metadata.row_group(first_groups[0]).column(index).statistics
+        last_stats = pf.metadata.row_group(first_groups[-1]).column(index).statistics
+        if first_stats is not None and first_stats.has_min_max and last_stats is not None and last_stats.has_min_max:
+            # the column is sorted, so the bounds of the outer row groups are the first and last values
+            return int(first_stats.min), int(last_stats.max), rows
+        first = pf.read_row_group(first_groups[0], columns=[column]).column(column)[0].as_py()
+        last = pf.read_row_group(first_groups[-1], columns=[column]).column(column)[-1].as_py()
+        return int(first), int(last), rows
+    if file_path.endswith(".agz"):
+        # the footer keeps the first and last value of every column of every block
+        blocks = agz.read_footer(file_path)["blocks"]
+        if not blocks:
+            return 0, 0, 0
+        return int(blocks[0]["stats"][column][0]), int(blocks[-1]["stats"][column][1]), sum(b["rows"] for b in blocks)
+    index = headers.index(column)
+    with open(file_path, "r") as f:
+        first_line = f.readline()
+        if is_header_line(first_line.encode()):
+            first_line = f.readline()
+    if first_line.strip() == "":
+        return 0, 0, 0
+    first = int(first_line.split(",")[index])
+    last = int(get_last_row_ignore_header(file_path).split(",")[index])
+    return first, last, count_csv_rows(file_path)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,16 @@
+from collections import deque
 import csv
+from dataclasses import dataclass
 import datetime
-import itertools
 import logging
 from multiprocessing import Pool
 import os
 
+import numpy as np
 import pandas as pd
 from enums import SymbolType
 
+import catalog
 import config
 import csv_util
 
@@ -18,20 +21,99 @@ _decimal_places = 10
 
 micro_20000101 = 946684800000000
 
-def merge_one_file_agg_trades_to_klines(
+def _aggregate_klines(
+        bucket: np.ndarray,
+        open_price: np.ndarray,
+        high_price: np.ndarray,
+        low_price: np.ndarray,
+        close_price: np.ndarray,
+        volume: np.ndarray,
+        quote_asset_volume: np.ndarray,
+        trades_number: np.ndarray,
+        taker_buy_base_asset_volume: np.ndarray,
+        taker_buy_quote_asset_volume: np.ndarray,
+        kline_num: int,
+        ) -> dict[str, np.ndarray]:
+    """
+    Aggregate rows sorted by bucket into kline_num klines.
+
+    Rows can be trades (all prices equal, trades_number 1) or finer klines.
+    Sums use np.bincount, which adds the rows of a bucket one by one in order,
+    so the results equal a python loop doing += row by row.
+
+    Returns:
+        Dict of kline columns with kline_num rows, empty buckets have zero
+        trades_number and nan prices
+    """
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], len(bucket)] - 1
+    idx = bucket[starts]
+
+    def _prices(values: np.ndarray) -> np.ndarray:
+        out = np.full(kline_num, np.nan)
+        out[idx] = values
+        return out
+
+    return {
+        "openPrice": _prices(open_price[starts]),
+        "highPrice": _prices(np.maximum.reduceat(high_price, starts)),
+        "lowPrice": _prices(np.minimum.reduceat(low_price, starts)),
+        "closePrice": _prices(close_price[ends]),
+        "volume": np.bincount(bucket, weights=volume, minlength=kline_num),
+        "quoteAssetVolume": np.bincount(bucket, weights=quote_asset_volume, minlength=kline_num),
+        "tradesNumber": np.bincount(bucket, weights=trades_number, minlength=kline_num).astype(np.int64),
+        "takerBuyBaseAssetVolume": np.bincount(bucket, weights=taker_buy_base_asset_volume, minlength=kline_num),
+        "takerBuyQuoteAssetVolume": np.bincount(bucket, weights=taker_buy_quote_asset_volume, minlength=kline_num),
+    }
+
+
+def _fill_empty_klines(columns: dict[str, np.ndarray], start_ms: int, interval_ms: int, last_close_price: float) -> pd.DataFrame:
+    """
+    Turn aggregated kline columns into a kline DataFrame, empty klines take the
+    close price of the last real kline, or last_close_price before the first one.
+    """
+    kline_num = len(columns["volume"])
+    has_trades = columns["tradesNumber"] > 0
+    # index of the last real kline at or before each kline, -1 before the first one
+    last_real = np.maximum.accumulate(np.where(has_trades, np.arange(kline_num), -1))
+    fill_price = np.where(last_real >= 0, columns["closePrice"][np.maximum(last_real, 0)], last_close_price)
+
+    open_time = start_ms + interval_ms * np.arange(kline_num, dtype=np.int64)
+    frame = {
+        "openTime": open_time,
+        "openPrice": np.where(has_trades, columns["openPrice"], fill_price),
+        "highPrice": np.where(has_trades, columns["highPrice"], fill_price),
+        "lowPrice": np.where(has_trades, columns["lowPrice"], fill_price),
+        "closePrice": np.where(has_trades, columns["closePrice"], fill_price),
+        "volume": columns["volume"],
+        "closeTime": open_time + interval_ms - 1,
+        "quoteAssetVolume": columns["quoteAssetVolume"],
+        "tradesNumber": columns["tradesNumber"],
+        "takerBuyBaseAssetVolume": columns["takerBuyBaseAssetVolume"],
+        "takerBuyQuoteAssetVolume": columns["takerBuyQuoteAssetVolume"],
+        "unused": np.zeros(kline_num, dtype=np.int64),
+    }
+    return pd.DataFrame(frame, columns=csv_util.klines_headers)
+
+
+def _read_agg_trades_to_kline_columns(
         interval_seconds: int,
         agg_trade_file_path: str,
-        last_kline_before_today: dict | None = None,
-        ) -> list[dict]:
+        ) -> tuple[dict[str, np.ndarray], int] | None:
+    """
+    Read one day of agg trades and aggregate them into klines of interval_seconds.
 
+    Returns:
+        (kline columns as returned by _aggregate_klines, open time of the first kline),
+        None if the file has no trades
+    """
     df = None
 
     # Read agg trades file into pandas DataFrame
-    with open(agg_trade_file_path, "r") as f:
-        df = csv_util.csv_to_pandas(f, csv_util.agg_trades_headers)
+    df = csv_util.read_file_to_pandas(agg_trade_file_path, csv_util.agg_trades_headers)
     
     if df is None or df.empty:
-        return []
+        return None
     
     first_time = int(df.at[0, "time"])
     
@@ -50,95 +132,276 @@ def merge_one_file_agg_trades_to_klines(
     start_ms = first_time//one_day_ms*one_day_ms
     
     kline_num = one_day_ms // interval_ms
-    # no use, just for safety
-    if one_day_ms % interval_ms != 0:
-        kline_num += 1
-        
-    klines: list[dict] = list(itertools.islice(itertools.repeat(None), kline_num))
-    
-    kline: dict = {
-        "openTime": 0,
-    }
     
     _logger.debug(f"file: {agg_trade_file_path}, df.shape: {df.shape}, kline_num: {kline_num}, start: {datetime.datetime.fromtimestamp(start_ms//1000, tz=datetime.timezone.utc)}, interval_ms: {interval_ms}")
     
-    for row in df.itertuples():
-        time_ms = row.time // ts_adjust_ratio
-        open_time_ms = (time_ms - start_ms) // interval_ms * interval_ms + start_ms
-        quote_asset_volume = row.price * row.qty
-        if open_time_ms != kline["openTime"]:
-            kline = {}
-            kline["openTime"] = open_time_ms
-            kline["openPrice"] = row.price
-            kline["highPrice"] = row.price
-            kline["lowPrice"] = row.price
-            kline["closePrice"] = row.price
-            kline["volume"] = 0.0
-            kline["closeTime"] = open_time_ms + interval_ms - 1
-            kline["quoteAssetVolume"] = 0.0
-            kline["tradesNumber"] = 0
-            kline["takerBuyBaseAssetVolume"] = 0.0
-            kline["takerBuyQuoteAssetVolume"] = 0.0
-            kline["unused"] = 0
-            i = (open_time_ms - start_ms) // interval_ms
-            klines[i] = kline
-        
-        if row.price > kline["highPrice"]:
-            kline["highPrice"] = row.price
-        if row.price < kline["lowPrice"]:
-            kline["lowPrice"] = row.price
-        kline["closePrice"] = row.price
-        kline["volume"] += row.qty
-        kline["quoteAssetVolume"] += quote_asset_volume
-        kline["tradesNumber"] += 1
-        if not row.isBuyerMaker:
-            kline["takerBuyBaseAssetVolume"] += row.qty
-            kline["takerBuyQuoteAssetVolume"] += quote_asset_volume
-    
-    # for k in klines:
-    #     if k is None:
-    #         continue
-    #     k["volume"] = round(k["volume"], _decimal_places)
-    #     k["quoteAssetVolume"] = round(k["quoteAssetVolume"], _decimal_places)
-    #     k["takerBuyBaseAssetVolume"] = round(k["takerBuyBaseAssetVolume"], _decimal_places)
-    #     k["takerBuyQuoteAssetVolume"] = round(k["takerBuyQuoteAssetVolume"], _decimal_places)
+    time_ms = df["time"].to_numpy(dtype=np.int64) // ts_adjust_ratio
+    bucket = (time_ms - start_ms) // interval_ms
+    if bucket.max() >= kline_num:
+        raise ValueError(f"file: {agg_trade_file_path} has trades after {datetime.datetime.fromtimestamp((start_ms + one_day_ms)//1000, tz=datetime.timezone.utc)}")
+
+    price = df["price"].to_numpy(dtype=np.float64)
+    qty = df["qty"].to_numpy(dtype=np.float64)
+    quote_asset_volume = price * qty
+    is_taker_buy = ~df["isBuyerMaker"].to_numpy(dtype=bool)
+
+    columns = _aggregate_klines(
+        bucket, price, price, price, price, qty, quote_asset_volume,
+        np.ones(len(bucket)),
+        np.where(is_taker_buy, qty, 0.0),
+        np.where(is_taker_buy, quote_asset_volume, 0.0),
+        kline_num,
+    )
+    return columns, start_ms
+
+
+def _roll_up_klines(columns: dict[str, np.ndarray], ratio: int) -> dict[str, np.ndarray]:
+    """
+    Aggregate kline columns into klines ratio times longer, only klines with trades take part.
+    """
+    real = np.flatnonzero(columns["tradesNumber"] > 0)
+    return _aggregate_klines(
+        real // ratio,
+        columns["openPrice"][real],
+        columns["highPrice"][real],
+        columns["lowPrice"][real],
+        columns["closePrice"][real],
+        columns["volume"][real],
+        columns["quoteAssetVolume"][real],
+        columns["tradesNumber"][real],
+        columns["takerBuyBaseAssetVolume"][real],
+        columns["takerBuyQuoteAssetVolume"][real],
+        len(columns["volume"]) // ratio,
+    )
+
+
+def merge_one_file_agg_trades_to_klines(
+        interval_seconds: int,
+        agg_trade_file_path: str,
+        last_kline_before_today: dict | None = None,
+        ) -> pd.DataFrame:
+
+    result = _read_agg_trades_to_kline_columns(interval_seconds, agg_trade_file_path)
+    if result is None:
+        return pd.DataFrame(columns=csv_util.klines_headers)
+    columns, start_ms = result
 
     last_real_kline_close_price = 0.0
     if last_kline_before_today is not None:
         last_real_kline_close_price = last_kline_before_today["closePrice"]
 
-    # can not use enumerate, because klines is too long
-    i = -1
-    for k in klines:
-        i += 1
-        if k is not None:
-            last_real_kline_close_price = k["closePrice"]
-            continue
-        open_time_ms = start_ms + interval_ms * i
-        klines[i] = {
-            "openTime": open_time_ms,
-            "openPrice": last_real_kline_close_price,
-            "highPrice": last_real_kline_close_price,
-            "lowPrice": last_real_kline_close_price,
-            "closePrice": last_real_kline_close_price,
-            "volume": 0,
-            "closeTime": open_time_ms + interval_ms - 1,
-            "quoteAssetVolume": 0,
-            "tradesNumber": 0,
-            "takerBuyBaseAssetVolume": 0,
-            "takerBuyQuoteAssetVolume": 0,
-            "unused": 0,
+    return _fill_empty_klines(columns, start_ms, interval_seconds*1000, last_real_kline_close_price)
+
+
+def merge_one_file_agg_trades_to_kline_pyramid(
+        interval_seconds_list: list[int],
+        agg_trade_file_path: str,
+        ) -> dict[int, pd.DataFrame]:
+    """
+    Build klines of several intervals from one agg trades file, reading it once.
+
+    Klines of the finest interval are aggregated from the trades, every coarser
+    interval is rolled up from them. Open, high, low, close and trades number are
+    the same as merge_one_file_agg_trades_to_klines, the volumes are sums of the
+    finer sums and can differ from it in the last digit.
+
+    Args:
+        interval_seconds_list: Intervals to build, each one a multiple of the finest one
+        agg_trade_file_path: Path of the agg trades file
+
+    Returns:
+        Dict from interval seconds to klines, all empty if the file has no trades
+
+    Raises:
+        ValueError: If an interval is not a multiple of the finest interval
+    """
+    finest = min(interval_seconds_list)
+    for interval_seconds in interval_seconds_list:
+        if interval_seconds % finest != 0:
+            raise ValueError(f"interval_seconds: {interval_seconds} is not a multiple of the finest interval: {finest}")
+
+    result = _read_agg_trades_to_kline_columns(finest, agg_trade_file_path)
+    if result is None:
+        return {interval_seconds: pd.DataFrame(columns=csv_util.klines_headers) for interval_seconds in interval_seconds_list}
+    columns, start_ms = result
+
+    pyramid: dict[int, pd.DataFrame] = {}
+    for interval_seconds in sorted(set(interval_seconds_list)):
+        ratio = interval_seconds // finest
+        interval_columns = columns if ratio == 1 else _roll_up_klines(columns, ratio)
+        pyramid[interval_seconds] = _fill_empty_klines(interval_columns, start_ms, interval_seconds*1000, 0.0)
+    return pyramid
+
+
+class _RunningSum:
+    """
+    Sum of a sliding window with Neumaier compensation, so adding and removing
+    values over a whole day does not drift in the printed decimal places.
+    """
+    def __init__(self) -> None:
+        self._sum = 0.0
+        self._compensation = 0.0
+
+    def add(self, x: float) -> None:
+        t = self._sum + x
+        if abs(self._sum) >= abs(x):
+            self._compensation += (self._sum - t) + x
+        else:
+            self._compensation += (x - t) + self._sum
+        self._sum = t
+
+    @property
+    def value(self) -> float:
+        return self._sum + self._compensation
+
+
+class RollingKlineBuilder:
+    """
+    Streaming rolling klines over a sliding time window.
+
+    A trade at least interval_ms after the first trade of the window closes the
+    window: a kline over every trade in it is returned, then the trades that are
+    interval_ms or more older than the new trade are dropped. Sums are kept
+    running and high/low come from monotonic deques, so each trade costs
+    amortized O(1) instead of a rescan of the window.
+    """
+    def __init__(self, interval_ms: int) -> None:
+        self.interval_ms = interval_ms
+        # (seq, time, price, qty, quote asset volume, is taker buy)
+        self._trades: deque[tuple[int, int, float, float, float, bool]] = deque()
+        # (seq, price), prices decreasing for high and increasing for low
+        self._highs: deque[tuple[int, float]] = deque()
+        self._lows: deque[tuple[int, float]] = deque()
+        self._volume = _RunningSum()
+        self._quote_asset_volume = _RunningSum()
+        self._taker_buy_base_asset_volume = _RunningSum()
+        self._taker_buy_quote_asset_volume = _RunningSum()
+        self._seq = 0
+
+    def update(self, time_ms: int, price: float, qty: float, is_buyer_maker: bool) -> dict | None:
+        """
+        Feed one trade, trades must come in time order.
+
+        Returns:
+            The kline of the window closed by this trade, None if it stays open
+        """
+        kline = None
+        if self._trades and time_ms - self._trades[0][1] >= self.interval_ms:
+            kline = self._kline()
+            while self._trades and time_ms - self._trades[0][1] >= self.interval_ms:
+                self._remove_first()
+        self._append(time_ms, price, qty, not is_buyer_maker)
+        return kline
+
+    def _kline(self) -> dict:
+        first = self._trades[0]
+        last = self._trades[-1]
+        return {
+            'openTime': first[1],
+            'openPrice': first[2],
+            'highPrice': self._highs[0][1],
+            'lowPrice': self._lows[0][1],
+            'closePrice': last[2],
+            'volume': self._volume.value,
+            'closeTime': last[1],
+            'quoteAssetVolume': self._quote_asset_volume.value,
+            'tradesNumber': len(self._trades),
+            'takerBuyBaseAssetVolume': self._taker_buy_base_asset_volume.value,
+            'takerBuyQuoteAssetVolume': self._taker_buy_quote_asset_volume.value,
+            'unused': 0,
         }
-        
-    # first_not_zero_price_index = len(klines)
-    # i = -1
-    # for k in klines:
-    #     i += 1
-    #     if k["closePrice"] != 0:
-    #         first_not_zero_price_index = i
-    #         break
-        
-    return klines
+
+    def _append(self, time_ms: int, price: float, qty: float, is_taker_buy: bool) -> None:
+        seq = self._seq
+        self._seq += 1
+        quote_asset_volume = price * qty
+        self._trades.append((seq, time_ms, price, qty, quote_asset_volume, is_taker_buy))
+        while self._highs and self._highs[-1][1] <= price:
+            self._highs.pop()
+        self._highs.append((seq, price))
+        while self._lows and self._lows[-1][1] >= price:
+            self._lows.pop()
+        self._lows.append((seq, price))
+        self._volume.add(qty)
+        self._quote_asset_volume.add(quote_asset_volume)
+        if is_taker_buy:
+            self._taker_buy_base_asset_volume.add(qty)
+            self._taker_buy_quote_asset_volume.add(quote_asset_volume)
+
+    def _remove_first(self) -> None:
+        seq, _, _, qty, quote_asset_volume, is_taker_buy = self._trades.popleft()
+        if self._highs[0][0] == seq:
+            self._highs.popleft()
+        if self._lows[0][0] == seq:
+            self._lows.popleft()
+        self._volume.add(-qty)
+        self._quote_asset_volume.add(-quote_asset_volume)
+        if is_taker_buy:
+            self._taker_buy_base_asset_volume.add(-qty)
+            self._taker_buy_quote_asset_volume.add(-quote_asset_volume)
+
+
+def rolling_klines_batch(
+        time_ms: np.ndarray,
+        price: np.ndarray,
+        qty: np.ndarray,
+        is_buyer_maker: np.ndarray,
+        interval_ms: int,
+        ) -> pd.DataFrame:
+    """
+    Vectorized RollingKlineBuilder over a whole day of trades.
+
+    The window ending at trade i holds the trades in (time_i - interval_ms, time_i].
+    Its left edge left[i] only moves forward, and a kline is closed at trade i
+    exactly when the next trade moves it, so the klines are the windows of those
+    trades. Window sums, high and low come from pandas time based rolling, which
+    keeps compensated running sums and monotonic deques in C.
+
+    Args:
+        time_ms: Trade times in milliseconds, sorted
+        price: Trade prices
+        qty: Trade quantities
+        is_buyer_maker: Trade sides
+        interval_ms: Window length in milliseconds
+
+    Returns:
+        Klines with csv_util.klines_headers columns, same rows as the streaming builder
+    """
+    left = np.searchsorted(time_ms, time_ms - interval_ms, side="right")
+    ends = np.flatnonzero(left[1:] > left[:-1])
+    starts = left[ends]
+
+    is_taker_buy = ~is_buyer_maker.astype(bool)
+    quote_asset_volume = price * qty
+    trades = pd.DataFrame(
+        {
+            "volume": qty,
+            "quoteAssetVolume": quote_asset_volume,
+            "takerBuyBaseAssetVolume": np.where(is_taker_buy, qty, 0.0),
+            "takerBuyQuoteAssetVolume": np.where(is_taker_buy, quote_asset_volume, 0.0),
+        },
+        index=pd.DatetimeIndex(time_ms.astype("datetime64[ms]")),
+    )
+    window = f"{interval_ms}ms"
+    sums = trades.rolling(window).sum().to_numpy()[ends]
+    prices = pd.Series(price, index=trades.index).rolling(window)
+    high_price = prices.max().to_numpy()[ends]
+    low_price = prices.min().to_numpy()[ends]
+
+    return pd.DataFrame({
+        "openTime": time_ms[starts],
+        "openPrice": price[starts],
+        "highPrice": high_price,
+        "lowPrice": low_price,
+        "closePrice": price[ends],
+        "volume": sums[:, 0],
+        "closeTime": time_ms[ends],
+        "quoteAssetVolume": sums[:, 1],
+        "tradesNumber": ends - starts + 1,
+        "takerBuyBaseAssetVolume": sums[:, 2],
+        "takerBuyQuoteAssetVolume": sums[:, 3],
+        "unused": np.zeros(len(ends), dtype=np.int64),
+    }, columns=csv_util.klines_headers)
 
 
 def agg_trades_to_rolling_klines_and_save(
@@ -148,7 +411,15 @@ def agg_trades_to_rolling_klines_and_save(
         interval_seconds: int,
         date: str,
         klines_root_dir: str = config.diy_binance_vision_dir,
+        batch: bool = True,
         ) -> None:
+    """
+    Build rolling klines of one day of agg trades and save them.
+
+    Args:
+        batch: Use the vectorized rolling_klines_batch, otherwise feed the trades
+        one by one through RollingKlineBuilder
+    """
 
     if trades is None or trades.empty:
         return []
@@ -161,70 +432,24 @@ def agg_trades_to_rolling_klines_and_save(
         ts_adjust_ratio = 1000
         first_time = first_time // ts_adjust_ratio
 
-    one_day_ms = 24*60*60*1000
     interval_ms = interval_seconds*1000
     
-    # if one_day_ms % interval_ms != 0:
-    #     raise ValueError(f"interval_ms: {interval_ms} is not a divisor of one_day_ms: {one_day_ms}")
-    
-    klines = []
-    
-    temp_trades = []    
-
-    for row in trades.itertuples():
-        time_ms = row.time // ts_adjust_ratio
-        trade = {
-            "time": time_ms,
-            "price": row.price,
-            "qty": row.qty,
-            "isBuyerMaker": bool(row.isBuyerMaker),
-        }
-        if len(temp_trades) == 0:
-            temp_trades.append(trade)
-            continue
-        first = temp_trades[0]
-        ts_diff = time_ms - first["time"]
-        if ts_diff < interval_ms:
-            temp_trades.append(trade)
-            continue
-        kline = {
-            'openTime': first["time"],
-            'openPrice': first["price"],
-            'highPrice': first["price"],
-            'lowPrice': first["price"],
-            'closePrice': first["price"],
-            'volume': 0,
-            'closeTime': 0,
-            'quoteAssetVolume': 0,
-            'tradesNumber': 0,
-            'takerBuyBaseAssetVolume': 0,
-            'takerBuyQuoteAssetVolume': 0,
-            'unused': 0,
-        }
-        new_temp_trades = []
-        for t in temp_trades:
-            ts = t["time"]
-            p = t["price"]
-            q = t["qty"]
-            quote_asset_volume = p * q
-            if p > kline["highPrice"]:
-                kline["highPrice"] = p
-            if p < kline["lowPrice"]:
-                kline["lowPrice"] = p
-            kline["closePrice"] = p
-            kline["closeTime"] = ts
-            kline["volume"] += q
-            kline["quoteAssetVolume"] += quote_asset_volume
-            kline["tradesNumber"] += 1
-            if not t["isBuyerMaker"]:
-                kline["takerBuyBaseAssetVolume"] += q
-                kline["takerBuyQuoteAssetVolume"] += quote_asset_volume
-            if time_ms - ts < interval_ms:
-                new_temp_trades.append(t)
-        _logger.debug(f"new kline: {datetime.datetime.fromtimestamp(kline['openTime']//1000, tz=datetime.timezone.utc)} ~ {datetime.datetime.fromtimestamp(kline['closeTime']//1000, tz=datetime.timezone.utc)}")
-        klines.append(kline)
-        new_temp_trades.append(trade)
-        temp_trades = new_temp_trades
+    time_ms = trades["time"].to_numpy(dtype=np.int64) // ts_adjust_ratio
+    price = trades["price"].to_numpy(dtype=np.float64)
+    qty = trades["qty"].to_numpy(dtype=np.float64)
+    is_buyer_maker = trades["isBuyerMaker"].to_numpy(dtype=bool)
+
+    if batch:
+        klines = rolling_klines_batch(time_ms, price, qty, is_buyer_maker, interval_ms)
+    else:
+        builder = RollingKlineBuilder(interval_ms)
+        kline_list = []
+        for trade in zip(time_ms.tolist(), price.tolist(), qty.tolist(), is_buyer_maker.tolist()):
+            kline = builder.update(*trade)
+            if kline is not None:
+                kline_list.append(kline)
+        klines = pd.DataFrame(kline_list, columns=csv_util.klines_headers)
+    _logger.debug(f"{len(klines)} rolling klines of {symbol} {date}")
             
     klines_dir = f"{klines_root_dir}/data/{syb_type.value}/daily/rolling_klines/{symbol}/rolling{interval_seconds}s"
     
@@ -239,16 +464,121 @@ def read_agg_trades_to_rolling_klines_and_save(
         *,
         add_trades_root_dir: str = config.tidy_binance_vision_dir,
         klines_root_dir: str = config.diy_binance_vision_dir,
+        batch: bool = True,
         ) -> None:
     
-    agg_trades_file_path = f"{add_trades_root_dir}/data/{syb_type.value}/daily/aggTrades/{symbol}/{symbol}-aggTrades-{date}.csv"
-    if not os.path.exists(agg_trades_file_path):
-        raise FileNotFoundError(f"agg trades file not found, {agg_trades_file_path}")
+    agg_trades_dir = f"{add_trades_root_dir}/data/{syb_type.value}/daily/aggTrades/{symbol}"
+    agg_trades_file_path = csv_util.find_data_file(agg_trades_dir, f"{symbol}-aggTrades-{date}")
+    if agg_trades_file_path is None:
+        raise FileNotFoundError(f"agg trades file not found, {agg_trades_dir}/{symbol}-aggTrades-{date}")
     
-    with open(agg_trades_file_path, "r") as f:
-        df = csv_util.csv_to_pandas(f, csv_util.agg_trades_headers)
+    df = csv_util.read_file_to_pandas(agg_trades_file_path, csv_util.agg_trades_headers)
         
-    agg_trades_to_rolling_klines_and_save(symbol, syb_type, df, interval_seconds, date, klines_root_dir)
+    agg_trades_to_rolling_klines_and_save(symbol, syb_type, df, interval_seconds, date, klines_root_dir, batch)
+
+
+def _list_agg_trades_file_names(agg_trades_dir: str, symbol: str, start_agg_trade_file_name: str) -> list[str]:
+    # tidy agg trades may be csv or parquet, compare file stems
+    start_stem = os.path.splitext(start_agg_trade_file_name)[0]
+    agg_trades_file_names = catalog.list_file_names(agg_trades_dir, csv_util.data_file_exts)
+    if start_stem:
+        cdt = datetime.datetime.strptime(start_stem.split("-aggTrades-")[-1], "%Y-%m-%d")
+        cdt = cdt - datetime.timedelta(days=1)
+        stem = f"{symbol}-aggTrades-{cdt.strftime('%Y-%m-%d')}"
+        if any(os.path.splitext(f)[0] == stem for f in agg_trades_file_names):
+            start_stem = stem
+            
+    if start_stem:
+        agg_trades_file_names = [f for f in agg_trades_file_names if os.path.splitext(f)[0] >= start_stem]
+    return agg_trades_file_names
+
+
+@dataclass
+class KlinesDaySummary:
+    interval_seconds: int
+    date: str
+    klines_file_path: str
+    # number of klines before the first trade of the day, their prices wait for the day before
+    leading_gap: int
+    last_close_price: float
+
+
+def _merge_one_file_agg_trades_to_kline_pyramid_and_save(
+        interval_seconds_list: list[int],
+        agg_trade_file_path: str,
+        check_exist: bool,
+        klines_dirs: dict[int, str],
+        symbol: str,
+        ) -> list[KlinesDaySummary]:
+    """
+    Build the klines of one agg trades file and write them in the worker, only
+    small summaries go back to the parent.
+
+    Klines with a leading gap are written to klines_file_path + ".tmp" and moved in
+    place by _fill_leading_missing_klines_and_save once the close of the day before
+    is known, so a killed run never leaves a final file with zero prices.
+    """
+    date = os.path.splitext(os.path.basename(agg_trade_file_path))[0].split("-aggTrades-")[-1]
+    klines_file_paths = {
+        interval_seconds: f"{klines_dirs[interval_seconds]}/{symbol}-{interval_seconds}s-{date}.csv"
+        for interval_seconds in interval_seconds_list
+    }
+
+    summaries: list[KlinesDaySummary] = []
+    todo_interval_seconds_list = []
+    for interval_seconds, klines_file_path in klines_file_paths.items():
+        if check_exist and os.path.exists(klines_file_path):
+            _logger.debug(f"klines file already exists, skipping, {klines_file_path}")
+            last_close_price = float(csv_util.get_last_value(klines_file_path, csv_util.klines_headers, "closePrice"))
+            summaries.append(KlinesDaySummary(interval_seconds, date, klines_file_path, 0, last_close_price))
+        else:
+            todo_interval_seconds_list.append(interval_seconds)
+    if not todo_interval_seconds_list:
+        return summaries
+
+    pyramid = merge_one_file_agg_trades_to_kline_pyramid(todo_interval_seconds_list, agg_trade_file_path)
+    for interval_seconds, klines in pyramid.items():
+        if len(klines) == 0:
+            continue
+        klines_file_path = klines_file_paths[interval_seconds]
+        not_zero_price_indexes = np.flatnonzero(klines["openPrice"].to_numpy() != 0.0)
+        leading_gap = int(not_zero_price_indexes[0]) if len(not_zero_price_indexes) > 0 else len(klines)
+        save_path = klines_file_path + ".tmp" if leading_gap > 0 else klines_file_path
+        _logger.debug(f"saving klines to {save_path}")
+        _write_klines_csv(klines, save_path)
+        if leading_gap == 0:
+            catalog.record_frame(save_path, klines, None, "openTime")
+        summaries.append(KlinesDaySummary(interval_seconds, date, klines_file_path, leading_gap, float(klines["closePrice"].iloc[-1])))
+    return summaries
+
+
+def _fill_leading_missing_klines_and_save(
+        klines_file_path: str,
+        leading_gap: int,
+        close_price: float | None,
+        ) -> None:
+    """
+    Set the prices of the first leading_gap klines in klines_file_path + ".tmp" to
+    close_price, the close of the day before, and move the file in place.
+    Without a day before the prices stay zero.
+    """
+    tmp_path = klines_file_path + ".tmp"
+    if close_price is not None:
+        price = _float_formater(close_price)
+        patched_path = klines_file_path + ".patch"
+        with open(tmp_path, "r", newline="") as f, open(patched_path, "w", newline="") as out:
+            out.write(f.readline())
+            reader = csv.reader(f)
+            writer = csv.writer(out)
+            for _, row in zip(range(leading_gap), reader):
+                row[1:5] = [price] * 4
+                writer.writerow(row)
+            # the rest of the day is copied line by line
+            out.writelines(f)
+        os.replace(patched_path, tmp_path)
+    os.replace(tmp_path, klines_file_path)
+    catalog.record_file(klines_file_path)
+    _logger.debug(f"saved klines to {klines_file_path}")
 
 
 def multi_proc_merge_one_symbol_agg_trades_to_klines(
@@ -261,46 +591,67 @@ def multi_proc_merge_one_symbol_agg_trades_to_klines(
         check_exist: bool = True,
         max_workers: int = config.max_workers,
         ) -> None:
-    
-    if start_agg_trade_file_name:
-        cdt = datetime.datetime.strptime(start_agg_trade_file_name.lstrip(f"{symbol}-aggTrades-").rstrip(".csv"), "%Y-%m-%d")
-        cdt = cdt - datetime.timedelta(days=1)
-        fn = f"{symbol}-aggTrades-{cdt.strftime('%Y-%m-%d')}.csv"
-        if os.path.exists(f"{agg_trades_root_dir}/data/{syb_type.value}/daily/aggTrades/{symbol}/{fn}"):
-            start_agg_trade_file_name = fn
-            
+    multi_proc_merge_one_symbol_agg_trades_to_kline_pyramid(
+        syb_type, symbol, [interval_seconds], start_agg_trade_file_name,
+        agg_trades_root_dir, klines_root_dir, check_exist, max_workers,
+    )
+
+
+def multi_proc_merge_one_symbol_agg_trades_to_kline_pyramid(
+        syb_type: SymbolType,
+        symbol: str,
+        interval_seconds_list: list[int],
+        start_agg_trade_file_name: str = "",
+        agg_trades_root_dir: str = config.tidy_binance_vision_dir,
+        klines_root_dir: str = config.diy_binance_vision_dir,
+        check_exist: bool = True,
+        max_workers: int = config.max_workers,
+        ) -> None:
+    """
+    Same as multi_proc_merge_one_symbol_agg_trades_to_klines for several intervals
+    at once, every agg trades file is read and parsed a single time.
+
+    Each worker writes its own day, the parent only keeps a KlinesDaySummary per
+    day and interval and fills the leading gaps with the close of the day before.
+
+    Args:
+        interval_seconds_list: Intervals to build, e.g. [1, 60, 300, 900, 3600, 14400],
+        each one a multiple of the finest one
+    """
     agg_trades_dir = f"{agg_trades_root_dir}/data/{syb_type.value}/daily/aggTrades/{symbol}"
-    agg_trades_file_names = os.listdir(agg_trades_dir)
-    agg_trades_file_names.sort()
-    if start_agg_trade_file_name:
-        agg_trades_file_names = [f for f in agg_trades_file_names if f >= start_agg_trade_file_name]
+
+    agg_trades_file_names = _list_agg_trades_file_names(agg_trades_dir, symbol, start_agg_trade_file_name)
         
     if len(agg_trades_file_names) == 0:
         _logger.info(f"no agg trades files found")
         return
         
-    _logger.info(f"agg_trades_files: {agg_trades_file_names[0]} ~ {agg_trades_file_names[-1]}")
+    _logger.info(f"agg_trades_files: {agg_trades_file_names[0]} ~ {agg_trades_file_names[-1]}, intervals: {interval_seconds_list}")
         
-    klines_dir = f"{klines_root_dir}/data/{syb_type.value}/daily/klines/{symbol}/{interval_seconds}s"
-    os.makedirs(klines_dir, mode=0o777, exist_ok=True)
-        
-    kline_dict: dict[str, list[dict]] = {}
+    klines_dirs: dict[int, str] = {}
+    for interval_seconds in interval_seconds_list:
+        klines_dirs[interval_seconds] = f"{klines_root_dir}/data/{syb_type.value}/daily/klines/{symbol}/{interval_seconds}s"
+        os.makedirs(klines_dirs[interval_seconds], mode=0o777, exist_ok=True)
     
     with Pool(max_workers) as p:
-        kss = p.starmap(merge_one_file_agg_trades_to_klines, [(interval_seconds, f"{agg_trades_dir}/{fn}") for fn in agg_trades_file_names])
-        for ks in kss:
-            if len(ks) == 0:
-                continue
-            fdt = datetime.datetime.fromtimestamp(ks[0]["openTime"]//1000, tz=datetime.timezone.utc)
-            kline_dict[fdt.strftime("%Y-%m-%d")] = ks
+        summary_lists = p.starmap(
+            _merge_one_file_agg_trades_to_kline_pyramid_and_save,
+            [(interval_seconds_list, f"{agg_trades_dir}/{fn}", check_exist, klines_dirs, symbol) for fn in agg_trades_file_names],
+        )
+    summaries = [summary for summary_list in summary_lists for summary in summary_list]
     
-    _logger.debug(f"kline_dict_len: {len(kline_dict)}")
+    _logger.debug(f"summaries_len: {len(summaries)}")
+
+    last_close_prices = {(s.interval_seconds, s.date): s.last_close_price for s in summaries}
+    args = []
+    for s in summaries:
+        if s.leading_gap == 0:
+            continue
+        ldt = (datetime.datetime.strptime(s.date, "%Y-%m-%d") - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+        args.append((s.klines_file_path, s.leading_gap, last_close_prices.get((s.interval_seconds, ldt))))
                 
     with Pool(max_workers) as p:
-        p.starmap(
-            _add_leading_missing_klines_and_save, 
-            [(interval_seconds, dt, klines, kline_dict, check_exist, klines_dir, symbol) for dt, klines in kline_dict.items()]
-        )
+        p.starmap(_fill_leading_missing_klines_and_save, args)
 
                     
 def _float_formater(x) -> str:
@@ -310,70 +661,17 @@ def _float_formater(x) -> str:
     return formatted
 
             
-def _add_leading_missing_klines_and_save(
-        interval_seconds: int, 
-        tody_date: str, 
-        klines: list[dict], 
-        kline_dict: dict[str, list[dict]], 
-        check_exist: bool, 
-        klines_dir: str, 
-        symbol: str
-        ) -> None:
-    if len(klines) == 0:
-        return
-    
-    _logger.debug(f"checking klines leading missing klines, symbol: {symbol}, date: {tody_date}, klines_len: {len(klines)}")
-    
-    interval_ms = interval_seconds*1000
-
-    first_not_zero_price_index = len(klines)
-    for k in klines:
-        if k["openPrice"] != 0.0:
-            first_not_zero_price_index = klines.index(k)
-            break
-
-    if first_not_zero_price_index > 0:
-        lot = datetime.datetime.strptime(tody_date, "%Y-%m-%d") - datetime.timedelta(days=1)
-        ldt = lot.strftime("%Y-%m-%d")
-        lklines = kline_dict.get(ldt)
-        if lklines is not None and len(lklines) != 0:
-            fko = klines[0]["openTime"]
-            last_lk = lklines[-1]
-            close_price = last_lk["closePrice"]
-            for i in range(first_not_zero_price_index):            
-                op = fko + interval_ms * i
-                klines[i] = {
-                    "openTime": op,
-                    "openPrice": close_price,
-                    "highPrice": close_price,
-                    "lowPrice": close_price,
-                    "closePrice": close_price,
-                    "volume": 0,
-                    "closeTime": op + interval_ms - 1,
-                    "quoteAssetVolume": 0,
-                    "tradesNumber": 0,
-                    "takerBuyBaseAssetVolume": 0,
-                    "takerBuyQuoteAssetVolume": 0,
-                    "unused": 0,
-                }
-
-    klines_file_path = f"{klines_dir}/{symbol}-{interval_seconds}s-{tody_date}.csv"
-    _logger.debug(f"saving klines to {klines_file_path}")
-    if check_exist and os.path.exists(klines_file_path):
-        _logger.debug(f"klines file already exists, skipping, {klines_file_path}")
-        return
+def _write_klines_csv(klines: pd.DataFrame, klines_file_path: str) -> None:
+    # format column by column, tolist gives python ints and floats like the old dict rows
+    columns = [[_float_formater(v) for v in klines[h].tolist()] for h in csv_util.klines_headers]
     with open(klines_file_path, "w") as f:
-        writer = csv.DictWriter(f, fieldnames=csv_util.klines_headers)
-        writer.writeheader()
-        for kline in klines:
-            for k, v in kline.items():
-                kline[k] = _float_formater(v)
-            writer.writerow(kline)
-    _logger.debug(f"saved klines to {klines_file_path}")
-    
-    
+        writer = csv.writer(f)
+        writer.writerow(csv_util.klines_headers)
+        writer.writerows(zip(*columns))
+
+            
 def _save_rolling_klines(
-        klines: list[dict],
+        klines: pd.DataFrame,
         symbol: str,
         interval_seconds: int,
         date: str,
@@ -382,13 +680,8 @@ def _save_rolling_klines(
     os.makedirs(klines_dir, mode=0o777, exist_ok=True)
     klines_file_path = f"{klines_dir}/{symbol}-rolling{interval_seconds}s-{date}.csv"
     _logger.debug(f"saving klines to {klines_file_path}")
-    with open(klines_file_path, "w") as f:
-        writer = csv.DictWriter(f, fieldnames=csv_util.klines_headers)
-        writer.writeheader()
-        for kline in klines:
-            for k, v in kline.items():
-                kline[k] = _float_formater(v)
-            writer.writerow(kline)
+    _write_klines_csv(klines, klines_file_path)
+    catalog.record_frame(klines_file_path, klines, None, "openTime")
 
 
 if __name__ == "__main__":
@@ -3,9 +3,12 @@ import logging
 from multiprocessing import Pool
 import os
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from enums import SymbolType
 
+import catalog
 import config
 import csv_util
 
@@ -25,10 +28,6 @@ def merge_agg_trades_to_klines(
     if raw_data is None or raw_data.empty:
         return pd.DataFrame(columns=csv_util.klines_headers)
     
-    raw_data["time"] = pd.to_numeric(raw_data["time"])
-    raw_data["price"] = pd.to_numeric(raw_data["price"])
-    raw_data["qty"] = pd.to_numeric(raw_data["qty"])
-    
     first_time = int(raw_data["time"].iloc[0])
     
     ts_adjust_ratio = 1
@@ -116,48 +115,202 @@ def merge_agg_trades_to_klines(
     return complete_klines_df
 
 
+# the only columns the klines need, streaming reads nothing else
+stream_columns = ["price", "qty", "firstTradeId", "lastTradeId", "time", "isBuyerMaker"]
+
+
+class KlineAccumulator:
+    """
+    Klines of one day built chunk by chunk from agg trades in file order.
+
+    Every bucket of the day has a slot in fixed size arrays, so memory follows
+    the number of buckets and not the number of trades. Open and close carry
+    over chunk boundaries: a bucket keeps the open of its first trade and takes
+    the close of its latest one.
+    """
+    def __init__(self, interval_ms: int) -> None:
+        if ONE_DAY_MS % interval_ms != 0:
+            raise ValueError(f"interval_ms: {interval_ms} is not a divisor of one_day_ms: {ONE_DAY_MS}")
+        self.interval_ms = interval_ms
+        n = ONE_DAY_MS // interval_ms
+        self.start_ms: int | None = None
+        self.ts_adjust_ratio = 1
+        self.has_trade = np.zeros(n, dtype=bool)
+        self.open = np.zeros(n)
+        self.high = np.full(n, -np.inf)
+        self.low = np.full(n, np.inf)
+        self.close = np.zeros(n)
+        # sums are kept in extended precision, close to the compensated sums of pandas groupby
+        self.volume = np.zeros(n, dtype=np.longdouble)
+        self.quote_asset_volume = np.zeros(n, dtype=np.longdouble)
+        self.trades_number = np.zeros(n, dtype=np.int64)
+        self.taker_buy_base_asset_volume = np.zeros(n, dtype=np.longdouble)
+        self.taker_buy_quote_asset_volume = np.zeros(n, dtype=np.longdouble)
+
+    def update(
+            self,
+            time: np.ndarray,
+            price: np.ndarray,
+            qty: np.ndarray,
+            first_trade_id: np.ndarray,
+            last_trade_id: np.ndarray,
+            is_buyer_maker: np.ndarray,
+            ) -> None:
+        if len(time) == 0:
+            return
+        if self.start_ms is None:
+            # binance old data is in milliseconds, new data is in microseconds
+            if int(time[0]) > MICRO_SECONDS_20000101:
+                self.ts_adjust_ratio = 1000
+            self.start_ms = int(time[0]) // self.ts_adjust_ratio // ONE_DAY_MS * ONE_DAY_MS
+        buckets = (time // self.ts_adjust_ratio - self.start_ms) // self.interval_ms
+        in_day = (buckets >= 0) & (buckets < len(self.has_trade))
+        if not in_day.all():
+            buckets, price, qty, first_trade_id, last_trade_id, is_buyer_maker = (
+                a[in_day] for a in (buckets, price, qty, first_trade_id, last_trade_id, is_buyer_maker))
+            if len(buckets) == 0:
+                return
+
+        quote_asset_volume = (price * qty).round(DECIMAL_PLACES).astype(np.longdouble)
+        qty = qty.astype(np.longdouble)
+        is_taker_buy = ~is_buyer_maker
+        # runs of trades in the same bucket, a bucket only has several runs if times go back
+        run_starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+        run_ends = np.r_[run_starts[1:], len(buckets)] - 1
+        run_buckets = buckets[run_starts]
+
+        np.add.at(self.volume, run_buckets, np.add.reduceat(qty, run_starts))
+        np.add.at(self.quote_asset_volume, run_buckets, np.add.reduceat(quote_asset_volume, run_starts))
+        np.add.at(self.trades_number, run_buckets, np.add.reduceat(last_trade_id - first_trade_id + 1, run_starts))
+        np.add.at(self.taker_buy_base_asset_volume, run_buckets, np.add.reduceat(np.where(is_taker_buy, qty, 0.0), run_starts))
+        np.add.at(self.taker_buy_quote_asset_volume, run_buckets, np.add.reduceat(np.where(is_taker_buy, quote_asset_volume, 0.0), run_starts))
+        np.maximum.at(self.high, run_buckets, np.maximum.reduceat(price, run_starts))
+        np.minimum.at(self.low, run_buckets, np.minimum.reduceat(price, run_starts))
+
+        first_runs = np.unique(run_buckets, return_index=True)[1]
+        is_new = ~self.has_trade[run_buckets[first_runs]]
+        self.open[run_buckets[first_runs[is_new]]] = price[run_starts[first_runs[is_new]]]
+        last_runs = len(run_buckets) - 1 - np.unique(run_buckets[::-1], return_index=True)[1]
+        self.close[run_buckets[last_runs]] = price[run_ends[last_runs]]
+        self.has_trade[run_buckets] = True
+
+    def update_batch(self, batch: pa.RecordBatch | pd.DataFrame) -> None:
+        """update with the stream_columns of a record batch or frame."""
+        columns = {c: np.asarray(batch[c]) for c in stream_columns}
+        self.update(
+            columns["time"].astype(np.int64, copy=False),
+            columns["price"].astype(np.float64, copy=False),
+            columns["qty"].astype(np.float64, copy=False),
+            columns["firstTradeId"].astype(np.int64, copy=False),
+            columns["lastTradeId"].astype(np.int64, copy=False),
+            columns["isBuyerMaker"].astype(bool, copy=False),
+        )
+
+    def klines(self, pre_close_price: float) -> pd.DataFrame:
+        """
+        Klines of every bucket of the day, buckets without trades take the close
+        before them and the first one takes pre_close_price.
+        """
+        if self.start_ms is None:
+            return pd.DataFrame(columns=csv_util.klines_headers)
+        n = len(self.has_trade)
+        has_close = self.has_trade.copy()
+        close = self.close.copy()
+        if not has_close[0]:
+            has_close[0] = True
+            close[0] = pre_close_price
+        close = close[np.maximum.accumulate(np.where(has_close, np.arange(n), 0))]
+        open_time = self.start_ms + self.interval_ms * np.arange(n, dtype=np.int64)
+        return pd.DataFrame({
+            "openTime": open_time,
+            "openPrice": np.where(self.has_trade, self.open, close).round(DECIMAL_PLACES),
+            "highPrice": np.where(self.has_trade, self.high, close).round(DECIMAL_PLACES),
+            "lowPrice": np.where(self.has_trade, self.low, close).round(DECIMAL_PLACES),
+            "closePrice": close.round(DECIMAL_PLACES),
+            "volume": self.volume.astype(np.float64).round(DECIMAL_PLACES),
+            "closeTime": open_time + self.interval_ms - 1,
+            "quoteAssetVolume": self.quote_asset_volume.astype(np.float64).round(DECIMAL_PLACES),
+            "tradesNumber": self.trades_number,
+            "takerBuyBaseAssetVolume": self.taker_buy_base_asset_volume.astype(np.float64).round(DECIMAL_PLACES),
+            "takerBuyQuoteAssetVolume": self.taker_buy_quote_asset_volume.astype(np.float64).round(DECIMAL_PLACES),
+            "unused": np.zeros(n, dtype=np.int64),
+        }, columns=csv_util.klines_headers)
+
+
+def merge_agg_trades_to_klines_streaming(
+        interval_ms: int,
+        agg_trade_file_path: str,
+        pre_close_price: float,
+        chunk_rows: int = config.stream_chunk_rows,
+        ) -> pd.DataFrame:
+    """
+    Same klines as merge_agg_trades_to_klines, read from agg_trade_file_path in
+    chunks of chunk_rows trades and only the stream_columns, so peak memory does
+    not depend on the size of the day.
+    """
+    accumulator = KlineAccumulator(interval_ms)
+    for batch in csv_util.iter_file_batches(agg_trade_file_path, csv_util.agg_trades_headers, stream_columns, chunk_rows):
+        accumulator.update_batch(batch)
+    return accumulator.klines(pre_close_price)
+
+
 def merge_one_file_agg_trades_to_klines(
         interval_ms: int,
         agg_trade_file_path: str,
         kline_dir: str | None = None,
+        streaming: bool = True,
         ):
+    """
+    Build the klines of one agg trades file and save them as parquet.
+
+    Args:
+        kline_dir: Directory of the klines, by default the diy tree of the symbol
+        of agg_trade_file_path
+        streaming: Read the file in chunks with merge_agg_trades_to_klines_streaming,
+        otherwise load the whole day
+    """
         
     _logger.info(f"merging {agg_trade_file_path} to klines")
 
-    with open(agg_trade_file_path, "r") as f:
-        raw_data = csv_util.csv_to_pandas(f, csv_util.agg_trades_headers)
-    
-    if raw_data is None or raw_data.empty:
-        _logger.warning(f"no raw data found in {agg_trade_file_path}")
-        return
-        
+    stem = os.path.splitext(os.path.basename(agg_trade_file_path))[0]
+    symbol, date = stem.split("-aggTrades-")
+
     if kline_dir is None:
-        kline_dir = f"{config.diy_binance_vision_dir}/data/{syb_type.value}/daily/klines/{symbol}/{interval_ms}ms"
+        syb_type = catalog.parse_path(agg_trade_file_path)["syb_type"]
+        if not syb_type:
+            raise ValueError(f"no symbol type in {agg_trade_file_path}, pass kline_dir")
+        kline_dir = f"{config.diy_binance_vision_dir}/data/{syb_type}/daily/klines/{symbol}/{interval_ms}ms"
         
-    os.makedirs(kline_dir, exist_ok=True)
-    
-    date = os.path.basename(agg_trade_file_path).strip(".csv").split("-aggTrades-")[-1]
-    
     date = datetime.datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
     
     pre_date = date - datetime.timedelta(days=1)
     
-    pre_file = agg_trade_file_path.replace(date.strftime("%Y-%m-%d"), pre_date.strftime("%Y-%m-%d"))
+    # previous day may be stored in another format
+    pre_file = csv_util.find_data_file(os.path.dirname(agg_trade_file_path), stem.replace(date.strftime("%Y-%m-%d"), pre_date.strftime("%Y-%m-%d")))
     
     pre_close_price = 0.0
     
-    if os.path.exists(pre_file):
-        last_row_str = csv_util.get_last_row_ignore_header(pre_file)
-        pre_close_price = float(last_row_str.split(",")[1])
+    if pre_file is not None:
+        pre_close_price = float(csv_util.get_last_value(pre_file, csv_util.agg_trades_headers, "price"))
         pre_close_price = round(pre_close_price, DECIMAL_PLACES)
     
-    ks = merge_agg_trades_to_klines(interval_ms, raw_data, pre_close_price)
-    
-    _logger.info(f"saving klines to {kline_dir}/{symbol}-{interval_ms}ms-{date.strftime('%Y-%m-%d')}.parquet")
+    if streaming:
+        ks = merge_agg_trades_to_klines_streaming(interval_ms, agg_trade_file_path, pre_close_price)
+    else:
+        ks = merge_agg_trades_to_klines(interval_ms, csv_util.read_file_to_pandas(agg_trade_file_path, csv_util.agg_trades_headers), pre_close_price)
+
+    if ks.empty:
+        _logger.warning(f"no raw data found in {agg_trade_file_path}")
+        return
+
+    os.makedirs(kline_dir, exist_ok=True)
     
     file_path = f"{kline_dir}/{symbol}-{interval_ms}ms-{date.strftime('%Y-%m-%d')}.parquet"
+
+    _logger.info(f"saving klines to {file_path}")
     
     ks.to_parquet(file_path, engine="pyarrow", index=False)
+    catalog.record_frame(file_path, ks, None, "openTime")
 
 
 def multi_proc_merge_one_symbol_agg_trades_to_klines(
@@ -172,34 +325,33 @@ def multi_proc_merge_one_symbol_agg_trades_to_klines(
         max_workers: int = config.max_workers,
         ) -> None:
 
-    start_agg_trade_file_name = ""
-    end_agg_trade_file_name = f"{symbol}-aggTrades-9999-12-31.csv"
+    agg_trades_dir = f"{agg_trades_root_dir}/data/{syb_type.value}/daily/aggTrades/{symbol}"
+    all_agg_trades_file_names = catalog.list_file_names(agg_trades_dir, csv_util.data_file_exts)
+
+    # tidy agg trades may be csv or parquet, compare file stems
+    start_agg_trade_file_stem = ""
+    end_agg_trade_file_stem = f"{symbol}-aggTrades-9999-12-31"
     if start_date:
-        start_agg_trade_file_name = f"{symbol}-aggTrades-{start_date}.csv"
+        start_agg_trade_file_stem = f"{symbol}-aggTrades-{start_date}"
         cdt = datetime.datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
         cdt = cdt - datetime.timedelta(days=1)
-        fn = f"{symbol}-aggTrades-{cdt.strftime('%Y-%m-%d')}.csv"
-        if os.path.exists(f"{agg_trades_root_dir}/data/{syb_type.value}/daily/aggTrades/{symbol}/{fn}"):
-            start_agg_trade_file_name = fn
+        stem = f"{symbol}-aggTrades-{cdt.strftime('%Y-%m-%d')}"
+        if any(os.path.splitext(f)[0] == stem for f in all_agg_trades_file_names):
+            start_agg_trade_file_stem = stem
     if end_date:
-        end_agg_trade_file_name = f"{symbol}-aggTrades-{end_date}.csv"
+        end_agg_trade_file_stem = f"{symbol}-aggTrades-{end_date}"
 
     klines_dir = f"{klines_root_dir}/data/{syb_type.value}/daily/klines/{symbol}/{interval_milliseconds}ms"
     os.makedirs(klines_dir, mode=0o777, exist_ok=True)
 
-    exist_klines_file_names = os.listdir(klines_dir)
+    exist_klines_file_stems = set()
     
     if check_exist:
-        exist_klines_file_names = [fn.replace(f"-{interval_milliseconds}ms-", f"-aggTrades-") for fn in exist_klines_file_names]
-        exist_klines_file_names = [fn.replace("parquet", "csv") for fn in exist_klines_file_names]
+        exist_klines_file_stems = {os.path.splitext(fn)[0].replace(f"-{interval_milliseconds}ms-", f"-aggTrades-") for fn in catalog.list_file_names(klines_dir)}
         
-    agg_trades_dir = f"{agg_trades_root_dir}/data/{syb_type.value}/daily/aggTrades/{symbol}"
-    all_agg_trades_file_names = os.listdir(agg_trades_dir)
-    all_agg_trades_file_names.sort()
     all_agg_trades_file_names = [f for f in all_agg_trades_file_names
-                                 if f >= start_agg_trade_file_name
-                                 and f <= end_agg_trade_file_name
-                                 and f not in exist_klines_file_names]
+                                 if start_agg_trade_file_stem <= os.path.splitext(f)[0] <= end_agg_trade_file_stem
+                                 and os.path.splitext(f)[0] not in exist_klines_file_stems]
         
     if len(all_agg_trades_file_names) == 0:
         _logger.info(f"no agg trades files found")
@@ -208,7 +360,7 @@ def multi_proc_merge_one_symbol_agg_trades_to_klines(
     _logger.info(f"agg_trades_files: {all_agg_trades_file_names[0]} ~ {all_agg_trades_file_names[-1]}")
     
     with Pool(max_workers) as p:
-        p.starmap(merge_one_file_agg_trades_to_klines, [(interval_milliseconds, f"{agg_trades_dir}/{fn}") for fn in all_agg_trades_file_names])
+        p.starmap(merge_one_file_agg_trades_to_klines, [(interval_milliseconds, f"{agg_trades_dir}/{fn}", klines_dir) for fn in all_agg_trades_file_names])
 
             
 if __name__ == "__main__":
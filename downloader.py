@@ -1,7 +1,10 @@
 from multiprocessing import Pool
+import hashlib
 import os, requests, logging, config
 from urllib.parse import urlparse
 
+import catalog
+import manifest
 import zipper
 
 _logger = logging.getLogger(__name__)
@@ -17,42 +20,163 @@ def download(url: str) -> bytes:
     return file_data
 
 
-def download_save(url: str, save_dir: str, check_exists: bool = True) -> None:
+def download_checksum(url: str) -> str | None:
+    """
+    Download the .CHECKSUM sidecar of url.
+
+    Returns:
+        The sha256 hex digest, or None if the sidecar does not exist
+    """
+    response = requests.get(url + ".CHECKSUM")
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return manifest.parse_checksum(response.text)
+
+
+def download_to_file(url: str, save_path: str, chunk_size: int = 1024 * 1024, expected_sha256: str | None = None) -> str:
+    """
+    Stream url into save_path without holding the whole file in memory.
+
+    Chunks are appended to save_path + ".part". If a part file is left over from an
+    interrupted run, the download resumes from its end with an HTTP Range request.
+    The part file is renamed to save_path only after the whole body has been written,
+    so save_path either does not exist or is complete.
+
+    Args:
+        url: URL of the file to download
+        save_path: Final path of the downloaded file
+        chunk_size: Size of each chunk read from the response
+        expected_sha256: If given, the file must hash to it, and testzip is skipped
+
+    Returns:
+        The sha256 hex digest of the downloaded file
+
+    Raises:
+        requests.HTTPError: If the server answers with an error status
+        Exception: If a zip file is invalid or the checksum does not match
+    """
+    part_path = save_path + ".part"
+    downloaded = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={downloaded}-"} if downloaded > 0 else {}
+    h = hashlib.sha256()
+    with requests.get(url, headers=headers, stream=True) as response:
+        # 416 means the part file already holds every byte of the remote file
+        complete = downloaded > 0 and response.status_code == 416
+        if not complete:
+            response.raise_for_status()
+        # server ignored the Range header, so restart from byte zero
+        mode = 'ab' if complete or response.status_code == 206 else 'wb'
+        if mode == 'ab':
+            _logger.debug(f"Resuming {url} from byte {downloaded}")
+            # bytes already on disk are part of the file, hash them first
+            with open(part_path, 'rb') as f:
+                while data := f.read(chunk_size):
+                    h.update(data)
+        if not complete:
+            with open(part_path, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        h.update(chunk)
+                        f.write(chunk)
+    sha256 = h.hexdigest()
+    if expected_sha256 is not None:
+        if sha256 != expected_sha256:
+            os.remove(part_path)
+            _logger.error(f"Checksum mismatch: {url}")
+            raise Exception(f"Checksum mismatch: {url}")
+    elif url.endswith(".zip"):
+        if not zipper.is_valid_zip_file(part_path):
+            # drop the broken part file, otherwise every retry would resume from it
+            os.remove(part_path)
+            _logger.error(f"Invalid zip file: {url}")
+            raise Exception(f"Invalid zip file: {url}")
+    os.replace(part_path, save_path)
+    return sha256
+
+
+def download_save(
+        url: str,
+        save_dir: str,
+        check_exists: bool = True,
+        stream: bool = True,
+        verify: bool = False,
+    ) -> tuple[str, int, str] | None:
+    """
+    Download url into save_dir.
+
+    With verify, the .CHECKSUM sidecar of url is fetched and the file is hashed while
+    it is written. An existing non empty file is hashed and downloaded again if it
+    does not match. Empty files are trusted, raw_unzipper clears zips after unzipping.
+
+    Returns:
+        (file name, size, sha256) of a verified file, None otherwise
+    """
     parsed_url = urlparse(url)
     filename = parsed_url.path.split('/')[-1]
     save_path = os.path.join(save_dir, filename)
+    expected_sha256 = None
     if check_exists and os.path.exists(save_path):
-        return
+        size = os.path.getsize(save_path)
+        # cleared zips were unzipped already, skip them before any request
+        if not verify or size == 0:
+            return None
+        expected_sha256 = download_checksum(url)
+        if expected_sha256 is None:
+            return None
+        if manifest.sha256_file(save_path) == expected_sha256:
+            return filename, size, expected_sha256
+        _logger.warning(f"Checksum mismatch for existing {save_path}, downloading again")
+    elif verify:
+        expected_sha256 = download_checksum(url)
     os.makedirs(save_dir, exist_ok=True)
-    data = download(url)
-    if url.endswith(".zip"):
-        if not zipper.is_valid_zip(data):
-            _logger.error(f"Invalid zip file: {url}")
-            raise Exception(f"Invalid zip file: {url}")
-    with open(save_path, 'wb') as f:
-        f.write(data)
+    if stream:
+        download_to_file(url, save_path, expected_sha256=expected_sha256)
+    else:
+        data = download(url)
+        if expected_sha256 is not None:
+            if hashlib.sha256(data).hexdigest() != expected_sha256:
+                _logger.error(f"Checksum mismatch: {url}")
+                raise Exception(f"Checksum mismatch: {url}")
+        elif url.endswith(".zip"):
+            if not zipper.is_valid_zip(data):
+                _logger.error(f"Invalid zip file: {url}")
+                raise Exception(f"Invalid zip file: {url}")
+        with open(save_path, 'wb') as f:
+            f.write(data)
+    catalog.record_file(save_path)
+    if expected_sha256 is None:
+        return None
+    return filename, os.path.getsize(save_path), expected_sha256
         
 
-def _download_save_wrapper(url: str,save_dir: str,check_exists: bool = True) -> str:
+def _download_save_wrapper(url: str, save_dir: str, check_exists: bool = True, stream: bool = True, verify: bool = False) -> tuple[str | None, tuple[str, int, str] | None]:
     try:
         _logger.debug(f"Downloading {url}")
-        download_save(url, save_dir, check_exists)
+        entry = download_save(url, save_dir, check_exists, stream, verify)
         _logger.debug(f"Downloaded {url}")
-        return None
+        return None, entry
     except Exception:
         _logger.error(f"Failed to download {url}")
-        return url
+        return url, None
         
 
 def multi_proc_download_save(
         urls: list[str],
         save_dir: str,
         check_exists: bool = True,
-        max_workers: int = config.max_workers
+        max_workers: int = config.max_workers,
+        stream: bool = True,
+        verify: bool = False,
     ) -> list[str]:
+    if verify and check_exists:
+        # files in the manifest were verified by an earlier run, skip them without hashing
+        verified = manifest.load_manifest(save_dir)
+        urls = [url for url in urls if not manifest.is_verified(verified, os.path.join(save_dir, urlparse(url).path.split('/')[-1]))]
     with Pool(processes=max_workers) as pool:
-        undownloads = pool.starmap(_download_save_wrapper, [(url, save_dir, check_exists) for url in urls])
-    return [url for url in undownloads if url]
+        results = pool.starmap(_download_save_wrapper, [(url, save_dir, check_exists, stream, verify) for url in urls])
+    manifest.append_manifest(save_dir, [entry for _, entry in results if entry])
+    return [url for url, _ in results if url]
 
 
 def multi_proc_download_save_until_success(
@@ -60,10 +184,12 @@ def multi_proc_download_save_until_success(
         save_dir: str,
         check_exists: bool = True,
         max_workers: int = config.max_workers,
+        stream: bool = True,
+        verify: bool = False,
     ) -> None:
     undownloaded_urls = urls
     while undownloaded_urls:
-        undownloaded_urls = multi_proc_download_save(undownloaded_urls, save_dir, check_exists, max_workers)
+        undownloaded_urls = multi_proc_download_save(undownloaded_urls, save_dir, check_exists, max_workers, stream, verify)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,432 @@
+import argparse
+import datetime
+import functools
+import hashlib
+import io
+import json
+import logging
+import random
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import zipfile
+import zlib
+
+import numpy as np
+
+from enums import SymbolType
+
+_logger = logging.getLogger(__name__)
+
+_one_day_ms = 24 * 60 * 60 * 1000
+
+_interval_ms = {
+    "1s": 1000,
+    "1m": 60 * 1000,
+    "3m": 3 * 60 * 1000,
+    "5m": 300 * 1000,
+    "15m": 900 * 1000,
+    "30m": 1800 * 1000,
+    "1h": 3600 * 1000,
+    "2h": 2 * 3600 * 1000,
+    "4h": 14400 * 1000,
+    "6h": 6 * 3600 * 1000,
+    "8h": 8 * 3600 * 1000,
+    "12h": 12 * 3600 * 1000,
+}
+
+# rest path prefix of each market and the weight binance charges for one call
+_rest_markets = {
+    "/api/v3/": SymbolType.SPOT,
+    "/fapi/v1/": SymbolType.FUTURES_UM,
+    "/dapi/v1/": SymbolType.FUTURES_CM,
+}
+_rest_weights = {
+    (SymbolType.SPOT, "aggTrades"): 4,
+    (SymbolType.SPOT, "klines"): 2,
+    (SymbolType.FUTURES_UM, "aggTrades"): 20,
+    (SymbolType.FUTURES_UM, "klines"): 5,
+    (SymbolType.FUTURES_CM, "aggTrades"): 20,
+    (SymbolType.FUTURES_CM, "klines"): 5,
+}
+
+_futures_agg_trades_header = "agg_trade_id,price,quantity,first_trade_id,last_trade_id,transact_time,is_buyer_maker"
+_futures_klines_header = "open_time,open,high,low,close,volume,close_time,quote_volume,count,taker_buy_volume,taker_buy_quote_volume,ignore"
+
+
+class FakeDataset:
+    """
+    Deterministic synthetic daily aggTrades and klines of a few symbols.
+
+    Every day is generated from a seed, so the Vision archives, their checksums
+    and the REST answers stay the same across runs and processes. Agg trade ids
+    are dense over the whole date range, like on binance.
+
+    A Vision archive is a "bad day" with probability hole_rate: a block of its
+    trades or klines is left out of the archive while the REST endpoints still
+    serve it, so the missing data backfill has work to do.
+    """
+    def __init__(
+            self,
+            symbols: list[str],
+            start_date: str,
+            days: int,
+            trades_per_day: int = 20000,
+            hole_rate: float = 0.0,
+            seed: int = 0,
+        ) -> None:
+        self.symbols = symbols
+        self.start = datetime.datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+        self.days = days
+        self.trades_per_day = trades_per_day
+        self.hole_rate = hole_rate
+        self.seed = seed
+        self.start_ms = int(self.start.timestamp() * 1000)
+
+    @property
+    def dates(self) -> list[str]:
+        return [(self.start + datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(self.days)]
+
+    def _rng(self, *key: object) -> np.random.Generator:
+        return np.random.default_rng(zlib.crc32("|".join(str(k) for k in (self.seed, *key)).encode()))
+
+    def _day_index(self, date: str) -> int:
+        return self.dates.index(date)
+
+    @functools.lru_cache(maxsize=64)
+    def agg_trades(self, syb_type: SymbolType, symbol: str, day_index: int) -> dict[str, np.ndarray]:
+        """All trades of one day as columns a, p, q, f, l, T, m."""
+        rng = self._rng("aggTrades", syb_type.value, symbol, day_index)
+        n = self.trades_per_day
+        first_id = day_index * n + 1
+        base_price = 10.0 + zlib.crc32(symbol.encode()) % 1000
+        return {
+            "a": np.arange(first_id, first_id + n, dtype=np.int64),
+            "p": np.round(base_price * np.exp(np.cumsum(rng.normal(0, 1e-4, n))), 2),
+            "q": np.round(rng.uniform(0.001, 5.0, n), 3),
+            "f": np.arange(first_id, first_id + n, dtype=np.int64) * 2,
+            "l": np.arange(first_id, first_id + n, dtype=np.int64) * 2 + rng.integers(0, 2, n),
+            "T": self.start_ms + day_index * _one_day_ms + np.sort(rng.integers(0, _one_day_ms, n)),
+            "m": rng.random(n) < 0.5,
+        }
+
+    @functools.lru_cache(maxsize=64)
+    def klines(self, syb_type: SymbolType, symbol: str, interval: str, day_index: int) -> dict[str, np.ndarray]:
+        """All klines of one day, keyed by csv_util.klines_headers names."""
+        rng = self._rng("klines", syb_type.value, symbol, interval, day_index)
+        interval_ms = _interval_ms[interval]
+        n = _one_day_ms // interval_ms
+        base_price = 10.0 + zlib.crc32(symbol.encode()) % 1000
+        close = np.round(base_price * np.exp(np.cumsum(rng.normal(0, 1e-3, n))), 2)
+        open_ = np.r_[close[0], close[:-1]]
+        volume = np.round(rng.uniform(0.0, 50.0, n), 3)
+        taker_buy = np.round(volume * rng.uniform(0.0, 1.0, n), 3)
+        open_time = self.start_ms + day_index * _one_day_ms + interval_ms * np.arange(n, dtype=np.int64)
+        return {
+            "openTime": open_time,
+            "openPrice": open_,
+            "highPrice": np.round(np.maximum(open_, close) * (1 + rng.uniform(0, 1e-3, n)), 2),
+            "lowPrice": np.round(np.minimum(open_, close) * (1 - rng.uniform(0, 1e-3, n)), 2),
+            "closePrice": close,
+            "volume": volume,
+            "closeTime": open_time + interval_ms - 1,
+            "quoteAssetVolume": np.round(volume * close, 4),
+            "tradesNumber": rng.integers(1, 100, n),
+            "takerBuyBaseAssetVolume": taker_buy,
+            "takerBuyQuoteAssetVolume": np.round(taker_buy * close, 4),
+        }
+
+    def _hole(self, kind: str, syb_type: SymbolType, symbol: str, day_index: int, n: int) -> slice:
+        rng = self._rng("hole", kind, syb_type.value, symbol, day_index)
+        if rng.random() >= self.hole_rate:
+            return slice(0, 0)
+        start = int(rng.integers(1, n - 1))
+        return slice(start, min(n - 1, start + int(rng.integers(1, max(2, n // 10)))))
+
+    def agg_trades_csv(self, syb_type: SymbolType, symbol: str, day_index: int) -> str:
+        t = self.agg_trades(syb_type, symbol, day_index)
+        keep = np.ones(len(t["a"]), dtype=bool)
+        keep[self._hole("aggTrades", syb_type, symbol, day_index, len(keep))] = False
+        columns = [t[k][keep].tolist() for k in ("a", "p", "q", "f", "l", "T", "m")]
+        if syb_type == SymbolType.SPOT:
+            # spot archives have no header and an extra isBestMatch column
+            rows = [f"{a},{p},{q},{f},{l},{ts},{m},True" for a, p, q, f, l, ts, m in zip(*columns)]
+        else:
+            rows = [_futures_agg_trades_header]
+            rows += [f"{a},{p},{q},{f},{l},{ts},{str(m).lower()}" for a, p, q, f, l, ts, m in zip(*columns)]
+        return "\n".join(rows) + "\n"
+
+    def klines_csv(self, syb_type: SymbolType, symbol: str, interval: str, day_index: int) -> str:
+        k = self.klines(syb_type, symbol, interval, day_index)
+        keep = np.ones(len(k["openTime"]), dtype=bool)
+        keep[self._hole("klines", syb_type, symbol, day_index, len(keep))] = False
+        columns = [v[keep].tolist() for v in k.values()]
+        rows = [] if syb_type == SymbolType.SPOT else [_futures_klines_header]
+        rows += [",".join(str(x) for x in row) + ",0" for row in zip(*columns)]
+        return "\n".join(rows) + "\n"
+
+    def vision_keys(self, prefix: str) -> list[str]:
+        """Keys of the archives and checksum files directly under prefix."""
+        parts = prefix.strip("/").split("/")
+        if len(parts) < 5 or parts[0] != "data":
+            return []
+        market, rest = ("/".join(parts[1:3]), parts[3:]) if parts[1] == "futures" else (parts[1], parts[2:])
+        if rest[:1] != ["daily"] or len(rest) < 3 or rest[2] not in self.symbols:
+            return []
+        kind, symbol = rest[1], rest[2]
+        if kind == "aggTrades" and len(rest) == 3:
+            stems = [f"{symbol}-aggTrades-{date}" for date in self.dates]
+        elif kind == "klines" and len(rest) == 4 and rest[3] in _interval_ms:
+            stems = [f"{symbol}-{rest[3]}-{date}" for date in self.dates]
+        else:
+            return []
+        if market not in [t.value for t in SymbolType]:
+            return []
+        base = "/".join(parts) + "/"
+        return sorted(key for stem in stems for key in (f"{base}{stem}.zip", f"{base}{stem}.zip.CHECKSUM"))
+
+    @functools.lru_cache(maxsize=256)
+    def vision_zip(self, key: str) -> bytes | None:
+        """Zip archive of a key returned by vision_keys, None if there is no such archive."""
+        if not key.endswith(".zip") or key not in self.vision_keys(key.rsplit("/", 1)[0]):
+            return None
+        parts = key.split("/")
+        syb_type = SymbolType("/".join(parts[1:3]) if parts[1] == "futures" else parts[1])
+        stem = parts[-1][:-len(".zip")]
+        symbol = stem.split("-")[0]
+        day_index = self._day_index(stem[-len("yyyy-mm-dd"):])
+        if "-aggTrades-" in stem:
+            text = self.agg_trades_csv(syb_type, symbol, day_index)
+        else:
+            text = self.klines_csv(syb_type, symbol, stem.split("-")[1], day_index)
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr(stem + ".csv", text)
+        return buffer.getvalue()
+
+    def rest_agg_trades(self, syb_type: SymbolType, symbol: str, from_id: int, limit: int) -> list[dict]:
+        trades = []
+        day_index = max(0, (from_id - 1) // self.trades_per_day)
+        while len(trades) < limit and day_index < self.days:
+            t = self.agg_trades(syb_type, symbol, day_index)
+            i = max(0, from_id - int(t["a"][0]))
+            for a, p, q, f, l, ts, m in zip(*(t[k][i:i + limit - len(trades)].tolist() for k in ("a", "p", "q", "f", "l", "T", "m"))):
+                trade = {"a": a, "p": f"{p:.8f}", "q": f"{q:.8f}", "f": f, "l": l, "T": ts, "m": m}
+                if syb_type == SymbolType.SPOT:
+                    trade["M"] = True
+                trades.append(trade)
+            day_index += 1
+        return trades
+
+    def rest_klines(self, syb_type: SymbolType, symbol: str, interval: str, start_time: int, end_time: int | None, limit: int) -> list[list]:
+        klines = []
+        day_index = max(0, (start_time - self.start_ms) // _one_day_ms)
+        while len(klines) < limit and day_index < self.days:
+            k = self.klines(syb_type, symbol, interval, day_index)
+            i = int(np.searchsorted(k["openTime"], start_time))
+            for row in zip(*(v[i:i + limit - len(klines)].tolist() for v in k.values())):
+                if end_time is not None and row[0] > end_time:
+                    return klines
+                klines.append([row[0], *(f"{x:.8f}" for x in row[1:6]), row[6], f"{row[7]:.8f}", row[8], f"{row[9]:.8f}", f"{row[10]:.8f}", "0"])
+            day_index += 1
+        return klines
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "FakeBinanceServer"
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args: object) -> None:
+        _logger.debug(format % args)
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/octet-stream", headers: dict | None = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, obj: object, headers: dict | None = None) -> None:
+        self._send(status, json.dumps(obj).encode(), "application/json", headers)
+
+    def do_GET(self) -> None:
+        server = self.server
+        if server.latency > 0:
+            time.sleep(server.latency)
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if server.roll(server.error_rate):
+            self._send_json(500, {"code": -1000, "msg": "injected error"})
+            return
+        for rest_prefix, syb_type in _rest_markets.items():
+            if url.path.startswith(rest_prefix):
+                self._rest(syb_type, url.path[len(rest_prefix):], query)
+                return
+        if url.path.rstrip("/") == "/data.binance.vision":
+            self._listing(query)
+        elif url.path.startswith("/data/"):
+            self._vision_file(url.path.lstrip("/"))
+        else:
+            self._send(404, b"not found")
+
+    def _listing(self, query: dict[str, str]) -> None:
+        prefix = query.get("prefix", "")
+        marker = query.get("marker", "")
+        keys = [key for key in self.server.dataset.vision_keys(prefix) if key > marker]
+        page = keys[:self.server.max_keys]
+        truncated = len(keys) > len(page)
+        xml = ['<?xml version="1.0" encoding="UTF-8"?>',
+               '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">',
+               f"<Name>data.binance.vision</Name><Prefix>{prefix}</Prefix><Marker>{marker}</Marker>"]
+        if truncated:
+            xml.append(f"<NextMarker>{page[-1]}</NextMarker>")
+        xml.append(f"<MaxKeys>{self.server.max_keys}</MaxKeys><Delimiter>/</Delimiter><IsTruncated>{str(truncated).lower()}</IsTruncated>")
+        for key in page:
+            xml.append(f"<Contents><Key>{key}</Key><StorageClass>STANDARD</StorageClass></Contents>")
+        xml.append("</ListBucketResult>")
+        self._send(200, "".join(xml).encode(), "application/xml")
+
+    def _vision_file(self, key: str) -> None:
+        dataset = self.server.dataset
+        if key.endswith(".CHECKSUM"):
+            data = dataset.vision_zip(key[:-len(".CHECKSUM")])
+            if data is None:
+                self._send(404, b"not found")
+                return
+            name = key[:-len(".CHECKSUM")].rsplit("/", 1)[-1]
+            self._send(200, f"{hashlib.sha256(data).hexdigest()}  {name}\n".encode(), "text/plain")
+            return
+        data = dataset.vision_zip(key)
+        if data is None:
+            self._send(404, b"not found")
+            return
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and range_header.endswith("-"):
+            start = int(range_header[len("bytes="):-1])
+            if start >= len(data):
+                self._send(416, b"", headers={"Content-Range": f"bytes */{len(data)}"})
+                return
+            self._send(206, data[start:], "application/zip", {"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"})
+            return
+        self._send(200, data, "application/zip")
+
+    def _rest(self, syb_type: SymbolType, endpoint: str, query: dict[str, str]) -> None:
+        server = self.server
+        if (syb_type, endpoint) not in _rest_weights:
+            self._send_json(404, {"code": -1, "msg": "unknown endpoint"})
+            return
+        if server.roll(server.rate_limit_rate):
+            self._send_json(429, {"code": -1003, "msg": "injected rate limit"}, {"Retry-After": str(server.retry_after)})
+            return
+        used_weight = server.use_weight(syb_type, _rest_weights[(syb_type, endpoint)])
+        headers = {"x-mbx-used-weight-1m": str(used_weight)}
+        symbol = query.get("symbol", "")
+        if symbol not in server.dataset.symbols:
+            self._send_json(400, {"code": -1121, "msg": "Invalid symbol."}, headers)
+            return
+        limit = min(int(query.get("limit", 500)), 1000)
+        if endpoint == "aggTrades":
+            data = server.dataset.rest_agg_trades(syb_type, symbol, int(query.get("fromId", 1)), limit)
+        else:
+            end_time = int(query["endTime"]) if "endTime" in query else None
+            data = server.dataset.rest_klines(syb_type, symbol, query["interval"], int(query.get("startTime", 0)), end_time, limit)
+        self._send_json(200, data, headers)
+
+
+class FakeBinanceServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the Binance Vision bucket listing, the Vision archives
+    and the aggTrades/klines REST endpoints, serving a FakeDataset.
+
+    Latency is added to every request, error_rate of the requests fail with a 500
+    and rate_limit_rate of the REST requests get a 429 with Retry-After. Point
+    config at it with the variables of env(), set before config is imported.
+    They include a work dir of its own, a new temporary directory unless
+    work_dir is given, so synthetic files never land in the real one.
+    """
+    daemon_threads = True
+
+    def __init__(
+            self,
+            dataset: FakeDataset,
+            host: str = "127.0.0.1",
+            port: int = 0,
+            latency: float = 0.0,
+            error_rate: float = 0.0,
+            rate_limit_rate: float = 0.0,
+            retry_after: int = 1,
+            max_keys: int = 1000,
+            seed: int = 0,
+            work_dir: str | None = None,
+        ) -> None:
+        super().__init__((host, port), _Handler)
+        self.dataset = dataset
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.max_keys = max_keys
+        self.work_dir = work_dir if work_dir is not None else tempfile.mkdtemp(prefix="fake_binance_")
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._weights: dict[SymbolType, tuple[int, int]] = {}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def env(self) -> dict[str, str]:
+        return {
+            "BINANCE_WORK_DIR": self.work_dir,
+            "BINANCE_VISION_LISTING_URL": f"{self.base_url}/data.binance.vision",
+            "BINANCE_VISION_DATA_URL": self.base_url,
+            "BINANCE_SPOT_REST_URL": self.base_url,
+            "BINANCE_UM_REST_URL": self.base_url,
+            "BINANCE_CM_REST_URL": self.base_url,
+        }
+
+    def roll(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def use_weight(self, syb_type: SymbolType, weight: int) -> int:
+        minute = int(time.time() // 60)
+        with self._lock:
+            last_minute, used = self._weights.get(syb_type, (minute, 0))
+            used = used + weight if last_minute == minute else weight
+            self._weights[syb_type] = (minute, used)
+            return used
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a synthetic Binance Vision and REST api")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--symbols", default="BTCUSDT")
+    parser.add_argument("--start-date", default="2024-01-01")
+    parser.add_argument("--days", type=int, default=3)
+    parser.add_argument("--trades-per-day", type=int, default=20000)
+    parser.add_argument("--hole-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--work-dir", default=None, help="Work dir for the clients, a new temporary directory by default")
+    args = parser.parse_args()
+
+    dataset = FakeDataset(args.symbols.split(","), args.start_date, args.days, args.trades_per_day, args.hole_rate)
+    server = FakeBinanceServer(dataset, args.host, args.port, args.latency, args.error_rate, args.rate_limit_rate, work_dir=args.work_dir)
+    for k, v in server.env().items():
+        print(f"export {k}={v}")
+    server.serve_forever()
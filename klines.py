@@ -1,6 +1,8 @@
 import datetime
 import os
+import catalog
 import config
+import csv_util
 from enums import SymbolType
 import klines_checker
 import raw_downloader
@@ -19,6 +21,7 @@ def download(
     unzip_root_dir: str = config.unzip_binance_vision_dir,
     missing_root_dir: str = config.missing_binance_vision_dir,
     tidy_root_dir: str = config.tidy_binance_vision_dir,
+    unzip_format: str = "csv",
     max_workers: int = config.max_workers,
     ) -> None:
     
@@ -38,6 +41,7 @@ def download(
         unzip_root_dir: Directory to store unzipped raw data
         missing_root_dir: Directory to store downloaded missing data
         tidy_root_dir: Directory to store final merged/tidy data
+        unzip_format: "csv" to unzip raw files, "parquet" to convert zips straight to parquet
         max_workers: Number of parallel processes to use
     
     Raises:
@@ -59,10 +63,8 @@ def download(
     
     # Get last file date from tidy dir
     last_file_date = None
-    file_names = os.listdir(tidy_dir)
-    if file_names:
-        file_names.sort()
-        last_file_name = file_names[-1]
+    last_file_name = catalog.last_file_name(tidy_dir, csv_util.data_file_exts)
+    if last_file_name:
         last_file_date = last_file_name.split(f"{symbol}-{interval}-")[1].split(".")[0]
         if start_date == "":
             start_date = last_file_date
@@ -82,7 +84,10 @@ def download(
         
     raw_downloader.multi_proc_download(prefix, marker, zip_dir, max_workers=max_workers)
     
-    raw_unzipper.multi_proc_unzip_one_dir_files_to_dir(zip_dir, unzip_dir, max_workers=max_workers)
+    if unzip_format == "parquet":
+        raw_unzipper.multi_proc_unzip_one_dir_files_to_parquet(zip_dir, unzip_dir, csv_util.klines_headers, max_workers=max_workers)
+    else:
+        raw_unzipper.multi_proc_unzip_one_dir_files_to_dir(zip_dir, unzip_dir, max_workers=max_workers)
 
     klines_checker.multi_proc_tidy_klines(
         syb_type, symbol, interval,
@@ -101,16 +106,14 @@ def download(
     #     logger.error(result)
     #     raise ValueError("Tidied klines not continuous")
 
-    file_names = os.listdir(tidy_dir)
-    if file_names:
-        file_names.sort()
-        last_file_name = file_names[-1]
+    last_file_name = catalog.last_file_name(tidy_dir, csv_util.data_file_exts)
+    if last_file_name:
         last_file_date = last_file_name.split(f"{symbol}-{interval}-")[1].split(".")[0]
         last_file_time = datetime.datetime.strptime(last_file_date, "%Y-%m-%d") - datetime.timedelta(days=2)
         last_file_date = last_file_time.strftime("%Y-%m-%d")
-        last_file_name = f"{symbol}-{interval}-{last_file_date}.csv"
-        file_names = os.listdir(unzip_dir)
-        file_names = [f for f in file_names if f <= last_file_name]
+        last_file_stem = f"{symbol}-{interval}-{last_file_date}"
+        file_names = catalog.list_file_names(unzip_dir)
+        file_names = [f for f in file_names if os.path.splitext(f)[0] <= last_file_stem]
         for file_name in file_names:
             raw_unzipper.clear_file(os.path.join(unzip_dir, file_name))
             logger.info(f"Cleared {os.path.join(unzip_dir, file_name)}")
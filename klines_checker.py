@@ -1,14 +1,17 @@
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from dataclasses import dataclass
 import datetime
 import logging
 from multiprocessing import Pool
 import os
+import numpy as np
 import pandas as pd
 
 import api_downloader
+import catalog
 import config
-from csv_util import klines_headers, csv_to_pandas
+from csv_util import klines_headers, csv_to_pandas, data_file_exts, read_file_to_pandas
 from enums import SymbolType
 
 logging.basicConfig(level=logging.INFO)
@@ -53,11 +56,49 @@ map_interval_to_interval_ms = {
 class OneKlineFileCheckResult:
     empty: bool
     file_path: str
-    invalid_ts: list[int]
+    # missing klines as ranges, open time of the first missing kline and number of missing klines
+    missing_starts: np.ndarray
+    missing_counts: np.ndarray
     first_open_time: int
     last_open_time: int
+    interval_ms: int
+
+    @property
+    def invalid_ts(self) -> list[int]:
+        """Open times of every missing kline, expanded from the ranges."""
+        return expand_missing_ranges(self.missing_starts, self.missing_counts, self.interval_ms).tolist()
+
+
+def expand_missing_ranges(starts: np.ndarray, counts: np.ndarray, interval_ms: int) -> np.ndarray:
+    """
+    Expand (start, count) ranges into the open time of every missing kline.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    offsets = np.arange(counts.sum(), dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64), counts) + offsets * interval_ms
+
+
+def merge_missing_ranges(starts: np.ndarray, counts: np.ndarray, interval_ms: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Sort ranges and merge the ones that overlap or touch.
+
+    Returns:
+        (starts, counts) of the merged ranges
+    """
+    if len(starts) == 0:
+        return np.asarray(starts, dtype=np.int64), np.asarray(counts, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    starts = np.asarray(starts, dtype=np.int64)[order]
+    ends = starts + np.asarray(counts, dtype=np.int64)[order] * interval_ms
+    # a range starts a new group unless it begins at or before the furthest end so far
+    furthest_ends = np.maximum.accumulate(ends)
+    new_group = np.r_[True, starts[1:] > furthest_ends[:-1]]
+    group_starts = starts[new_group]
+    group_ends = np.maximum.reduceat(ends, np.flatnonzero(new_group))
+    return group_starts, (group_ends - group_starts) // interval_ms
+
     
-    
+
 def tidy_klines_df(df: pd.DataFrame) -> pd.DataFrame:
     if len(str(int(df["openTime"].iloc[0]))) == 16:
         df["openTime"] = df["openTime"] // 1000
@@ -72,67 +113,61 @@ def handle_empty_klines_file(klines_file_path: str, interval_seconds: int) -> On
     file_time = datetime.datetime.strptime(file_date, "%Y-%m-%d")
     first_open_time = int(file_time.timestamp() * 1000)
     last_open_time = int((file_time + datetime.timedelta(days=1) - datetime.timedelta(seconds=interval_seconds)).timestamp() * 1000)
-    invalid_ts = []
-    for i in range(first_open_time, last_open_time+interval_ms, interval_ms):
-        invalid_ts.append(i)
     return OneKlineFileCheckResult(
         empty=True,
         file_path=klines_file_path,
-        invalid_ts=invalid_ts,
+        missing_starts=np.array([first_open_time], dtype=np.int64),
+        missing_counts=np.array([(last_open_time - first_open_time) // interval_ms + 1], dtype=np.int64),
         first_open_time=first_open_time,
         last_open_time=last_open_time,
+        interval_ms=interval_ms,
     )
 
 
 def check_one_file_klines(klines_file_path: str, interval_seconds: int) -> OneKlineFileCheckResult:
     interval_ms = interval_seconds * 1000
-    invalid_ts: list[int] = []
-    with open(klines_file_path, "r") as f:
-        df = csv_to_pandas(f, klines_headers)
+    df = read_file_to_pandas(klines_file_path, klines_headers)
+    
+    if df.empty:
+        _logger.warning(f"File {klines_file_path} is empty")
+        return handle_empty_klines_file(klines_file_path, interval_seconds)
         
-        if df.empty:
-            _logger.warning(f"File {klines_file_path} is empty")
-            return handle_empty_klines_file(klines_file_path, interval_seconds)
-            
-        df = tidy_klines_df(df)
+    df = tidy_klines_df(df)
 
-        df["openTime"] = pd.to_numeric(df["openTime"])
-        df["closeTime"] = pd.to_numeric(df["closeTime"])
+    df["openTime"] = pd.to_numeric(df["openTime"])
+    df["closeTime"] = pd.to_numeric(df["closeTime"])
 
-        df.sort_values(by="openTime", inplace=True)
-        df.drop_duplicates(subset="openTime", keep="first", inplace=True)
-        
-        # Drop rows where openTime is not a multiple of the interval
-        df = df[df["openTime"] % interval_ms == 0]
-
-        # Drop rows with invalid intervals
-        time_diffs = df["closeTime"] - df["openTime"]
-        expected_diff = interval_ms - 1
-        df = df[time_diffs == expected_diff]
-
-        if df.empty:
-            _logger.warning(f"File {klines_file_path} is empty")
-            return handle_empty_klines_file(klines_file_path, interval_seconds)
-
-        # check if openTime is consistent with closeTime
-        expected_open_times = df["closeTime"].shift(1) + 1
-        expected_open_times.iloc[0] = df["openTime"].iloc[0]
-        diffs = df["openTime"] - expected_open_times
-        for i, diff in enumerate(diffs):
-            if diff == 0:
-                continue
-            op = int(expected_open_times.iloc[i])
-            for o in range(op, op + int(diff), interval_ms):
-                invalid_ts.append(int(o))
-
-        return OneKlineFileCheckResult(
-            empty=False,
-            file_path=klines_file_path,
-            invalid_ts=invalid_ts,
-            first_open_time=int(df["openTime"].iloc[0]),
-            last_open_time=int(df["openTime"].iloc[-1])
-        )
-        
+    df.sort_values(by="openTime", inplace=True)
+    df.drop_duplicates(subset="openTime", keep="first", inplace=True)
+    
+    # Drop rows where openTime is not a multiple of the interval
+    df = df[df["openTime"] % interval_ms == 0]
+
+    # Drop rows with invalid intervals
+    time_diffs = df["closeTime"] - df["openTime"]
+    expected_diff = interval_ms - 1
+    df = df[time_diffs == expected_diff]
+
+    if df.empty:
+        _logger.warning(f"File {klines_file_path} is empty")
+        return handle_empty_klines_file(klines_file_path, interval_seconds)
+
+    # check if openTime is consistent with closeTime of the kline before
+    open_times = df["openTime"].to_numpy(dtype=np.int64)
+    expected_open_times = df["closeTime"].to_numpy(dtype=np.int64)[:-1] + 1
+    diffs = open_times[1:] - expected_open_times
+    gaps = np.flatnonzero(diffs != 0)
+
+    return OneKlineFileCheckResult(
+        empty=False,
+        file_path=klines_file_path,
+        missing_starts=expected_open_times[gaps],
+        missing_counts=diffs[gaps] // interval_ms,
+        first_open_time=int(open_times[0]),
+        last_open_time=int(open_times[-1]),
+        interval_ms=interval_ms,
+    )
+    
 
 def multi_proc_check_one_symbol_klines(
         syb_type: SymbolType, 
@@ -146,18 +181,18 @@ def multi_proc_check_one_symbol_klines(
     prefix = f"data/{syb_type.value}/daily/klines/{symbol}/{interval}"
     klines_dir = os.path.join(klines_root_dir, prefix)
     interval_seconds = map_interval_to_interval_ms[interval] // 1000
+    # compare file stems, raw files may be csv or parquet
     if start_date:
-        start_file_name = f"{symbol}-{interval}-{start_date}.csv"
+        start_stem = f"{symbol}-{interval}-{start_date}"
     else:
-        start_file_name = ""    
+        start_stem = ""    
     if end_date:
-        end_file_name = f"{symbol}-{interval}-{end_date}.csv"
+        end_stem = f"{symbol}-{interval}-{end_date}"
     else:
-        end_file_name = f"{symbol}-{interval}-{datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')}.csv"
+        end_stem = f"{symbol}-{interval}-{datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%d')}"
 
-    file_names = os.listdir(klines_dir)
-    file_names = [f for f in file_names if start_file_name <= f <= end_file_name]
-    file_names.sort()
+    file_names = [f for f in catalog.list_file_names(klines_dir, data_file_exts)
+                  if start_stem <= os.path.splitext(f)[0] <= end_stem]
 
     with Pool(max_workers) as pool:
         check_results = pool.starmap(check_one_file_klines, [(os.path.join(klines_dir, f), interval_seconds) for f in file_names])
@@ -169,35 +204,45 @@ def multi_proc_check_one_symbol_klines(
     for i, result in enumerate(check_results[1:]):
         last_open_time = check_results[i].last_open_time
         missing_num = (result.first_open_time - last_open_time) // interval_ms - 1
-        if missing_num == 0:
+        if missing_num <= 0:
             continue
         
-        for j in range(missing_num):
-            result.invalid_ts.append(last_open_time + (j + 1) * interval_ms)
+        result.missing_starts = np.r_[last_open_time + interval_ms, result.missing_starts]
+        result.missing_counts = np.r_[missing_num, result.missing_counts]
 
-    return [r for r in check_results if r.invalid_ts]
+    return [r for r in check_results if r.missing_counts.sum() > 0]
 
 
 def download_missing_klines_and_save(
     syb_type: SymbolType,
     symbol: str,
     interval: str,
-    missing_ts: list[int],
+    missing_starts: np.ndarray,
+    missing_counts: np.ndarray,
     missing_root_dir: str=config.missing_binance_vision_dir,
-    check_file_exists: bool=True
+    check_file_exists: bool=True,
+    max_in_flight: int=config.max_in_flight_rest_requests
     ) -> None:
-    if not missing_ts:
+    """
+    Download missing klines from the API and save them by date.
+
+    Args:
+        missing_starts: Open time of the first missing kline of each range
+        missing_counts: Number of missing klines of each range, touching ranges
+        are merged and downloaded with one paged request
+        max_in_flight: Number of ranges downloaded at the same time, the shared
+        weight budget of api_downloader decides how fast they actually go
+    """
+    if len(missing_starts) == 0:
         return
     interval_ms = map_interval_to_interval_ms[interval]
-    groups = []
-    for i in range(len(missing_ts)):
-        if i == 0 or missing_ts[i] != missing_ts[i-1] + interval_ms:
-            groups.append([missing_ts[i]])
-        else:
-            groups[-1].append(missing_ts[i])
+    starts, counts = merge_missing_ranges(missing_starts, missing_counts, interval_ms)
     klines = []
-    for group in groups:
-        klines.extend(api_downloader.download_klines(syb_type, symbol, interval, group[0], group[-1]))
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for ks in executor.map(
+                lambda r: api_downloader.download_klines(syb_type, symbol, interval, r[0], r[0] + (r[1] - 1) * interval_ms),
+                zip(starts.tolist(), counts.tolist())):
+            klines.extend(ks)
 
     klines.sort(key=lambda x: x[0])
 
@@ -254,6 +299,7 @@ def download_missing_klines_and_save(
                     klines_headers[11]: kline[11]
                 })
             writer.writerows(rows)
+        catalog.record_file(filepath, rows=len(rows), first_time=rows[0][klines_headers[0]], last_time=rows[-1][klines_headers[0]])
     
     
 def merge_raw_and_missing_klines(
@@ -263,24 +309,25 @@ def merge_raw_and_missing_klines(
     save_dir: str=config.tidy_binance_vision_dir,
     check_file_exists: bool = True
     ) -> None:
-    # save as parquet
-    tidy_path = os.path.join(save_dir, file_name.replace(".csv", ".parquet"))
+    # save as parquet, raw file may be csv or parquet, missing file is csv
+    stem = os.path.splitext(file_name)[0]
+    tidy_path = os.path.join(save_dir, stem + ".parquet")
     if check_file_exists and os.path.exists(tidy_path):
         _logger.info(f"Tidy file {tidy_path} already exists, skipping")
         return
     
     raw_path = os.path.join(raw_dir, file_name)
-    with open(raw_path, "r") as f:
-        raw_df = csv_to_pandas(f, klines_headers)
+    raw_df = read_file_to_pandas(raw_path, klines_headers)
     if raw_df.empty:
         _logger.warning(f"Raw file {raw_path} is empty, skipping merge and save.")
         return
     raw_df = tidy_klines_df(raw_df)
         
-    missing_path = os.path.join(missing_dir, file_name)
+    missing_path = os.path.join(missing_dir, stem + ".csv")
     if not os.path.exists(missing_path):
         _logger.info(f"No missing klines file for {file_name}, copying raw file to tidy file")
         raw_df.to_parquet(tidy_path, engine="pyarrow")
+        catalog.record_frame(tidy_path, raw_df, None, "openTime")
         _logger.info(f"Saved raw klines to {tidy_path}")
         return
     
@@ -297,6 +344,7 @@ def merge_raw_and_missing_klines(
     merged_df.drop_duplicates(subset="openTime", keep="first", inplace=True)
 
     merged_df.to_parquet(tidy_path, engine="pyarrow")
+    catalog.record_frame(tidy_path, merged_df, None, "openTime")
 
     _logger.info(f"Saved merged klines to {tidy_path}")
     
@@ -318,18 +366,22 @@ def multi_proc_merge_one_symbol_raw_and_missing_klines(
     missing_dir = os.path.join(missing_root_dir, prefix)
     save_dir = os.path.join(tidy_root_dir, prefix)
     if start_date:
-        start_file_name = f"{symbol}-{interval}-{start_date}.csv"
+        start_stem = f"{symbol}-{interval}-{start_date}"
     else:
-        start_file_name = ""
+        start_stem = ""
     if end_date:
-        end_file_name = f"{symbol}-{interval}-{end_date}.csv"
+        end_stem = f"{symbol}-{interval}-{end_date}"
     else:
         tidy_end_date = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=2)
-        end_file_name = f"{symbol}-{interval}-{tidy_end_date.strftime('%Y-%m-%d')}.csv"
+        end_stem = f"{symbol}-{interval}-{tidy_end_date.strftime('%Y-%m-%d')}"
+    file_names = [file_name for file_name in catalog.list_file_names(raw_dir, data_file_exts)
+                  if start_stem <= os.path.splitext(file_name)[0] <= end_stem]
+    if check_file_exists:
+        tidy_file_names = set(catalog.list_file_names(save_dir, (".parquet",)))
+        file_names = [file_name for file_name in file_names if os.path.splitext(file_name)[0] + ".parquet" not in tidy_file_names]
     with Pool(processes=max_workers) as pool:
         pool.starmap(merge_raw_and_missing_klines, [(file_name, raw_dir, missing_dir, save_dir, check_file_exists)
-                                                    for file_name in os.listdir(raw_dir) 
-                                                    if start_file_name <= file_name <= end_file_name])
+                                                    for file_name in file_names])
 
     
 def multi_proc_tidy_klines(
@@ -374,11 +426,9 @@ def multi_proc_tidy_klines(
     check_result = multi_proc_check_one_symbol_klines(syb_type, symbol, interval, start_date, end_date, unzip_root_dir, max_workers)
     
     if check_result:
-        missing_ts = []
-        for r in check_result:
-            missing_ts.extend(r.invalid_ts)
-        missing_ts.sort()
-        download_missing_klines_and_save(syb_type, symbol, interval, missing_ts, missing_root_dir, check_file_exists)
+        missing_starts = np.concatenate([r.missing_starts for r in check_result])
+        missing_counts = np.concatenate([r.missing_counts for r in check_result])
+        download_missing_klines_and_save(syb_type, symbol, interval, missing_starts, missing_counts, missing_root_dir, check_file_exists)
     
     multi_proc_merge_one_symbol_raw_and_missing_klines(syb_type, symbol, interval, start_date, end_date, unzip_root_dir, missing_root_dir, tidy_root_dir, check_file_exists, max_workers)
 
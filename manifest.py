@@ -0,0 +1,85 @@
+import hashlib
+import json
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+# 每个下载目录下有一个manifest文件，记录已经通过.CHECKSUM校验的文件
+# 每行一个json: {"name": 文件名, "size": 文件大小, "sha256": 文件sha256}
+manifest_file_name = ".manifest.jsonl"
+
+
+def sha256_file(file_path: str, chunk_size: int = 1024 * 1024) -> str:
+    h = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_checksum(text: str) -> str:
+    """
+    Parse a Binance Vision .CHECKSUM file.
+
+    Args:
+        text: Content like "<sha256>  BTCUSDT-aggTrades-2024-11-19.zip"
+
+    Returns:
+        The lower case sha256 hex digest
+    """
+    return text.split()[0].lower()
+
+
+def load_manifest(save_dir: str) -> dict[str, tuple[int, str]]:
+    """
+    Load the manifest of verified files in save_dir.
+
+    Returns:
+        Dict from file name to (size, sha256), later lines win
+    """
+    path = os.path.join(save_dir, manifest_file_name)
+    manifest: dict[str, tuple[int, str]] = {}
+    if not os.path.exists(path):
+        return manifest
+    with open(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # a run killed mid-write can leave a partial last line
+                _logger.warning(f"Skipping broken manifest line in {path}")
+                continue
+            manifest[entry["name"]] = (entry["size"], entry["sha256"])
+    return manifest
+
+
+def append_manifest(save_dir: str, entries: list[tuple[str, int, str]]) -> None:
+    if not entries:
+        return
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, manifest_file_name)
+    with open(path, "a") as f:
+        for name, size, sha256 in entries:
+            f.write(json.dumps({"name": name, "size": size, "sha256": sha256}) + "\n")
+
+
+def is_verified(manifest: dict[str, tuple[int, str]], file_path: str) -> bool:
+    """
+    Check a file against the manifest without reading it.
+
+    A file passes if its size still equals the verified size. An empty file also
+    passes, because raw_unzipper.clear_file truncates zips after unzipping them.
+    A file of any other size was truncated or replaced and has to be fetched again.
+    """
+    entry = manifest.get(os.path.basename(file_path))
+    if entry is None:
+        return False
+    try:
+        size = os.path.getsize(file_path)
+    except FileNotFoundError:
+        return False
+    return size == entry[0] or size == 0
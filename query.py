@@ -0,0 +1,200 @@
+import datetime
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import agz
+import arrow_cache
+import catalog
+import config
+import csv_util
+from enums import SymbolType
+
+_logger = logging.getLogger(__name__)
+
+MICRO_SECONDS_20000101 = 946684800000000
+ONE_DAY_MS = 24*60*60*1000
+
+
+def _time_column(dataset: str) -> str:
+    return "openTime" if dataset == "klines" else "time"
+
+
+def _to_ms(value: str | datetime.datetime | int) -> int:
+    """Milliseconds since epoch, naive times and dates are UTC."""
+    if isinstance(value, int):
+        return value
+    ts = pd.Timestamp(value)
+    if ts.tzinfo is None:
+        ts = ts.tz_localize("UTC")
+    return ts.value // 1_000_000
+
+
+def _time_bounds(sample_time: int, start_ms: int, end_ms: int) -> tuple[int, int]:
+    # binance old data is in milliseconds, new data is in microseconds
+    ratio = 1000 if sample_time > MICRO_SECONDS_20000101 else 1
+    return start_ms * ratio, end_ms * ratio
+
+
+def _overlaps(first_time: int, last_time: int, start_ms: int, end_ms: int) -> bool:
+    start, end = _time_bounds(first_time, start_ms, end_ms)
+    return last_time >= start and first_time < end
+
+
+def _file_columns(file_path: str, headers: list[str]) -> list[str]:
+    if file_path.endswith(".parquet"):
+        return pq.ParquetFile(file_path).schema_arrow.names
+    if file_path.endswith(".agz"):
+        return agz.read_footer(file_path)["columns"]
+    with open(file_path, "rb") as f:
+        # futures aggTrades files have no isBestMatch column
+        return headers[:f.readline().count(b",") + 1]
+
+
+def _read_day(file_path: str, headers: list[str], columns: list[str] | None, time_column: str, start_ms: int, end_ms: int) -> pa.Table | None:
+    """
+    Rows of one day file with open or trade time in [start_ms, end_ms), only the
+    given columns. Parquet row groups and agz blocks outside the range are skipped
+    by their statistics, csv files are read whole.
+    """
+    if os.path.getsize(file_path) == 0:
+        return None
+    file_columns = _file_columns(file_path, headers)
+    columns = file_columns if columns is None else columns
+    for column in columns:
+        if column not in file_columns:
+            raise ValueError(f"{file_path} has no column {column}, it has {file_columns}")
+    read_columns = columns if time_column in columns else [*columns, time_column]
+
+    if file_path.endswith(".parquet"):
+        pf = pq.ParquetFile(file_path)
+        index = pf.schema_arrow.get_field_index(time_column)
+        row_groups = []
+        for i in range(pf.num_row_groups):
+            stats = pf.metadata.row_group(i).column(index).statistics
+            if stats is None or not stats.has_min_max or _overlaps(stats.min, stats.max, start_ms, end_ms):
+                row_groups.append(i)
+        table = pf.read_row_groups(row_groups, columns=read_columns) if row_groups else None
+    elif file_path.endswith(".agz"):
+        blocks = agz.read_footer(file_path)["blocks"]
+        block_indexes = [i for i, b in enumerate(blocks) if _overlaps(*b["stats"][time_column], start_ms, end_ms)]
+        tables = [pa.table({c: block[c] for c in read_columns}) for block in agz.iter_agg_trades_blocks(file_path, read_columns, block_indexes)]
+        table = pa.concat_tables(tables) if tables else None
+    else:
+        batches = list(csv_util.iter_file_batches(file_path, headers, read_columns))
+        table = pa.Table.from_batches(batches) if batches else None
+
+    if table is None or table.num_rows == 0:
+        return None
+    times = table.column(time_column)
+    start, end = _time_bounds(times[0].as_py(), start_ms, end_ms)
+    table = table.filter(pc.and_(pc.greater_equal(times, start), pc.less(times, end)))
+    return table.select(columns)
+
+
+@dataclass(frozen=True)
+class RangeQuery:
+    """
+    Lazy read of tidy klines or aggTrades over a time range, nothing is read until
+    to_arrow or to_pandas.
+
+    Times are compared in milliseconds, columns come back as stored, so days of
+    spot data since 2025 keep their microsecond times.
+    """
+    syb_type: SymbolType
+    symbol: str
+    dataset: str
+    start_ms: int
+    # exclusive
+    end_ms: int
+    interval: str | None = None
+    columns: tuple[str, ...] | None = None
+    tidy_root_dir: str = config.tidy_binance_vision_dir
+    max_threads: int = config.max_query_threads
+
+    def select(self, *columns: str) -> "RangeQuery":
+        """The same query reading only columns."""
+        return replace(self, columns=columns)
+
+    def files(self) -> list[str]:
+        """Day files overlapping the range, in date order, one format per day like csv_util.find_data_file."""
+        tidy_dir = arrow_cache.dataset_dir(self.tidy_root_dir, self.syb_type, self.symbol, self.dataset, self.interval)
+        first_date = datetime.datetime.fromtimestamp(self.start_ms / 1000, datetime.timezone.utc).strftime("%Y-%m-%d")
+        last_date = datetime.datetime.fromtimestamp((self.end_ms - 1) / 1000, datetime.timezone.utc).strftime("%Y-%m-%d")
+        start_stem = arrow_cache.day_stem(self.symbol, self.dataset, self.interval, first_date)
+        end_stem = arrow_cache.day_stem(self.symbol, self.dataset, self.interval, last_date)
+        names = catalog.file_names_by_stem(tidy_dir, csv_util.data_file_exts)
+        return [os.path.join(tidy_dir, names[stem]) for stem in sorted(names) if start_stem <= stem <= end_stem]
+
+    def to_arrow(self) -> pa.Table:
+        """Read the days in parallel and concatenate them into one contiguous table."""
+        headers = arrow_cache.dataset_headers(self.dataset)
+        columns = None if self.columns is None else list(self.columns)
+        time_column = _time_column(self.dataset)
+        file_paths = self.files()
+        _logger.debug(f"Reading {len(file_paths)} files of {self.symbol} {self.dataset}")
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_threads, len(file_paths)))) as executor:
+            tables = [t for t in executor.map(lambda p: _read_day(p, headers, columns, time_column, self.start_ms, self.end_ms), file_paths) if t is not None]
+        if not tables:
+            dtypes = csv_util.headers_dtypes(headers)
+            return pa.table({h: pa.array([], type=pa.from_numpy_dtype(dtypes.get(h, "int64"))) for h in (columns or headers)})
+        return pa.concat_tables(tables, promote_options="default").combine_chunks()
+
+    def to_pandas(self) -> pd.DataFrame:
+        return self.to_arrow().to_pandas()
+
+
+def query(
+        syb_type: SymbolType,
+        symbol: str,
+        dataset: str,
+        start: str | datetime.datetime | int,
+        end: str | datetime.datetime | int,
+        interval: str | None = None,
+        columns: list[str] | None = None,
+        *,
+        tidy_root_dir: str = config.tidy_binance_vision_dir,
+        max_threads: int = config.max_query_threads,
+        ) -> RangeQuery:
+    """
+    Query tidy klines or aggTrades of one symbol over a time range, e.g. the close
+    and volume of BTCUSDT 1m klines from 2023-03-01 to 2023-06-30:
+
+        query(SymbolType.SPOT, "BTCUSDT", "klines", "2023-03-01", "2023-06-30", "1m", ["closePrice", "volume"]).to_pandas()
+
+    Only the day files of the range are opened, only columns are read, and
+    parquet row groups and agz blocks outside the range are skipped.
+
+    Args:
+        syb_type: Type of symbol
+        symbol: e.g. BTCUSDT
+        dataset: klines or aggTrades
+        start: First time, a date, a datetime or milliseconds since epoch, UTC
+        end: End time, excluded, a bare yyyy-mm-dd date includes that day
+        interval: Kline interval, e.g. 1m, only for klines
+        columns: Columns to read, all if None
+
+    Returns:
+        A lazy RangeQuery, call to_arrow or to_pandas to read it
+
+    Raises:
+        ValueError: If dataset is unknown or klines have no interval
+    """
+    arrow_cache.dataset_headers(dataset)
+    if dataset == "klines" and interval is None:
+        raise ValueError("klines need an interval, e.g. 1m")
+    end_ms = _to_ms(end)
+    if isinstance(end, str) and len(end) == len("yyyy-mm-dd"):
+        end_ms += ONE_DAY_MS
+    return RangeQuery(syb_type, symbol, dataset, _to_ms(start), end_ms, interval, None if columns is None else tuple(columns), tidy_root_dir, max_threads)
+
+
+if __name__ == "__main__":
+    df = query(SymbolType.SPOT, "BTCUSDT", "klines", "2023-03-01", "2023-06-30", "1m", ["openTime", "closePrice", "volume"]).to_pandas()
+    print(df)
@@ -0,0 +1,115 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+
+import config
+
+_logger = logging.getLogger(__name__)
+
+
+class _StateFile:
+    """
+    Budget state of one market in a small json file, held under an exclusive
+    flock so every process and thread sees the same numbers.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def __enter__(self) -> dict:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._f = open(self.path, "a+")
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        self._f.seek(0)
+        try:
+            self.state = json.loads(self._f.read() or "{}")
+        except json.JSONDecodeError:
+            self.state = {}
+        self.state.setdefault("minute", 0)
+        self.state.setdefault("used", 0)
+        self.state.setdefault("banned_until", 0.0)
+        return self.state
+
+    def __exit__(self, *exc) -> None:
+        try:
+            self._f.seek(0)
+            self._f.truncate()
+            self._f.write(json.dumps(self.state))
+            self._f.flush()
+        finally:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+            self._f.close()
+
+
+def _state_file(market: str, state_dir: str) -> _StateFile:
+    # budgets and bans belong to the server, a fake one must not hold back the real one
+    url_key = hashlib.sha256(config.rest_base_urls[market].encode()).hexdigest()[:16]
+    return _StateFile(os.path.join(state_dir, f"{market.replace('/', '_')}-{url_key}.json"))
+
+
+def _weight_budget(market: str) -> int:
+    return int(config.rest_weight_limits[market] * config.rest_weight_ratio)
+
+
+def acquire(market: str, weight: int, state_dir: str = config.rate_limit_dir) -> None:
+    """
+    Block until weight fits in the budget of market for the current minute, then take it.
+
+    Binance counts request weight per IP in fixed one minute windows, so the budget
+    resets at every minute boundary. A ban set by ban() holds every caller back
+    until it ends.
+
+    Args:
+        market: Key of config.rest_weight_limits, e.g. SymbolType.SPOT.value
+        weight: Request weight of the call about to be made
+        state_dir: Directory of the state files shared by all processes
+    """
+    budget = _weight_budget(market)
+    while True:
+        now = time.time()
+        minute = int(now // 60)
+        with _state_file(market, state_dir) as state:
+            if state["minute"] != minute:
+                state["minute"] = minute
+                state["used"] = 0
+            if state["banned_until"] > now:
+                wait = state["banned_until"] - now
+            elif state["used"] + weight <= budget:
+                state["used"] += weight
+                return
+            else:
+                wait = (minute + 1) * 60 - now
+        _logger.debug(f"Weight budget of {market} used up, waiting {wait:.1f}s")
+        time.sleep(wait)
+
+
+def update_from_headers(market: str, headers: dict, state_dir: str = config.rate_limit_dir) -> None:
+    """
+    Sync the budget with the x-mbx-used-weight-1m header of a response.
+
+    The server count also holds the weight of other programs on the same IP,
+    so it wins whenever it is higher than the local one.
+    """
+    used = None
+    for key, value in headers.items():
+        if key.lower() == "x-mbx-used-weight-1m":
+            used = int(value)
+    if used is None:
+        return
+    minute = int(time.time() // 60)
+    with _state_file(market, state_dir) as state:
+        if state["minute"] != minute:
+            state["minute"] = minute
+            state["used"] = 0
+        state["used"] = max(state["used"], used)
+
+
+def ban(market: str, retry_after: float, state_dir: str = config.rate_limit_dir) -> None:
+    """
+    Stop every caller of market for retry_after seconds, after a 429 or 418 response.
+    """
+    _logger.warning(f"Rate limited on {market}, pausing for {retry_after}s")
+    with _state_file(market, state_dir) as state:
+        state["banned_until"] = max(state["banned_until"], time.time() + retry_after)
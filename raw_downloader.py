@@ -1,4 +1,5 @@
 import logging
+import async_downloader
 from downloader import multi_proc_download_save_until_success
 from xmler import query_vision_xml_file_paths
 import config
@@ -6,14 +7,30 @@ import config
 _logger = logging.getLogger(__name__)
 _logger.setLevel(logging.DEBUG)
 
-def multi_proc_download(prefix: str, marker: str, save_dir: str, check_exists: bool = True, max_workers: int = config.max_workers) -> None:
+def multi_proc_download(
+        prefix: str,
+        marker: str,
+        save_dir: str,
+        check_exists: bool = True,
+        max_workers: int = config.max_workers,
+        *,
+        use_async: bool = False,
+        max_in_flight: int = config.max_in_flight_downloads,
+        verify: bool = True,
+        use_listing_cache: bool = True,
+        listing_url: str = config.vision_listing_url,
+        data_url: str = config.vision_data_url,
+    ) -> None:
     _logger.debug(f"Downloading {prefix} {marker} XML, And Getting File Paths")
-    file_paths = query_vision_xml_file_paths(prefix, marker)
+    file_paths = query_vision_xml_file_paths(prefix, marker, use_cache=use_listing_cache, base_url=listing_url)
     file_paths = [path for path in file_paths if path.endswith('.zip')]
     _logger.debug(f"Found {len(file_paths)} files")
-    urls = [f"https://data.binance.vision/{file_path.strip("/")}" for file_path in file_paths]
+    urls = [f"{data_url.rstrip("/")}/{file_path.strip("/")}" for file_path in file_paths]
     _logger.debug(f"Downloading {prefix} {marker} Files")
-    multi_proc_download_save_until_success(urls, save_dir, check_exists, max_workers)
+    if use_async:
+        async_downloader.download_save_until_success(urls, save_dir, check_exists, max_in_flight, verify)
+    else:
+        multi_proc_download_save_until_success(urls, save_dir, check_exists, max_workers, verify=verify)
     _logger.debug(f"Downloaded {prefix} {marker} Files")
         
         
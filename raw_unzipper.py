@@ -1,7 +1,14 @@
 import logging
 from multiprocessing import Pool
 import os
+import zipfile
 
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+import catalog
+import csv_util
 import zipper
 import config
 
@@ -18,6 +25,57 @@ def unzip_file_to_dir(file_path: str, save_dir: str, check_exists: bool = True)
     
     _logger.info(f"Unzipping {file_path} to {save_path}")
     zipper.unzip_file_save(file_path, save_path)
+    catalog.record_file(save_path)
+    _logger.info(f"Unzipped {file_path} to {save_path}")
+    clear_file(file_path)
+
+
+def unzip_file_to_parquet(file_path: str, save_dir: str, headers: list[str], check_exists: bool = True) -> None:
+    """
+    Convert the csv inside a zip straight into a typed parquet file.
+
+    The csv member is read as a stream and parsed in blocks by pyarrow, each block is
+    written as a parquet row group, so the extracted csv is never materialized and
+    memory stays bounded by the block size.
+
+    Args:
+        file_path: Path to the zip file
+        save_dir: Directory to save the parquet file in, same layout as the unzip tree
+        headers: Column names of the csv, e.g. csv_util.agg_trades_headers
+        check_exists: Skip if the parquet file already exists
+    """
+    save_path = os.path.join(save_dir, os.path.basename(file_path).replace(".zip", ".parquet"))
+    if check_exists and os.path.exists(save_path):
+        return
+
+    os.makedirs(save_dir, exist_ok=True)
+
+    _logger.info(f"Unzipping {file_path} to {save_path}")
+    tmp_path = save_path + ".tmp"
+    rows = 0
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        with zip_ref.open(zip_ref.namelist()[0]) as member:
+            first_bytes = member.peek(1)
+            if len(first_bytes) == 0:
+                # pyarrow refuses empty csv, keep an empty file with the right schema
+                _logger.warning(f"Zip file {file_path} holds an empty csv")
+                dtypes = csv_util.headers_dtypes(headers)
+                # the klines unused column has no fixed type, pyarrow infers int64 for its zeros
+                schema = pa.schema([(h, dtypes.get(h, "int64")) for h in headers])
+                pq.write_table(schema.empty_table(), tmp_path, compression="zstd")
+            else:
+                skip_rows = 1 if csv_util.is_header_line(first_bytes) else 0
+                reader = pa_csv.open_csv(
+                    member,
+                    read_options=pa_csv.ReadOptions(column_names=headers, skip_rows=skip_rows),
+                    convert_options=pa_csv.ConvertOptions(column_types=csv_util.headers_dtypes(headers)),
+                )
+                with pq.ParquetWriter(tmp_path, reader.schema, compression="zstd") as writer:
+                    for batch in reader:
+                        writer.write_batch(batch)
+                        rows += batch.num_rows
+    os.replace(tmp_path, save_path)
+    catalog.record_file(save_path, rows=rows)
     _logger.info(f"Unzipped {file_path} to {save_path}")
     clear_file(file_path)
 
@@ -32,6 +90,7 @@ def clear_file(file_path: str) -> None:
     _logger.info(f"Clearing contents of {file_path}")
     with open(file_path, 'wb') as f:
         f.truncate(0)
+    catalog.record_file(file_path)
     _logger.info(f"Cleared contents of {file_path}")
     
 
@@ -49,12 +108,27 @@ def clear_dir(dir_path: str) -> None:
             if os.path.isfile(file_path):
                 with open(file_path, 'wb') as f:
                     f.truncate(0)
+                catalog.record_file(file_path)
                 _logger.info(f"Cleared contents of {file_path}")
     
 
+def _list_zip_names_to_unzip(zip_dir: str, save_dir: str, ext: str, check_exists: bool) -> list[str]:
+    # both listings come from the catalog, so files unzipped before are skipped without a stat each
+    zip_names = catalog.list_file_names(zip_dir, (".zip",))
+    if not check_exists:
+        return zip_names
+    unzipped_names = set(catalog.list_file_names(save_dir, (ext,)))
+    return [name for name in zip_names if name.replace(".zip", ext) not in unzipped_names]
+
+
 def multi_proc_unzip_one_dir_files_to_dir(zip_dir: str, save_dir: str, check_exists: bool = True, max_workers: int = config.max_workers) -> None:
     with Pool(processes=max_workers) as pool:
-        pool.starmap(unzip_file_to_dir, [(os.path.join(zip_dir, name), save_dir, check_exists) for name in os.listdir(zip_dir) if name.endswith(".zip")])
+        pool.starmap(unzip_file_to_dir, [(os.path.join(zip_dir, name), save_dir, check_exists) for name in _list_zip_names_to_unzip(zip_dir, save_dir, ".csv", check_exists)])
+
+
+def multi_proc_unzip_one_dir_files_to_parquet(zip_dir: str, save_dir: str, headers: list[str], check_exists: bool = True, max_workers: int = config.max_workers) -> None:
+    with Pool(processes=max_workers) as pool:
+        pool.starmap(unzip_file_to_parquet, [(os.path.join(zip_dir, name), save_dir, headers, check_exists) for name in _list_zip_names_to_unzip(zip_dir, save_dir, ".parquet", check_exists)])
         
 
 if __name__ == "__main__":
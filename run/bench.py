@@ -0,0 +1,301 @@
+from pathlib import Path
+import sys
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import time
+from typing import Callable
+
+import bench_data
+import config  # pyright: ignore[reportMissingImports]
+import csv_util  # pyright: ignore[reportMissingImports]
+
+
+_symbol = "BTCUSDT"
+_date = "2025-01-01"
+_agg_trades_stem = f"{_symbol}-aggTrades-{_date}"
+_klines_stem = f"{_symbol}-1s-{_date}"
+_bench_root_dir = os.path.join(config.work_dir, "bench.binance.vision")
+
+
+def _data_dir(root_dir: str, rows: int, micro: bool, gaps: int, seed: int) -> str:
+    return os.path.join(root_dir, "data", f"{rows}-{'us' if micro else 'ms'}-{gaps}gaps-{seed}")
+
+
+def prepare_data(data_dir: str, rows: int, micro: bool, gaps: int, seed: int) -> dict:
+    """
+    Generate the day files of a benchmark once, later runs with the same
+    parameters reuse them.
+
+    Returns:
+        Row counts of the generated files
+    """
+    params_path = os.path.join(data_dir, "params.json")
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            return json.load(f)
+    for sub_dir in ("raw", "missing", "zip", "klines_raw", "klines_missing"):
+        os.makedirs(os.path.join(data_dir, sub_dir), exist_ok=True)
+    raw_path = os.path.join(data_dir, "raw", _agg_trades_stem + ".csv")
+    agg_trades_rows, missing_agg_trades_rows = bench_data.generate_agg_trades_day(
+        raw_path, os.path.join(data_dir, "missing", _agg_trades_stem + ".csv"), _date, rows,
+        micro=micro, gaps=gaps, seed=seed,
+    )
+    bench_data.zip_file(raw_path, os.path.join(data_dir, "zip", _agg_trades_stem + ".zip"))
+    klines_rows, missing_klines_rows = bench_data.generate_klines_day(
+        os.path.join(data_dir, "klines_raw", _klines_stem + ".csv"),
+        os.path.join(data_dir, "klines_missing", _klines_stem + ".csv"),
+        _date, 1000, micro=micro, gaps=gaps, seed=seed,
+    )
+    params = {
+        "rows": rows,
+        "micro": micro,
+        "gaps": gaps,
+        "seed": seed,
+        "agg_trades_rows": agg_trades_rows,
+        "missing_agg_trades_rows": missing_agg_trades_rows,
+        "klines_rows": klines_rows,
+        "missing_klines_rows": missing_klines_rows,
+    }
+    with open(params_path, "w") as f:
+        json.dump(params, f)
+    return params
+
+
+# Every stage does its setup and returns the timed call and the rows it handles.
+# Imports live in the stages so a stage only pays for its own modules.
+
+def _stage_read_agg_trades(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    path = os.path.join(data_dir, "raw", _agg_trades_stem + ".csv")
+    return lambda: csv_util.read_file_to_pandas(path, csv_util.agg_trades_headers), params["agg_trades_rows"]
+
+
+def _stage_read_agg_trades_agz(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    # encoding is setup, only decoding is timed
+    path = os.path.join(tmp_dir, _agg_trades_stem + ".agz")
+    df = csv_util.read_file_to_pandas(os.path.join(data_dir, "raw", _agg_trades_stem + ".csv"), csv_util.agg_trades_headers)
+    csv_util.write_pandas_to_file(df, path)
+    return lambda: csv_util.read_file_to_pandas(path, csv_util.agg_trades_headers), params["agg_trades_rows"]
+
+
+def _stage_unzip_to_csv(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import raw_unzipper  # pyright: ignore[reportMissingImports]
+    # unzipping clears the zip, work on a copy
+    zip_path = shutil.copy(os.path.join(data_dir, "zip", _agg_trades_stem + ".zip"), tmp_dir)
+    return lambda: raw_unzipper.unzip_file_to_dir(zip_path, os.path.join(tmp_dir, "out"), False), params["agg_trades_rows"]
+
+
+def _stage_unzip_to_parquet(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import raw_unzipper  # pyright: ignore[reportMissingImports]
+    zip_path = shutil.copy(os.path.join(data_dir, "zip", _agg_trades_stem + ".zip"), tmp_dir)
+    return lambda: raw_unzipper.unzip_file_to_parquet(zip_path, os.path.join(tmp_dir, "out"), csv_util.agg_trades_headers, False), params["agg_trades_rows"]
+
+
+def _stage_check_consistency(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import agg_trades_checker  # pyright: ignore[reportMissingImports]
+    df = csv_util.read_file_to_pandas(os.path.join(data_dir, "raw", _agg_trades_stem + ".csv"), csv_util.agg_trades_headers)
+    return lambda: agg_trades_checker.check_consistency(df), params["agg_trades_rows"]
+
+
+def _stage_check_one_file_klines(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import klines_checker  # pyright: ignore[reportMissingImports]
+    path = os.path.join(data_dir, "klines_raw", _klines_stem + ".csv")
+    return lambda: klines_checker.check_one_file_klines(path, 1), params["klines_rows"]
+
+
+def _stage_diy_klines(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import diy_klines  # pyright: ignore[reportMissingImports]
+    path = os.path.join(data_dir, "raw", _agg_trades_stem + ".csv")
+    return lambda: diy_klines.merge_one_file_agg_trades_to_klines(60, path), params["agg_trades_rows"]
+
+
+def _stage_diy_klines_ms(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import diy_klines_ms  # pyright: ignore[reportMissingImports]
+    df = csv_util.read_file_to_pandas(os.path.join(data_dir, "raw", _agg_trades_stem + ".csv"), csv_util.agg_trades_headers)
+    return lambda: diy_klines_ms.merge_agg_trades_to_klines(100, df, 0.0), params["agg_trades_rows"]
+
+
+def _stage_diy_klines_ms_streaming(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import diy_klines_ms  # pyright: ignore[reportMissingImports]
+    path = os.path.join(data_dir, "raw", _agg_trades_stem + ".csv")
+    return lambda: diy_klines_ms.merge_agg_trades_to_klines_streaming(100, path, 0.0), params["agg_trades_rows"]
+
+
+def _stage_merge_agg_trades(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import agg_trades_checker  # pyright: ignore[reportMissingImports]
+    # merging clears the raw file, work on a copy
+    raw_dir = os.path.join(tmp_dir, "raw")
+    os.makedirs(raw_dir)
+    shutil.copy(os.path.join(data_dir, "raw", _agg_trades_stem + ".csv"), raw_dir)
+    return lambda: agg_trades_checker.merge_raw_and_missing_trades(
+        _agg_trades_stem + ".csv", raw_dir, os.path.join(data_dir, "missing"), os.path.join(tmp_dir, "tidy"),
+        csv_util.agg_trades_headers, False, "csv",
+    ), params["agg_trades_rows"] + params["missing_agg_trades_rows"]
+
+
+def _stage_merge_klines(data_dir: str, tmp_dir: str, params: dict) -> tuple[Callable[[], object], int]:
+    import klines_checker  # pyright: ignore[reportMissingImports]
+    save_dir = os.path.join(tmp_dir, "tidy")
+    os.makedirs(save_dir)
+    return lambda: klines_checker.merge_raw_and_missing_klines(
+        _klines_stem + ".csv", os.path.join(data_dir, "klines_raw"), os.path.join(data_dir, "klines_missing"), save_dir, False,
+    ), params["klines_rows"] + params["missing_klines_rows"]
+
+
+stages: dict[str, Callable[[str, str, dict], tuple[Callable[[], object], int]]] = {
+    "read_agg_trades": _stage_read_agg_trades,
+    "read_agg_trades_agz": _stage_read_agg_trades_agz,
+    "unzip_to_csv": _stage_unzip_to_csv,
+    "unzip_to_parquet": _stage_unzip_to_parquet,
+    "check_consistency": _stage_check_consistency,
+    "check_one_file_klines": _stage_check_one_file_klines,
+    "diy_klines": _stage_diy_klines,
+    "diy_klines_ms": _stage_diy_klines_ms,
+    "diy_klines_ms_streaming": _stage_diy_klines_ms_streaming,
+    "merge_agg_trades": _stage_merge_agg_trades,
+    "merge_klines": _stage_merge_klines,
+}
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux and in bytes on macos
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / (1024 * 1024) if sys.platform == "darwin" else max_rss / 1024
+
+
+def run_stage(name: str, data_dir: str, tmp_dir: str) -> dict:
+    """
+    Run one stage in this process, which should be fresh so the peak RSS is the stage's own.
+    """
+    with open(os.path.join(data_dir, "params.json")) as f:
+        params = json.load(f)
+    call, rows = stages[name](data_dir, tmp_dir, params)
+    setup_peak_rss_mb = _max_rss_mb()
+    start = time.perf_counter()
+    call()
+    wall_s = time.perf_counter() - start
+    return {
+        "rows": rows,
+        "wall_s": round(wall_s, 4),
+        "rows_per_s": round(rows / wall_s),
+        "setup_peak_rss_mb": round(setup_peak_rss_mb, 1),
+        "peak_rss_mb": round(_max_rss_mb(), 1),
+    }
+
+
+def _git_commit() -> tuple[str, bool]:
+    repo_dir = str(Path(__file__).parent.parent.resolve())
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=repo_dir, capture_output=True, text=True, check=True).stdout != ""
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+
+def run_bench(
+        rows: int,
+        micro: bool = False,
+        gaps: int = 20,
+        seed: int = 0,
+        stage_names: list[str] | None = None,
+        root_dir: str = _bench_root_dir,
+        output_path: str | None = None,
+    ) -> dict:
+    """
+    Run every stage in its own subprocess on one synthetic day and store the results as json.
+
+    Args:
+        rows: Agg trades of the synthetic day, 1M to 20M for BTCUSDT-like days
+        micro: Use microsecond timestamps
+        gaps: Holes cut out of the raw files
+        seed: Seed of the generator
+        stage_names: Stages to run, all by default
+        root_dir: Directory of the generated data and the results
+        output_path: Json file of the results, by default under root_dir/results named by commit
+
+    Returns:
+        The results that were written
+    """
+    data_dir = _data_dir(root_dir, rows, micro, gaps, seed)
+    params = prepare_data(data_dir, rows, micro, gaps, seed)
+    commit, dirty = _git_commit()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "params": params,
+        "stages": {},
+    }
+    for name in stage_names or list(stages):
+        tmp_dir = os.path.join(root_dir, "tmp", name)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        proc = subprocess.run(
+            [sys.executable, __file__, "--run-stage", name, "--data-dir", data_dir, "--tmp-dir", tmp_dir],
+            capture_output=True, text=True,
+        )
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        if proc.returncode != 0:
+            results["stages"][name] = {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit {proc.returncode}"}
+        else:
+            results["stages"][name] = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"{name:24} {json.dumps(results['stages'][name])}")
+
+    if output_path is None:
+        suffix = "-dirty" if dirty else ""
+        output_path = os.path.join(root_dir, "results", f"{commit[:10]}{suffix}-{rows}-{'us' if micro else 'ms'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved to {output_path}")
+    return results
+
+
+def compare(old_path: str, new_path: str) -> None:
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'stage':24} {'old rows/s':>12} {'new rows/s':>12} {'speedup':>8} {'old MB':>8} {'new MB':>8}")
+    for name, n in new["stages"].items():
+        o = old["stages"].get(name)
+        if o is None or "error" in o or "error" in n:
+            print(f"{name:24} {'-':>12} {n.get('rows_per_s', '-'):>12}")
+            continue
+        print(f"{name:24} {o['rows_per_s']:>12} {n['rows_per_s']:>12} {n['rows_per_s'] / o['rows_per_s']:>7.2f}x {o['peak_rss_mb']:>8} {n['peak_rss_mb']:>8}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every pipeline stage on a synthetic day")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--micro", action="store_true", help="microsecond timestamps")
+    parser.add_argument("--gaps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stages", default="", help=f"comma separated, from {','.join(stages)}")
+    parser.add_argument("--root-dir", default=_bench_root_dir)
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--run-stage", help=argparse.SUPPRESS)
+    parser.add_argument("--data-dir", help=argparse.SUPPRESS)
+    parser.add_argument("--tmp-dir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        logging.disable(logging.INFO)
+        print(json.dumps(run_stage(args.run_stage, args.data_dir, args.tmp_dir)))
+    elif args.compare:
+        compare(*args.compare)
+    else:
+        run_bench(args.rows, args.micro, args.gaps, args.seed, [s for s in args.stages.split(",") if s] or None, args.root_dir, args.output)
@@ -0,0 +1,169 @@
+from pathlib import Path
+import sys
+sys.path.append(str(Path(__file__).parent.parent.resolve()))
+
+import datetime
+import os
+import zipfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+import csv_util  # pyright: ignore[reportMissingImports]
+
+
+_one_day_ms = 24 * 60 * 60 * 1000
+# rows generated and written at a time, keeps 20M row days in bounded memory
+_chunk_rows = 1_000_000
+
+
+def _day_start_ms(date: str) -> int:
+    day = datetime.datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc)
+    return int(day.timestamp() * 1000)
+
+
+def _bool_strings(values: np.ndarray) -> pa.Array:
+    # binance spot archives spell booleans True/False
+    return pa.array(np.where(values, "True", "False"))
+
+
+def generate_agg_trades_day(
+        raw_path: str,
+        missing_path: str,
+        date: str,
+        rows: int,
+        *,
+        micro: bool = False,
+        gaps: int = 0,
+        first_id: int = 1,
+        seed: int = 0,
+    ) -> tuple[int, int]:
+    """
+    Write one synthetic day of spot agg trades like a Binance Vision csv.
+
+    Ids are dense from first_id, times are sorted over the day and prices follow a
+    random walk. gaps blocks of trades are left out of raw_path and written to
+    missing_path with a header, the way agg_trades_checker saves trades downloaded
+    from the api, so the check and merge stages have holes to work on.
+
+    Args:
+        raw_path: Path of the headerless csv like the unzipped archive
+        missing_path: Path of the csv of the trades left out
+        date: Day of the trades, yyyy-mm-dd
+        rows: Number of trades of the day, before the gaps are cut out
+        micro: Write times in microseconds like Binance spot since 2025
+        gaps: Number of holes cut out of the raw file
+        first_id: Id of the first trade
+        seed: Seed of the generator
+
+    Returns:
+        (rows in raw_path, rows in missing_path)
+    """
+    rng = np.random.default_rng(seed)
+    start_ms = _day_start_ms(date)
+    # holes start anywhere and are up to 0.1% of the day long each
+    gap_starts = np.sort(rng.integers(0, rows, gaps))
+    gap_ends = gap_starts + rng.integers(1, max(2, rows // 1000), gaps)
+    is_gap = np.zeros(rows, dtype=bool)
+    for s, e in zip(gap_starts, gap_ends):
+        is_gap[s:e] = True
+
+    schema = pa.schema([(h, pa.int64() if t == "int64" else pa.float64() if t == "float64" else pa.string())
+                        for h, t in csv_util.agg_trades_dtypes.items()])
+    raw_options = pa_csv.WriteOptions(include_header=False, quoting_style="none")
+    missing_options = pa_csv.WriteOptions(quoting_style="none")
+    raw_rows = 0
+    missing_rows = 0
+    price = 30000.0
+    with pa_csv.CSVWriter(raw_path, schema, write_options=raw_options) as raw_writer, \
+            pa_csv.CSVWriter(missing_path, schema, write_options=missing_options) as missing_writer:
+        for chunk_start in range(0, rows, _chunk_rows):
+            n = min(_chunk_rows, rows - chunk_start)
+            ids = np.arange(first_id + chunk_start, first_id + chunk_start + n, dtype=np.int64)
+            # each chunk covers its share of the day, so times stay sorted across chunks
+            slice_ms = _one_day_ms * n // rows
+            chunk_start_ms = start_ms + _one_day_ms * chunk_start // rows
+            times = chunk_start_ms + np.sort(rng.integers(0, max(1, slice_ms), n))
+            if micro:
+                times = times * 1000 + rng.integers(0, 1000, n)
+                times.sort()
+            prices = np.round(price * np.exp(np.cumsum(rng.normal(0, 2e-5, n))), 2)
+            price = float(prices[-1])
+            first_trade_ids = ids * 3
+            columns = [
+                pa.array(ids),
+                pa.array(prices),
+                pa.array(np.round(rng.lognormal(-4, 1.5, n), 5)),
+                pa.array(first_trade_ids),
+                pa.array(first_trade_ids + rng.integers(0, 3, n)),
+                pa.array(times),
+                _bool_strings(rng.random(n) < 0.5),
+                _bool_strings(np.ones(n, dtype=bool)),
+            ]
+            table = pa.Table.from_arrays(columns, schema=schema)
+            chunk_is_gap = is_gap[chunk_start:chunk_start + n]
+            raw_writer.write_table(table.filter(pa.array(~chunk_is_gap)))
+            missing_writer.write_table(table.filter(pa.array(chunk_is_gap)))
+            raw_rows += int((~chunk_is_gap).sum())
+            missing_rows += int(chunk_is_gap.sum())
+    return raw_rows, missing_rows
+
+
+def generate_klines_day(
+        raw_path: str,
+        missing_path: str,
+        date: str,
+        interval_ms: int,
+        *,
+        micro: bool = False,
+        gaps: int = 0,
+        seed: int = 0,
+    ) -> tuple[int, int]:
+    """
+    Write one synthetic day of klines like a Binance Vision csv, gaps blocks of
+    klines are left out of raw_path and written to missing_path with a header.
+
+    Returns:
+        (rows in raw_path, rows in missing_path)
+    """
+    rng = np.random.default_rng(seed)
+    n = _one_day_ms // interval_ms
+    open_time = _day_start_ms(date) + interval_ms * np.arange(n, dtype=np.int64)
+    close = np.round(30000.0 * np.exp(np.cumsum(rng.normal(0, 1e-4, n))), 2)
+    open_ = np.r_[close[0], close[:-1]]
+    volume = np.round(rng.uniform(0, 10, n), 5)
+    taker_buy = np.round(volume * rng.uniform(0, 1, n), 5)
+    unit = 1000 if micro else 1
+    columns = {
+        "openTime": open_time * unit,
+        "openPrice": open_,
+        "highPrice": np.maximum(open_, close) + 0.01,
+        "lowPrice": np.minimum(open_, close) - 0.01,
+        "closePrice": close,
+        "volume": volume,
+        "closeTime": (open_time + interval_ms) * unit - 1,
+        "quoteAssetVolume": np.round(volume * close, 5),
+        "tradesNumber": rng.integers(1, 500, n),
+        "takerBuyBaseAssetVolume": taker_buy,
+        "takerBuyQuoteAssetVolume": np.round(taker_buy * close, 5),
+        "unused": np.zeros(n, dtype=np.int64),
+    }
+    table = pa.table(columns)
+    is_gap = np.zeros(n, dtype=bool)
+    for s in rng.integers(0, n, gaps):
+        is_gap[s:s + int(rng.integers(1, max(2, n // 100)))] = True
+    pa_csv.write_csv(table.filter(pa.array(~is_gap)), raw_path, pa_csv.WriteOptions(include_header=False, quoting_style="none"))
+    pa_csv.write_csv(table.filter(pa.array(is_gap)), missing_path, pa_csv.WriteOptions(quoting_style="none"))
+    return int((~is_gap).sum()), int(is_gap.sum())
+
+
+def zip_file(file_path: str, zip_path: str) -> None:
+    # level 1 keeps generating 20M row days fast, the unzip cost is about the same
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED, compresslevel=1) as z:
+        z.write(file_path, os.path.basename(file_path))
+
+
+if __name__ == "__main__":
+    os.makedirs("/tmp/pybnv_bench_data", exist_ok=True)
+    print(generate_agg_trades_day("/tmp/pybnv_bench_data/raw.csv", "/tmp/pybnv_bench_data/missing.csv", "2025-01-01", 100_000, gaps=3))
@@ -1,58 +1,137 @@
+import hashlib
+import io
+import json
+import os
 import time
 import requests
-from typing import List
-import xml.dom.minidom
+from typing import Iterator, List
+import xml.etree.ElementTree as ET
 import logging
 
+import config
+
 _logger = logging.getLogger(__name__)
 
-def query_vision_xml_file_paths(prefix: str, marker: str = '') -> List[str]:
+
+def _query_vision_xml_page(prefix: str, marker: str, base_url: str = config.vision_listing_url) -> bytes:
+    url = f"{base_url}?delimiter=/&prefix={prefix}&marker={marker}"
+    while True:
+        try:
+            response = requests.get(url)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            _logger.error(f"Error querying vision XML: {e}")
+            time.sleep(1)
+
+
+def iter_vision_xml_file_paths(prefix: str, marker: str = '', base_url: str = config.vision_listing_url) -> Iterator[str]:
+    """
+    Iterate over file paths under a Binance Vision prefix, one 1000-key page at a time.
+
+    Each page is parsed with iterparse and every element is cleared once read,
+    so no DOM is built and pages are requested lazily as the caller iterates.
+
+    Args:
+        prefix: Prefix of the XML file to query
+        if url is https://data.binance.vision/data/spot/daily/aggTrades/BTCUSDT/,
+        then prefix is data/spot/daily/aggTrades/BTCUSDT/
+
+        marker: Start file path with prefix, only paths after it are returned
+
+        base_url: URL of the S3 bucket listing, config.vision_listing_url by default
+
+    Yields:
+        File paths in key order
+    """
+    prefix = prefix.strip('/') + "/"
+    while True:
+        content = _query_vision_xml_page(prefix, marker, base_url)
+        next_marker = ""
+        for _, el in ET.iterparse(io.BytesIO(content), events=("end",)):
+            # S3 puts every tag in its namespace, e.g. {http://s3.amazonaws.com/doc/2006-03-01/}Key
+            tag = el.tag.rsplit("}", 1)[-1]
+            if tag == "Key":
+                yield el.text
+            elif tag == "NextMarker":
+                next_marker = el.text or ""
+            if tag != "ListBucketResult":
+                el.clear()
+        if next_marker == "":
+            return
+        marker = next_marker
+
+
+def _listing_cache_path(prefix: str, cache_dir: str, base_url: str) -> str:
+    # listings of different buckets, e.g. the fake server, never share a high-water mark
+    url_key = hashlib.sha256(base_url.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, url_key, prefix.strip('/'), "listing.json")
+
+
+def _load_listing_cache(prefix: str, cache_dir: str, base_url: str) -> dict | None:
+    path = _listing_cache_path(prefix, cache_dir, base_url)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        _logger.warning(f"Broken listing cache {path}, ignoring it")
+        return None
+
+
+def _save_listing_cache(prefix: str, cache_dir: str, base_url: str, cache: dict) -> None:
+    path = _listing_cache_path(prefix, cache_dir, base_url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
+
+
+def query_vision_xml_file_paths(
+        prefix: str,
+        marker: str = '',
+        use_cache: bool = False,
+        cache_dir: str = config.listing_cache_dir,
+        base_url: str = config.vision_listing_url,
+        ) -> List[str]:
     """
     Query Binance Vision XML for a given prefix.
-    
+
     Args:
         prefix: Prefix of the XML file to query
         if url is https://data.binance.vision/data/spot/daily/aggTrades/BTCUSDT/,
         then prefix is data/spot/daily/aggTrades/BTCUSDT/
 
         marker: Start file path with prefix
-        
+
+        use_cache: Keep the listing of the prefix on disk and only request
+        pages after the last cached key, the high-water mark
+
+        cache_dir: Root directory of the listing cache, kept apart per base_url
+
+        base_url: URL of the S3 bucket listing, config.vision_listing_url by default
+
     Returns:
         List of file paths
     """
-    prefix = prefix.strip('/') + "/"
-    url = f"https://s3-ap-northeast-1.amazonaws.com/data.binance.vision?delimiter=/&prefix={prefix}&marker={marker}"
-    while True:
-        try:
-            response = requests.get(url)
-            response.raise_for_status()
-            break
-        except Exception as e:
-            _logger.error(f"Error querying vision XML: {e}")
-            time.sleep(1)
-    
-    encoding = response.encoding or 'utf-8'
-    content = response.content.decode(encoding)
-    
-    el = xml.dom.minidom.parseString(content)
-    
-    contents = el.getElementsByTagName("Contents")
-
-    file_paths: List[str] = []
-
-    for content in contents:
-        file_paths.append(content.getElementsByTagName("Key")[0].firstChild.data)
-    
-    next_marker_el = el.getElementsByTagName("NextMarker")
-
-    next_marker = next_marker_el[0].firstChild.data if len(next_marker_el) > 0 else ""
-    
-    if next_marker == "":
-        return file_paths
-    
-    other_file_paths = query_vision_xml_file_paths(prefix, next_marker)
-    
-    return file_paths + other_file_paths
+    if not use_cache:
+        return list(iter_vision_xml_file_paths(prefix, marker, base_url))
+
+    # cache holds every key after its own start marker, so it can serve any later marker
+    cache = _load_listing_cache(prefix, cache_dir, base_url)
+    if cache is None or cache["marker"] > marker:
+        cache = {"marker": marker, "keys": []}
+
+    high_water_mark = cache["keys"][-1] if cache["keys"] else cache["marker"]
+    new_file_paths = list(iter_vision_xml_file_paths(prefix, high_water_mark, base_url))
+    _logger.debug(f"Listing cache of {prefix}: {len(cache['keys'])} cached, {len(new_file_paths)} new")
+    if new_file_paths or not os.path.exists(_listing_cache_path(prefix, cache_dir, base_url)):
+        cache["keys"].extend(new_file_paths)
+        _save_listing_cache(prefix, cache_dir, base_url, cache)
+
+    return [path for path in cache["keys"] if path > marker]
 
 if __name__ == "__main__":
     file_paths = query_vision_xml_file_paths("data/futures/um/daily/klines/BTCUSDT/1m/")